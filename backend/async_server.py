@@ -0,0 +1,299 @@
+"""asyncio server mode (aiohttp), selected with RWS_SERVER=async or ``--server async``.
+
+/ws runs on the event loop: a connection is a coroutine instead of a blocked
+thread, and the serial reader threads hand data over with a subscriber notify
+callback (``call_soon_threadsafe``), so a client wakes only when one of its
+devices has something new. The static frontend is served directly. Every other
+/api route is the Flask view itself, called through WSGI on a bounded thread
+pool, so both server modes expose the same API.
+
+Needs aiohttp (in requirements.txt); the Flask server remains the default and
+works without it.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from aiohttp import WSMsgType, web
+except ImportError:
+    web = None
+
+# Threads for bridged /api requests (short request/response calls, not connections)
+API_THREADS = int(os.environ.get("RWS_API_THREADS", "8"))
+# Chunks of a streamed /api response (e.g. /api/export) buffered between its thread and the client
+API_STREAM_CHUNKS = 8
+
+
+def _wsgi_environ(request, body):
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": request.path,
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": request.host.split(":")[0],
+        "SERVER_PORT": str(request.url.port or 80),
+        "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+        "REMOTE_ADDR": request.remote or "",
+        "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ["HTTP_" + key] = value
+    return environ
+
+
+def _call_wsgi(wsgi_app, environ, loop, started, chunks, cancel):
+    """Run one WSGI request on this executor thread.
+
+    A response with a Content-Length is joined and handed to ``started`` whole.
+    Any other (a generator, e.g. /api/export) is iterated here, on the thread
+    that called the app as ``stream_with_context`` requires, and passed on
+    through the bounded ``chunks`` queue, ending with None; ``cancel`` stops it
+    when the client goes away.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    try:
+        result = wsgi_app(environ, start_response)
+    except BaseException as e:
+        loop.call_soon_threadsafe(started.set_exception, e)
+        return
+    try:
+        if any(name.lower() == "content-length" for name, _ in response["headers"]):
+            body = b"".join(result)
+            loop.call_soon_threadsafe(started.set_result, (response["status"], response["headers"], body))
+            return
+        loop.call_soon_threadsafe(started.set_result, (response["status"], response["headers"], None))
+        for chunk in result:
+            if cancel.is_set():
+                break
+            if chunk:
+                asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+    except BaseException as e:
+        if not started.done():
+            loop.call_soon_threadsafe(started.set_exception, e)
+        raise
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+        asyncio.run_coroutine_threadsafe(chunks.put(None), loop)
+
+
+class AsyncServer:
+    def __init__(self, backend):
+        # ``backend`` is the start_backend module (passed in so that running it as
+        # __main__ does not import a second copy with its own device registry)
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(API_THREADS, thread_name_prefix="rws-api")
+        self.app = web.Application()
+        self.app.router.add_get("/ws", self.ws)
+        self.app.router.add_get("/stream", self.stream)
+        self.app.router.add_route("*", "/api/{tail:.*}", self.api)
+        self.app.router.add_get("/{path:.*}", self.frontend)
+
+    async def api(self, request):
+        body = await request.read()
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+        chunks = asyncio.Queue(API_STREAM_CHUNKS)
+        cancel = threading.Event()
+        loop.run_in_executor(self.executor, _call_wsgi, self.backend.app.wsgi_app, _wsgi_environ(request, body),
+                             loop, started, chunks, cancel)
+        status, headers, payload = await started
+        if payload is not None:
+            response = web.Response(status=status, body=payload)
+        else:
+            response = web.StreamResponse(status=status)
+        for name, value in headers:
+            if name.lower() != "content-length":
+                response.headers.add(name, value)
+        if payload is not None:
+            return response
+        try:
+            await response.prepare(request)
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+        except ConnectionResetError:
+            pass
+        finally:
+            # Unblock the executor thread if it is waiting on a full queue
+            cancel.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+        return response
+
+    async def frontend(self, request):
+        # Same rules as the Flask view: static files, index.html for SPA routes
+        web_dir = os.path.abspath(self.backend.WEB_DIR)
+        if not os.path.isdir(web_dir):
+            return web.json_response({"error": "frontend not built"}, status=404)
+        path = request.match_info["path"]
+        full_path = os.path.abspath(os.path.join(web_dir, path))
+        if path and full_path.startswith(web_dir + os.sep) and os.path.isfile(full_path):
+            return web.FileResponse(full_path)
+        return web.FileResponse(os.path.join(web_dir, "index.html"))
+
+    async def stream(self, request):
+        # Native handler: the WSGI bridge would buffer the endless /stream response
+        backend = self.backend
+        options = backend.WsOptions(request.query)
+        window = options.window
+        since = backend.sse_resume(request.headers.get("Last-Event-ID") or request.query.get("last_event_id"),
+                                   len(options.device_ids))
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def notify():
+            # Runs on a reader thread
+            loop.call_soon_threadsafe(wake.set)
+
+        try:
+            streams = options.open_streams(threading.Event(), notify, since)
+        except backend.DeviceError as e:
+            return web.json_response({"error": str(e)}, status=e.status)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                               "X-Accel-Buffering": "no", "Access-Control-Allow-Origin": "*"})
+        try:
+            await response.prepare(request)
+            await response.write(f"retry: {backend.SSE_RETRY_MS}\n\n".encode())
+            idle_since = loop.time()
+            while True:
+                started = loop.time()
+                try:
+                    await asyncio.wait_for(wake.wait(), window)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                remaining = window - (loop.time() - started)
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                chunk, sent = backend.sse_chunk(streams)
+                if chunk:
+                    idle_since = loop.time()
+                    write_started = time.perf_counter()
+                    await response.write(chunk.encode())
+                    backend.sse_sent(sent, time.perf_counter() - write_started)
+                elif loop.time() - idle_since >= backend.SSE_HEARTBEAT:
+                    idle_since = loop.time()
+                    await response.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            pass
+        finally:
+            for stream in streams:
+                stream.close()
+        return response
+
+    async def ws(self, request):
+        backend = self.backend
+        options = backend.WsOptions(request.query)
+        try:
+            options.check_devices()
+        except backend.DeviceError as e:
+            return web.json_response({"error": str(e)}, status=e.status)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        window = options.window
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def notify():
+            # Runs on a reader thread
+            loop.call_soon_threadsafe(wake.set)
+
+        try:
+            streams = options.open_streams(threading.Event(), notify)
+        except backend.DeviceError as e:
+            await ws.send_str(json.dumps({"type": "console", "text": f"ws: {e}"}))
+            await ws.close()
+            return ws
+
+        async def send(stream, frame):
+            started = time.perf_counter()
+            if isinstance(frame, bytes):
+                await ws.send_bytes(frame)
+            else:
+                await ws.send_str(frame)
+            stream.sent(frame, time.perf_counter() - started)
+
+        async def drain():
+            for stream in streams:
+                for text in stream.poll():
+                    await send(stream, text)
+
+        async def stream_loop():
+            while not ws.closed:
+                started = loop.time()
+                try:
+                    await asyncio.wait_for(wake.wait(), window)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                await drain()
+                # Let samples accumulate for the rest of the window before draining again
+                remaining = window - (loop.time() - started)
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    await drain()
+                for stream in streams:
+                    for frame in stream.frames(options.encoding):
+                        await send(stream, frame)
+
+        sender = asyncio.ensure_future(stream_loop())
+        try:
+            # Reading is also what notices a close
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    await ws.send_str(backend.ws_message(streams, msg.data))
+                elif msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            sender.cancel()
+            try:
+                await sender
+            except (asyncio.CancelledError, Exception):
+                pass
+            for stream in streams:
+                stream.close()
+        return ws
+
+
+def require_aiohttp():
+    if web is None:
+        raise RuntimeError("the async server mode needs aiohttp (pip install aiohttp); "
+                           "without it, run the default Flask server")
+
+
+def create_app(backend):
+    require_aiohttp()
+    return AsyncServer(backend).app
+
+
+def run(backend, host="127.0.0.1", port=5000, handle_signals=True, sock=None):
+    # handle_signals=False when not on the main thread (tray app); ``sock`` is an
+    # already listening socket to serve instead of binding host:port
+    if sock is not None:
+        host = port = None
+    web.run_app(create_app(backend), host=host, port=port, sock=sock, print=None, handle_signals=handle_signals)
@@ -0,0 +1,177 @@
+"""PacketDecoder throughput on synthetic buffers.
+
+Scenarios:
+  binary     aligned packets only
+  mixed      packets with console log lines interleaved
+  corrupted  packets with random byte drops / garbage inserted (misaligned stream)
+  v2         protocol v2 frames of 40 packets with console frames interleaved
+  v2-corrupted  v2 frames with the same byte drops / garbage as ``corrupted``
+  v2-block   v2 compact block frames (int16 columns, all channels) of 160 samples
+  idle-reply  bursts of packets, each ending in a short reply (``1.00``) and then an
+             idle read, as after ``pid stream off``; every reply must come out
+             (``console_lines == lines_expected``)
+
+Each scenario is fed in fixed-size reads, like the serial reader does, and one
+JSON object per scenario is printed. Every scenario without damage is also a
+regression check: all packets must be decoded (``packets_decoded ==
+packets_expected``) and no console line may be misframed. The exit status is 1
+if any check fails (``"ok": false``).
+
+    python bench/bench_decoder.py --packets 200000 --read-size 4096
+"""
+import argparse
+import random
+import sys
+import time
+
+from common import SyntheticDevice, emit
+from protocol import FRAME_BLOCK, FRAME_CONSOLE, FRAME_PACKETS, PACKET_STRUCT, PacketDecoder, encode_block, encode_frame
+
+# Scenarios whose streams are not damaged on purpose: nothing may be lost
+CLEAN_SCENARIOS = ("binary", "mixed", "v2", "v2-block", "idle-reply")
+FRAME_PACKET_COUNT = 40
+BLOCK_SAMPLES = 160
+# Replies shorter than a packet, the case the v1 decoder holds back while packets flow
+SHORT_REPLIES = (b"1.00\n", b"P=1.000\n", b"Streaming OFF\n", b"ok\n")
+
+
+def damage(rng, chunk):
+    # USB hiccup: part of the chunk is lost, or garbage arrives before it
+    r = rng.random()
+    if r < 0.005:
+        return chunk[rng.randrange(1, len(chunk)):]
+    if r < 0.01:
+        return bytes(rng.randrange(256) for _ in range(rng.randrange(1, 40))) + chunk
+    return chunk
+
+
+def build_v2(device, rng, packets, corrupted):
+    out = bytearray()
+    for _ in range(0, packets, FRAME_PACKET_COUNT):
+        frame = encode_frame(FRAME_PACKETS, device.packets(FRAME_PACKET_COUNT))
+        out += damage(rng, frame) if corrupted else frame
+        if rng.random() < 0.4:
+            out += encode_frame(FRAME_CONSOLE, device.log_line().rstrip(b"\n"))
+    return bytes(out)
+
+
+def build_blocks(device, rng, packets):
+    out = bytearray()
+    for _ in range(0, packets, BLOCK_SAMPLES):
+        rows = [row[:6] for row in PACKET_STRUCT.iter_unpack(device.packets(BLOCK_SAMPLES))]
+        out += encode_frame(FRAME_BLOCK, encode_block(rows))
+        if rng.random() < 0.4 * BLOCK_SAMPLES / FRAME_PACKET_COUNT:
+            out += encode_frame(FRAME_CONSOLE, device.log_line().rstrip(b"\n"))
+    return bytes(out)
+
+
+def build_bursts(device, rng, packets):
+    # Each burst is followed by silence on the link
+    bursts = []
+    for _ in range(0, packets, FRAME_PACKET_COUNT):
+        bursts.append(device.packets(FRAME_PACKET_COUNT) + rng.choice(SHORT_REPLIES))
+    return bursts
+
+
+def build(scenario, packets, seed):
+    """Stream of the scenario (a list of bursts for idle-reply) and the packets in it."""
+    device = SyntheticDevice(seed)
+    return _build(scenario, packets, device, random.Random(seed)), device.seq
+
+
+def _build(scenario, packets, device, rng):
+    if scenario == "idle-reply":
+        return build_bursts(device, rng, packets)
+    if scenario == "binary":
+        return device.packets(packets)
+    if scenario in ("v2", "v2-corrupted"):
+        return build_v2(device, rng, packets, scenario == "v2-corrupted")
+    if scenario == "v2-block":
+        return build_blocks(device, rng, packets)
+    out = bytearray()
+    for _ in range(packets):
+        pkt = device.sample()
+        if scenario == "mixed":
+            out += pkt
+            if rng.random() < 0.01:
+                out += device.log_line()
+        elif scenario == "corrupted":
+            out += damage(rng, pkt)
+    return bytes(out)
+
+
+def run(scenario, packets, read_size, seed, repeat):
+    data, packets_expected = build(scenario, packets, seed)
+    # Bursts are separated by an empty read (port timeout); everything else is one stream
+    bursts = data if isinstance(data, list) else [data]
+    best = None
+    for _ in range(repeat):
+        decoded = [0]
+        lines = [0]
+
+        def on_packets(rows, raw):
+            decoded[0] += len(rows)
+
+        def on_line(text):
+            lines[0] += 1
+
+        decoder = PacketDecoder(on_packets, on_line)
+        start = time.perf_counter()
+        for burst in bursts:
+            for i in range(0, len(burst), read_size):
+                decoder.feed(burst[i:i + read_size])
+            decoder.flush_idle()
+        lines_expected = len(bursts) if scenario == "idle-reply" else None
+        # Only what came out before the final flush counts for the check
+        lines_before_flush = lines[0]
+        decoder.flush()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, decoded[0], lines[0], decoder, lines_before_flush)
+    elapsed, decoded, lines, decoder, lines_before_flush = best
+    size = sum(len(burst) for burst in bursts)
+    ok = None
+    if scenario in CLEAN_SCENARIOS:
+        ok = decoded == packets_expected and decoder.misframed == 0
+        if lines_expected is not None:
+            ok = ok and lines_before_flush == lines_expected
+    return {
+        "bench": "decoder",
+        "scenario": scenario,
+        "packets_sent": packets,
+        "bytes": size,
+        "read_size": read_size,
+        "packets_expected": packets_expected if scenario in CLEAN_SCENARIOS else None,
+        "packets_decoded": decoded,
+        "console_lines": lines,
+        "lines_expected": lines_expected,
+        "ok": ok,
+        "rejected": decoder.rejected,
+        "misframed_lines": decoder.misframed,
+        "frame_crc_errors": decoder.crc_errors,
+        "skipped_bytes": decoder.skipped,
+        "seconds": elapsed,
+        "packets_per_s": decoded / elapsed if elapsed else None,
+        "mb_per_s": size / elapsed / 1e6 if elapsed else None,
+        "bytes_per_sample": size / decoded if decoded else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="binary,mixed,corrupted,v2,v2-corrupted,v2-block,idle-reply")
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--read-size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    failed = False
+    for scenario in args.scenarios.split(","):
+        result = run(scenario, args.packets, args.read_size, args.seed, args.repeat)
+        emit(result)
+        failed |= result["ok"] is False
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""End-to-end backend benchmark over a pseudo-terminal pair.
+
+A generator driven by the simulator's DeviceModel writes packets (and the odd log
+line) into the master side of a pty at a fixed rate; the backend's SerialService
+reads the slave side. Each client records when every packet reached it, and the
+run reports packets/s, drops and device-to-client latency percentiles as JSON.
+
+Transports:
+  ws    real /ws clients (needs simple_websocket, and flask_sock or aiohttp for --server async)
+  hub   in-process hub subscribers (no web server involved)
+  auto  ws when available, hub otherwise
+
+    python bench/bench_e2e.py --rate 8000 --seconds 10 --clients 2 --transport auto
+
+POSIX only (needs os.openpty).
+"""
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+import urllib.request
+from array import array
+
+from common import SyntheticDevice, emit, percentiles
+
+import start_backend  # noqa: E402
+from telemetry import BATCH_HEADER, BATCH_MAGIC  # noqa: E402
+
+
+class Generator(threading.Thread):
+    def __init__(self, fd, rate, seconds, seed, log_every):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.rate = rate
+        self.seconds = seconds
+        self.device = SyntheticDevice(seed)
+        self.log_every = log_every
+        self.sent_at = array("d")
+        self.lines = 0
+
+    def run(self):
+        tick = 0.001
+        per_tick = self.rate * tick
+        owed = 0.0
+        start = next_time = time.perf_counter()
+        while next_time - start < self.seconds:
+            owed += per_tick
+            n = int(owed)
+            owed -= n
+            payload = self.device.packets(n)
+            if self.log_every and self.device.seq // self.log_every != (self.device.seq - n) // self.log_every:
+                payload += self.device.log_line()
+                self.lines += 1
+            now = time.perf_counter()
+            os.write(self.fd, payload)
+            self.sent_at.extend([now] * n)
+            next_time += tick
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class HubClient(threading.Thread):
+    def __init__(self, service, expected):
+        super().__init__(daemon=True)
+        self.sub = service.subscribe()
+        self.received_at = array("d", bytes(8 * expected))
+        self.running = True
+
+    def run(self):
+        while self.running:
+            rows, _ = self.sub.get(timeout=0.05)
+            if rows:
+                now = time.perf_counter()
+                for row in rows:
+                    if row[0] < len(self.received_at):
+                        self.received_at[row[0]] = now
+
+    def stop(self):
+        self.running = False
+        start_backend.hub.unsubscribe(self.sub)
+
+    def dropped(self):
+        return self.sub.dropped
+
+
+def server_clients(port):
+    """Subscriber stats of the default device, by subscriber id, from /api/clients"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/clients", timeout=5) as r:
+        return {stats["id"]: stats for stats in json.load(r)["clients"]}
+
+
+class WsClient(threading.Thread):
+    def __init__(self, url, port, expected):
+        super().__init__(daemon=True)
+        import simple_websocket
+        # Drops happen in the server's per-client buffer, so note which subscriber is ours
+        known = server_clients(port)
+        self.ws = simple_websocket.Client.connect(url)
+        self.sub_id = None
+        for _ in range(100):
+            new = set(server_clients(port)) - set(known)
+            if new:
+                self.sub_id = min(new)
+                break
+            time.sleep(0.01)
+        self.server_stats = None
+        self.received_at = array("d", bytes(8 * expected))
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                frame = self.ws.receive(timeout=0.05)
+            except Exception:
+                break
+            if not isinstance(frame, (bytes, bytearray)):
+                continue
+            now = time.perf_counter()
+            magic, count = BATCH_HEADER.unpack_from(frame)
+            if magic != BATCH_MAGIC:
+                continue
+            for seq in struct.unpack_from(f"<{count}I", frame, BATCH_HEADER.size):
+                if seq < len(self.received_at):
+                    self.received_at[seq] = now
+
+    def stop(self):
+        self.running = False
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def dropped(self):
+        # Read from /api/clients at the end of the run, before the socket closed
+        return self.server_stats["dropped"] if self.server_stats else None
+
+
+class AsyncServerThread:
+    """async_server on a free port in a background thread (same surface as werkzeug's server)"""
+
+    def __init__(self):
+        import socket
+        import async_server
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.server_port = s.getsockname()[1]
+        threading.Thread(target=async_server.run, args=(start_backend, "127.0.0.1", self.server_port, False),
+                         daemon=True).start()
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.server_port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def shutdown(self):
+        pass  # daemon thread, ends with the process
+
+
+def start_server(kind):
+    if kind == "async":
+        return AsyncServerThread()
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, start_backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=8000.0, help="packets per second")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--transport", choices=("auto", "ws", "hub"), default="auto")
+    parser.add_argument("--server", choices=("flask", "async"), default="flask", help="server mode behind /ws")
+    parser.add_argument("--window", type=int, default=10, help="/ws batch window in ms")
+    parser.add_argument("--log-every", type=int, default=1000, help="one console line per N packets (0: none)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    transport = args.transport
+    if transport == "auto":
+        try:
+            import simple_websocket  # noqa: F401
+            transport = "ws" if start_backend.sock or args.server == "async" else "hub"
+        except ImportError:
+            transport = "hub"
+
+    expected = int(args.rate * args.seconds) + int(args.rate) + 1
+    master, slave = os.openpty()
+    service = start_backend.serial_service
+    service.connect(os.ttyname(slave))
+
+    server = None
+    if transport == "ws":
+        server = start_server(args.server)
+        url = f"ws://127.0.0.1:{server.server_port}/ws?encoding=binary&window={args.window}"
+        clients = [WsClient(url, server.server_port, expected) for _ in range(args.clients)]
+    else:
+        clients = [HubClient(service, expected) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    time.sleep(0.2)
+
+    generator = Generator(master, args.rate, args.seconds, args.seed, args.log_every)
+    started = time.perf_counter()
+    generator.start()
+    generator.join()
+    elapsed = time.perf_counter() - started
+    time.sleep(0.5)
+
+    decoder = service.decoder
+    stats = {
+        "decoded": decoder.packets if decoder else None,
+        "rejected": decoder.rejected if decoder else None,
+        "console_lines": decoder.lines if decoder else None,
+    }
+    if transport == "ws":
+        final = server_clients(server.server_port)
+        for client in clients:
+            client.server_stats = final.get(client.sub_id)
+    for client in clients:
+        client.stop()
+    service.disconnect()
+    if server:
+        server.shutdown()
+    os.close(master)
+    os.close(slave)
+
+    sent = generator.sent_at
+    per_client = []
+    for client in clients:
+        received = client.received_at
+        latencies = [(received[i] - sent[i]) * 1000.0 for i in range(len(sent)) if received[i]]
+        per_client.append({
+            "received": len(latencies),
+            "missing": len(sent) - len(latencies),
+            "buffer_dropped": client.dropped(),
+            "latency_ms": percentiles(latencies),
+        })
+
+    emit({
+        "bench": "e2e",
+        "transport": transport,
+        "server": args.server if transport == "ws" else None,
+        "window_ms": args.window if transport == "ws" else None,
+        "reader_mode": service.reader_mode,
+        "rate": args.rate,
+        "seconds": elapsed,
+        "packets_sent": len(sent),
+        "packets_per_s": stats["decoded"] / elapsed if stats["decoded"] else None,
+        "console_lines_sent": generator.lines,
+        "decoder": stats,
+        "clients": per_client,
+    })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Export throughput from a capture file (export.py), per format.
+
+A synthetic capture of ``--seconds`` at ``--rate`` samples/s is written first
+(packet records of 5 ms, a console line per second), or ``--capture`` is used
+as is. Every format is then exported to nowhere and timed; one JSON object per
+format is printed. An hour at 8 kHz is ~720 MB of capture.
+
+    python bench/bench_export.py --seconds 3600 --rate 8000 --formats npz,parquet
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from array import array
+
+from common import SyntheticDevice, emit
+from capture import CaptureReader, CaptureWriter
+from export import CaptureSource, export, pa
+from protocol import PACKET_SIZE
+
+RECORD_MS = 5
+
+
+def write_capture(path, seconds, rate, seed):
+    # One second of device output is tiled with fresh timestamps, so building an
+    # hour does not take longer than exporting it
+    device = SyntheticDevice(seed)
+    base = bytearray(device.packets(rate))
+    per_record = max(rate * RECORD_MS // 1000, 1)
+    writer = CaptureWriter(path, PACKET_SIZE)
+    for second in range(seconds):
+        stamps = array("I", range(second * rate, (second + 1) * rate))
+        if sys.byteorder != "little":
+            stamps.byteswap()
+        raw = memoryview(stamps).cast("B")
+        for b in range(4):
+            base[b::PACKET_SIZE] = raw[b::4]
+        view = memoryview(base)
+        for i in range(0, rate, per_record):
+            writer.write_packets(view[i * PACKET_SIZE:(i + per_record) * PACKET_SIZE],
+                                 now=writer.start + second + i / rate)
+        writer.write_console(device.log_line().decode().rstrip("\n"), now=writer.start + second + 0.5)
+    writer.close()
+
+
+def run(path, fmt, table):
+    start = time.perf_counter()
+    source = CaptureSource(path)
+    samples = source.count
+    size = 0
+    for chunk in export(source, fmt, table):
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    return {
+        "bench": "export",
+        "format": fmt,
+        "table": table,
+        "samples": samples,
+        "bytes": size,
+        "seconds": elapsed,
+        "samples_per_s": samples / elapsed if elapsed else None,
+        "mb_per_s": size / elapsed / 1e6 if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=int, default=300)
+    parser.add_argument("--rate", type=int, default=8000)
+    parser.add_argument("--formats", default="csv,npz,parquet")
+    parser.add_argument("--capture", help="export this capture instead of a synthetic one")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.capture
+        if not path:
+            path = os.path.join(tmp, "bench.rwscap")
+            started = time.perf_counter()
+            write_capture(path, args.seconds, args.rate, args.seed)
+            emit({"bench": "export", "capture_bytes": os.path.getsize(path),
+                  "capture_seconds": CaptureReader(path).duration, "write_seconds": time.perf_counter() - started})
+        for fmt in args.formats.split(","):
+            if fmt == "parquet" and pa is None:
+                emit({"bench": "export", "format": fmt, "skipped": "pyarrow not installed"})
+                continue
+            emit(run(path, fmt, "samples"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import json
+import os
+import random
+import sys
+import time
+from array import array
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIMULATOR_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "cli-simulator")
+for path in (BACKEND_DIR, SIMULATOR_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from protocol import PACKET_SIZE  # noqa: E402
+from simulator import COLORS, LOG_MESSAGES, DeviceModel  # noqa: E402
+
+
+class SyntheticDevice:
+    """Packets of the simulator's DeviceModel (PID plant + IMU angles) and its log lines.
+
+    The timestamp field carries a running sequence number instead of milliseconds so
+    every packet can be matched on the receiving side.
+    """
+
+    RATE = 1000
+    PREFETCH = 256  # packets generated per model call, so sample() stays cheap
+
+    def __init__(self, seed=1, kp=1.0, ki=0.5, kd=0.1):
+        self.model = DeviceModel(rate=self.RATE, seed=seed)
+        self.model.pid.update(kp=kp, ki=ki, kd=kd)
+        self.rng = random.Random(seed)
+        self.seq = 0  # packets handed out
+        self._pending = bytearray()
+
+    def _generate(self, n):
+        first = self.seq + len(self._pending) // PACKET_SIZE
+        buf = bytearray(self.model.generate(n))
+        seqs = array("I", (i & 0xFFFFFFFF for i in range(first, first + n)))
+        if sys.byteorder != "little":
+            seqs.byteswap()
+        raw = memoryview(seqs).cast("B")
+        for b in range(4):
+            buf[b::PACKET_SIZE] = raw[b::4]
+        self._pending += buf
+
+    def packets(self, n):
+        size = n * PACKET_SIZE
+        if len(self._pending) < size:
+            self._generate(max(n - len(self._pending) // PACKET_SIZE, self.PREFETCH))
+        out = bytes(self._pending[:size])
+        del self._pending[:size]
+        self.seq += n
+        return out
+
+    def sample(self):
+        return self.packets(1)
+
+    def log_line(self):
+        level, msg = self.rng.choice(LOG_MESSAGES)
+        return f"{COLORS[level]}[{level}] {msg}{COLORS['RESET']}\n".encode()
+
+
+def percentiles(values, qs=(0.5, 0.9, 0.99)):
+    values = sorted(values)
+    out = {f"p{int(q * 100)}": values[min(int(q * len(values)), len(values) - 1)] if values else None for q in qs}
+    out["max"] = values[-1] if values else None
+    return out
+
+
+def emit(result):
+    result.setdefault("python", sys.version.split()[0])
+    result.setdefault("time", time.time())
+    print(json.dumps(result))
+    sys.stdout.flush()
@@ -0,0 +1,87 @@
+"""Byte-arrival-to-publish latency of SerialService against a pty stand-in device.
+
+Writes bursts of packets into the master side of a pseudo-terminal, lets
+SerialService read the slave side and timestamps every sample when the reader
+publishes it. Prints one JSON object per reader mode.
+
+    python bench/reader_latency.py --modes poll,blocking --packets 20000 --rate 2000
+
+POSIX only (needs os.openpty).
+"""
+import argparse
+import os
+import random
+import time
+
+from common import emit, percentiles
+from protocol import PACKET_STRUCT
+from start_backend import SerialService
+
+
+class LatencyProbe:
+    """Stands in for TelemetryHub and records when each sample was published."""
+
+    def __init__(self):
+        self.received = {}
+
+    def publish_samples(self, rows):
+        now = time.perf_counter()
+        for row in rows:
+            self.received[row[0]] = now
+
+    def publish(self, item):
+        pass
+
+
+def run(mode, packets, rate, burst, seed):
+    rng = random.Random(seed)
+    master, slave = os.openpty()
+    probe = LatencyProbe()
+    service = SerialService(probe, ring_capacity=packets, reader_mode=mode)
+    service.connect(os.ttyname(slave))
+    time.sleep(0.2)
+
+    sent = {}
+    next_time = time.perf_counter()
+    for seq in range(0, packets, burst):
+        n = min(burst, packets - seq)
+        payload = b"".join(PACKET_STRUCT.pack(seq + i, 1.0, 2.0, 3.0, 4.0, 5.0, 10) for i in range(n))
+        # Jitter the burst spacing so writes do not phase-lock with the poll interval
+        next_time += rng.uniform(0.5, 1.5) * n / rate
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.perf_counter()
+        os.write(master, payload)
+        for i in range(n):
+            sent[seq + i] = now
+
+    time.sleep(0.3)
+    service.disconnect()
+    os.close(master)
+    os.close(slave)
+
+    latencies = [(probe.received[k] - t) * 1000.0 for k, t in sent.items() if k in probe.received]
+    return {
+        "bench": "reader_latency",
+        "mode": mode,
+        "packets": packets,
+        "received": len(latencies),
+        "latency_ms": percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="poll,blocking")
+    parser.add_argument("--packets", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=2000.0, help="packets per second")
+    parser.add_argument("--burst", type=int, default=4, help="packets per write")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for mode in args.modes.split(","):
+        emit(run(mode, args.packets, args.rate, args.burst, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from contextlib import closing
+import threading
+import time
+
+# Capture file layout (little-endian, append-only):
+#
+#   header   8s magic "RWSCAP01", uint16 version, uint16 packet size, float64 wall-clock start
+#   records  uint8 type, float64 host receive time (seconds since start), uint32 length, payload
+#   trailer  uint64 offset of the last index record, 8s magic "RWSCAPND" (only after a clean stop)
+#
+# REC_PACKETS payloads are the raw bytes of decoded packet runs exactly as they came
+# off the wire; REC_CONSOLE payloads are UTF-8 console lines. Every INDEX_INTERVAL
+# seconds an REC_INDEX record is written that points at the first record of the span
+# it closes and at the previous index record, so a reader can walk the chain back
+# from the trailer and seek by time without scanning the file.
+MAGIC = b"RWSCAP01"
+TRAILER_MAGIC = b"RWSCAPND"
+VERSION = 1
+HEADER_STRUCT = struct.Struct("<8sHHd")
+RECORD_STRUCT = struct.Struct("<BdI")
+INDEX_STRUCT = struct.Struct("<dQQ")  # span start time, span start offset, previous index offset
+TRAILER_STRUCT = struct.Struct("<Q8s")
+
+REC_PACKETS = 1
+REC_CONSOLE = 2
+REC_INDEX = 3
+
+NO_INDEX = 0xFFFFFFFFFFFFFFFF
+INDEX_INTERVAL = 1.0
+WRITE_BUFFER_SIZE = 1 << 20
+
+CAPTURE_EXT = ".rwscap"
+REPLAY_PREFIX = "replay:"
+
+
+class CaptureWriter:
+    """Appends packet runs and console lines to a capture file.
+
+    Writes go through a large BufferedWriter so the reader thread only pays for a
+    memcpy per chunk; the OS sees a few bulk writes per second.
+    """
+
+    def __init__(self, path, packet_size):
+        self.path = path
+        self.f = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self.start_wall = time.time()
+        self.start = time.monotonic()
+        self.f.write(HEADER_STRUCT.pack(MAGIC, VERSION, packet_size, self.start_wall))
+        self.offset = HEADER_STRUCT.size
+        self.span_start_time = 0.0
+        self.span_start_offset = self.offset
+        self.last_index = NO_INDEX
+        self.records = 0
+        self.end = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _write_record(self, rec_type, t, payload):
+        header = RECORD_STRUCT.pack(rec_type, t, len(payload))
+        self.f.write(header)
+        self.f.write(payload)
+        self.offset += len(header) + len(payload)
+        self.records += 1
+
+    def _maybe_index(self, t):
+        if t - self.span_start_time < INDEX_INTERVAL:
+            return
+        index_offset = self.offset
+        self._write_record(REC_INDEX, t, INDEX_STRUCT.pack(self.span_start_time, self.span_start_offset, self.last_index))
+        self.last_index = index_offset
+        self.span_start_time = t
+        self.span_start_offset = self.offset
+
+    def write_packets(self, raw, now=None):
+        t = (time.monotonic() if now is None else now) - self.start
+        with self._lock:
+            if self.closed:
+                return
+            self._maybe_index(t)
+            self._write_record(REC_PACKETS, t, raw)
+
+    def write_console(self, text, now=None):
+        t = (time.monotonic() if now is None else now) - self.start
+        with self._lock:
+            if self.closed:
+                return
+            self._maybe_index(t)
+            self._write_record(REC_CONSOLE, t, text.encode(errors="replace"))
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.end = time.monotonic()
+            t = self.end - self.start
+            index_offset = self.offset
+            self._write_record(REC_INDEX, t, INDEX_STRUCT.pack(self.span_start_time, self.span_start_offset, self.last_index))
+            self.f.write(TRAILER_STRUCT.pack(index_offset, TRAILER_MAGIC))
+            self.offset += TRAILER_STRUCT.size
+            self.f.close()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "file": os.path.basename(self.path),
+            "records": self.records,
+            "bytes": self.offset,
+            "duration": (self.end or time.monotonic()) - self.start,
+        }
+
+
+class CaptureReader:
+    """Random access to a capture file through a read-only memory map.
+
+    Only the index chain is parsed up front, so opening a multi-hour capture and
+    seeking into the middle of it costs a few thousand small reads, not a full scan.
+    Files without a trailer (recording interrupted) fall back to a header-only scan.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_STRUCT.size:
+            self.close()
+            raise ValueError("not a capture file")
+        magic, self.version, self.packet_size, self.start_wall = HEADER_STRUCT.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("not a capture file")
+        self.end = len(self.mm)
+        self.duration = 0.0
+        self.index = self._load_index()
+        self.index_times = [t for t, _ in self.index]
+
+    def _load_index(self):
+        size = len(self.mm)
+        if size >= HEADER_STRUCT.size + TRAILER_STRUCT.size:
+            last_index, magic = TRAILER_STRUCT.unpack_from(self.mm, size - TRAILER_STRUCT.size)
+            if magic == TRAILER_MAGIC:
+                self.end = size - TRAILER_STRUCT.size
+                spans = []
+                offset = last_index
+                while offset != NO_INDEX:
+                    rec_type, t, length = RECORD_STRUCT.unpack_from(self.mm, offset)
+                    span_time, span_offset, offset = INDEX_STRUCT.unpack_from(self.mm, offset + RECORD_STRUCT.size)
+                    spans.append((span_time, span_offset))
+                    self.duration = max(self.duration, t)
+                spans.reverse()
+                return spans
+        return self._scan_index()
+
+    def _scan_index(self):
+        spans = [(0.0, HEADER_STRUCT.size)]
+        offset = HEADER_STRUCT.size
+        t = 0.0
+        while offset + RECORD_STRUCT.size <= len(self.mm):
+            rec_type, t_rec, length = RECORD_STRUCT.unpack_from(self.mm, offset)
+            if offset + RECORD_STRUCT.size + length > len(self.mm):
+                break  # torn final record
+            t = t_rec
+            if t - spans[-1][0] >= INDEX_INTERVAL:
+                spans.append((t, offset))
+            offset += RECORD_STRUCT.size + length
+        self.end = offset
+        self.duration = t
+        return spans
+
+    def offset_for(self, t):
+        """File offset of the first record received at or after ``t`` seconds."""
+        i = max(bisect_right(self.index_times, t) - 1, 0)
+        with closing(self.records(self.index[i][1])) as records:
+            for rec_type, t_rec, payload, offset in records:
+                if t_rec >= t:
+                    return offset
+        return self.end
+
+    def records(self, offset=HEADER_STRUCT.size):
+        """Yield ``(type, time, payload, offset)``; payload is a memoryview into the map.
+
+        A payload is only valid until the next record is requested: it is released
+        then, and the generator's own view when it finishes or is closed, so the map
+        can be closed as soon as every ``records()`` generator has been.
+        """
+        mm = self.mm
+        view = memoryview(mm)
+        end = self.end
+        try:
+            while offset + RECORD_STRUCT.size <= end:
+                rec_type, t, length = RECORD_STRUCT.unpack_from(mm, offset)
+                start = offset + RECORD_STRUCT.size
+                if start + length > end:
+                    break
+                payload = view[start:start + length]
+                try:
+                    yield rec_type, t, payload, offset
+                finally:
+                    payload.release()
+                offset = start + length
+        finally:
+            view.release()
+
+    def info(self):
+        return {
+            "file": os.path.basename(self.path),
+            "packet_size": self.packet_size,
+            "started": self.start_wall,
+            "duration": self.duration,
+            "bytes": len(self.mm),
+        }
+
+    def close(self):
+        # BufferError here means a records() generator was left open
+        try:
+            self.mm.close()
+        finally:
+            self._file.close()
+
+
+class ReplayPort:
+    """Serial-port stand-in that plays a capture back in (scaled) real time.
+
+    It implements the subset of ``serial.Serial`` that SerialService uses, so replayed
+    bytes go through exactly the same decode / broadcast path as a live board.
+    ``speed`` is a time multiplier; 0 means as fast as the reader can consume.
+    """
+
+    def __init__(self, path, speed=1.0, start=0.0, timeout=0.05):
+        self.reader = CaptureReader(path)
+        self.speed = max(float(speed), 0.0)
+        self.timeout = timeout
+        self.is_open = True
+        self._lock = threading.Lock()
+        self._pending = bytearray()
+        self._records = None
+        self.seek(start)
+
+    def seek(self, t):
+        with self._lock:
+            self._close_records()
+            self._records = self.reader.records(self.reader.offset_for(max(float(t), 0.0)))
+            self._next = next(self._records, None)
+            self._pending.clear()
+            self.position = self._next[1] if self._next else self.reader.duration
+            # Wall-clock instant that corresponds to capture time ``position``
+            self._origin = time.monotonic()
+            self._origin_t = self.position
+
+    def _due(self):
+        if self.speed == 0:
+            return float("inf")
+        return self._origin_t + (time.monotonic() - self._origin) * self.speed
+
+    def _fill(self, limit):
+        # Move every record that is due into the pending buffer
+        due = self._due()
+        pending = self._pending
+        while self._next is not None and self._next[1] <= due and len(pending) < limit:
+            rec_type, t, payload, _ = self._next
+            if rec_type == REC_PACKETS:
+                pending += payload
+            elif rec_type == REC_CONSOLE:
+                pending += payload
+                pending += b"\n"
+            self.position = t
+            self._next = next(self._records, None)
+
+    @property
+    def in_waiting(self):
+        # Bytes read() has already taken from the capture; only read() advances the
+        # replay, so status polling (/api/metrics) does not move playback
+        with self._lock:
+            return len(self._pending)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        while True:
+            with self._lock:
+                self._fill(max(size, 1 << 16))
+                if self._pending:
+                    data = bytes(self._pending[:size])
+                    del self._pending[:size]
+                    return data
+                if self._next is None:
+                    self.is_open = False
+                    return b""
+                wait = (self._next[1] - self._due()) / self.speed
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return b""
+            time.sleep(min(wait, remaining))
+
+    def write(self, data):
+        # Commands have nowhere to go during a replay
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def status(self):
+        return dict(self.reader.info(), position=self.position, speed=self.speed)
+
+    def _close_records(self):
+        if self._records is not None:
+            self._records.close()
+        self._records = None
+        self._next = None
+
+    def close(self):
+        self.is_open = False
+        with self._lock:
+            # Release the record views before unmapping
+            self._close_records()
+        self.reader.close()
+
+
+def list_captures(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(n for n in names if n.endswith(CAPTURE_EXT))
+
+
+def new_capture_path(directory):
+    os.makedirs(directory, exist_ok=True)
+    name = time.strftime("capture-%Y%m%d-%H%M%S") + CAPTURE_EXT
+    return os.path.join(directory, name)
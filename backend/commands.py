@@ -0,0 +1,156 @@
+import re
+import threading
+import time
+
+from step_metrics import ANSI_RE
+
+# Default and maximum time to wait for the replies of one batch (seconds)
+COMMAND_TIMEOUT = 1.0
+MAX_COMMAND_TIMEOUT = 10.0
+MAX_BATCH_COMMANDS = 64
+# Wait this long after the last reply of a batch when it can span several lines
+MULTILINE_SETTLE = 0.05
+
+_NUM = r"(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|-?nan|-?inf)"
+
+
+def _values(*names):
+    def parse(m):
+        return {name: float(v) for name, v in zip(names, m.groups())}
+    return parse
+
+
+def _set_value(prefix):
+    def parse(m):
+        return {prefix + m.group(1).lower(): float(m.group(2))}
+    return parse
+
+
+# (command pattern, first reply line pattern, parser) in firmware CLI order; the
+# reply formats are the ones the firmware prints (mirrored in cli-simulator)
+REPLY_RULES = [(re.compile(cmd, re.IGNORECASE), re.compile(reply), parse) for cmd, reply, parse in (
+    (r"^pid\s+set\s+[pid]\s+\S+", r"^PID k([PID]) set to " + _NUM + r"\s*$", _set_value("k")),
+    (r"^pid\s+get\s+[pid]$", r"^\s*" + _NUM + r"\s*$", _values("value")),
+    (r"^pid\s+show$", r"^P:\s*" + _NUM + r",\s*I:\s*" + _NUM + r",\s*D:\s*" + _NUM + r"\s*$",
+     _values("kp", "ki", "kd")),
+    (r"^pid\s+stream\s+\S+$", r"^PID streaming (ON|OFF)\s*$", lambda m: {"streaming": m.group(1) == "ON"}),
+    (r"^imu\s+offset\s+set\s+\S+\s+\S+", r"^IMU offset ([XYZ]) set to " + _NUM + r"\s*$", _set_value("")),
+    (r"^imu\s+offset\s+show$", r"^X:\s*" + _NUM + r",\s*Y:\s*" + _NUM + r",\s*Z:\s*" + _NUM + r"\s*$",
+     _values("x", "y", "z")),
+    (r"^imu\s+calib$", r"^Starting gyro calibration", None),
+    (r"^imu\s+level$", r"^Starting level calibration wizard", None),
+    (r"^imu\s+mahony\s+[pi]\s+\S+", r"^Mahony k([PI]) set to " + _NUM + r"\s*$", _set_value("k")),
+    (r"^imu\s+(mahony\s+)?show$", r"^P:\s*" + _NUM + r",\s*I:\s*" + _NUM + r"\s*$", _values("kp", "ki")),
+    (r"^(help|\?)$", r"^CMD: pid >", None),
+    (r"^status$", r"^System Status:", None),
+    (r"^pid\b", r"^CMD: pid >", None),
+    (r"^imu\b", r"^CMD: imu >", None),
+)]
+# Replies that continue on indented lines: first line pattern -> continuation pattern
+# (help prints one ``CMD:`` block per command group)
+_HELP_CONTINUATION = re.compile(r"^(\s|CMD: \w+ >)")
+MULTILINE_REPLIES = {
+    r"^CMD: pid >": _HELP_CONTINUATION,
+    r"^CMD: imu >": _HELP_CONTINUATION,
+    r"^System Status:": re.compile(r"^\s"),
+}
+ERROR_REPLY_RE = re.compile(r"^(ERR:|Unknown command:)")
+# Unsolicited firmware log lines are never a reply
+LOG_LINE_RE = re.compile(r"^\[(INFO|WARN|ERROR)\] ")
+
+
+def expected_reply(cmd):
+    """``(reply pattern, parser)`` for a CLI command, or ``(None, None)`` if the reply format is unknown."""
+    cmd = " ".join(cmd.split())
+    for cmd_re, reply_re, parse in REPLY_RULES:
+        if cmd_re.match(cmd):
+            return reply_re, parse
+    return None, None
+
+
+def _continuation(reply_re):
+    return None if reply_re is None else MULTILINE_REPLIES.get(reply_re.pattern)
+
+
+class CommandBatch:
+    """Matches console lines to the replies of a batch of CLI commands.
+
+    The firmware answers commands in order, so each console line is offered to
+    the oldest command still waiting: its expected reply, an ``ERR:`` or
+    ``Unknown command`` line, or (for a command with no known format) any line
+    that is not a log message. A line that instead fits a later command's reply
+    means the earlier replies were lost; those are marked unanswered. Indented
+    lines right after a reply (help, status) are kept as part of it.
+    """
+
+    def __init__(self, commands):
+        self.results = []
+        self.expected = []
+        self.next = 0
+        self.last = None
+        self.continuation = None
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        for cmd in commands:
+            self.add(cmd)
+        if not commands:
+            self.done.set()
+
+    def add(self, cmd):
+        """Expect the reply of one more command, written after the others."""
+        self.results.append({"cmd": cmd, "ok": False, "status": "timeout", "reply": None, "lines": []})
+        self.expected.append(expected_reply(cmd))
+        self.done.clear()
+
+    def _accepts(self, index, line):
+        reply_re, _ = self.expected[index]
+        if reply_re is None:
+            return None if LOG_LINE_RE.match(line) else True
+        return reply_re.match(line)
+
+    def _finish(self, index, line, match):
+        result = self.results[index]
+        result["reply"] = line
+        result["lines"].append(line)
+        result["elapsed"] = time.monotonic() - self.started
+        if ERROR_REPLY_RE.match(line):
+            result["status"] = "error"
+        else:
+            result["status"] = "ok"
+            result["ok"] = True
+            parse = self.expected[index][1]
+            if parse and match is not True:
+                try:
+                    result["values"] = parse(match)
+                except ValueError:
+                    pass
+        self.last = result
+        self.continuation = _continuation(self.expected[index][0]) if result["ok"] else None
+
+    def on_line(self, text):
+        """Offer one console line (reader thread). Returns True if it was taken as a reply."""
+        line = ANSI_RE.sub("", text).rstrip("\r")
+        if self.continuation and self.continuation.match(line):
+            self.last["lines"].append(line)
+            return True
+        if self.done.is_set() or not line.strip():
+            return False
+        error = ERROR_REPLY_RE.match(line)
+        for index in range(self.next, len(self.results)):
+            match = error if error and index == self.next else self._accepts(index, line)
+            if match:
+                for skipped in range(self.next, index):
+                    self.results[skipped]["status"] = "no_reply"
+                self._finish(index, line, match)
+                self.next = index + 1
+                if self.next == len(self.results):
+                    self.done.set()
+                return True
+        return False
+
+    def wait(self, timeout):
+        self.done.wait(timeout)
+        if self.continuation and self.done.is_set():
+            # Let the continuation lines of a final multi-line reply arrive
+            time.sleep(MULTILINE_SETTLE)
+        return self.results
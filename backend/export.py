@@ -0,0 +1,259 @@
+"""Streaming export of telemetry to CSV, NumPy .npz or Parquet.
+
+Two sources: the device's sample ring (``from`` / ``to`` are device timestamps
+in ms, like /api/history) or a capture file (``from`` / ``to`` are seconds
+since the recording started, like /api/replay/seek). Samples are read and
+written CHUNK_SAMPLES at a time, so memory use does not depend on the range.
+Console lines are a second table, stamped with the device timestamp of the
+newest sample when they arrived.
+
+  csv      one table per request (``table=samples`` or ``console``)
+  npz      one .npy member per column plus console_timestamp / console_text,
+           uncompressed like ``np.savez``; written by hand, NumPy is only
+           needed to read it
+  parquet  one table per request, needs pyarrow
+
+Capture packets are turned into columns with strided slice copies (every
+packet is 24 bytes of fields and a terminator), so an hour of 8 kHz samples
+exports in seconds as npz or parquet. CSV is bound by float formatting.
+"""
+import csv
+import io
+import struct
+import sys
+import zipfile
+from array import array
+from contextlib import closing
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from capture import REC_CONSOLE, REC_PACKETS, CaptureReader
+from protocol import PACKET_SIZE
+from telemetry import SAMPLE_FIELDS, SampleRing
+
+FORMATS = ("csv", "npz", "parquet")
+TABLES = ("samples", "console")
+CHUNK_SAMPLES = 1 << 16
+CONTENT_TYPES = {"csv": "text/csv", "npz": "application/zip", "parquet": "application/vnd.apache.parquet"}
+
+CSV_ROW = "%d" + ",%.7g" * (len(SAMPLE_FIELDS) - 1) + "\n"
+# .npy type of each SAMPLE_FIELDS column
+NPY_DESCR = {"I": "<u4", "f": "<f4"}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+
+
+def _packet_columns(buf, fields):
+    # buf holds whole packets; byte b of field i of every packet is one strided slice
+    n = len(buf) // PACKET_SIZE
+    mv = memoryview(buf)
+    cols = []
+    for i in fields:
+        raw = bytearray(4 * n)
+        for b in range(4):
+            raw[b::4] = mv[4 * i + b:n * PACKET_SIZE:PACKET_SIZE]
+        col = array(SampleRing.TYPECODES[i])
+        col.frombytes(raw)
+        if sys.byteorder != "little":
+            col.byteswap()
+        cols.append(col)
+    mv.release()
+    return cols
+
+
+class RingSource:
+    """Samples in device time [t_from, t_to] still held by a SampleRing, and the recent console lines."""
+
+    def __init__(self, ring, console_log, t_from=None, t_to=None):
+        self.ring = ring
+        with ring.lock:
+            self.start = ring.oldest if t_from is None else ring.find(t_from)
+            self.stop = ring.head if t_to is None else ring.find(t_to + 1)
+        self.count = max(self.stop - self.start, 0)
+        lo = float("-inf") if t_from is None else t_from
+        hi = float("inf") if t_to is None else t_to
+        self._console = [(ts, text) for ts, text in list(console_log) if lo <= ts <= hi]
+
+    def chunks(self, fields=range(len(SAMPLE_FIELDS))):
+        for start in range(self.start, self.stop, CHUNK_SAMPLES):
+            stop = min(start + CHUNK_SAMPLES, self.stop)
+            cols, first, lost = self.ring.columns(start, stop)
+            if lost or first != start:
+                raise RuntimeError("the ring overwrote part of the range during the export; export a capture instead")
+            yield [cols[i] for i in fields]
+
+    def console(self):
+        return iter(self._console)
+
+    def close(self):
+        pass
+
+
+class CaptureSource:
+    """Samples and console lines of a capture file between ``t_from`` and ``t_to`` seconds."""
+
+    def __init__(self, path, t_from=None, t_to=None):
+        self.reader = CaptureReader(path)
+        self.offset = self.reader.offset_for(t_from or 0.0)
+        self.t_to = float("inf") if t_to is None else t_to
+        # Record headers only: the .npy members need their length up front
+        self.count = sum(len(payload) // PACKET_SIZE
+                         for rec_type, payload in self._records() if rec_type == REC_PACKETS)
+
+    def _records(self):
+        with closing(self.reader.records(self.offset)) as records:
+            for rec_type, t, payload, _ in records:
+                if t > self.t_to:
+                    return
+                yield rec_type, payload
+
+    def chunks(self, fields=range(len(SAMPLE_FIELDS))):
+        limit = CHUNK_SAMPLES * PACKET_SIZE
+        t_to = self.t_to
+        buf = bytearray()
+        # The hot loop of every export, so records() directly rather than _records()
+        with closing(self.reader.records(self.offset)) as records:
+            for rec_type, t, payload, _ in records:
+                if t > t_to:
+                    break
+                if rec_type == REC_PACKETS:
+                    buf += payload[:len(payload) - len(payload) % PACKET_SIZE]
+                    if len(buf) >= limit:
+                        yield _packet_columns(buf, fields)
+                        buf = bytearray()
+        if buf:
+            yield _packet_columns(buf, fields)
+
+    def console(self):
+        latest = 0
+        for rec_type, payload in self._records():
+            if rec_type == REC_PACKETS and len(payload) >= PACKET_SIZE:
+                latest = struct.unpack_from("<I", payload, len(payload) // PACKET_SIZE * PACKET_SIZE - PACKET_SIZE)[0]
+            elif rec_type == REC_CONSOLE:
+                yield latest, bytes(payload).decode(errors="replace")
+
+    def close(self):
+        self.reader.close()
+
+
+class _Sink:
+    """Write-only file object; the export generators hand out what was written after each chunk."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)  # arrays and memoryviews: len() would count items, not bytes
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _csv(source, table):
+    if table == "console":
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(("timestamp", "text"))
+        for i, row in enumerate(source.console()):
+            writer.writerow(row)
+            if i % 1000 == 999:
+                yield out.getvalue().encode()
+                out.seek(0)
+                out.truncate()
+        yield out.getvalue().encode()
+        return
+    yield (",".join(SAMPLE_FIELDS) + "\n").encode()
+    for cols in source.chunks():
+        yield "".join(map(CSV_ROW.__mod__, zip(*cols))).encode()
+
+
+def _npy_header(descr, count):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    # magic + version + length field + header + newline, padded to 64 bytes as numpy does
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def _npz(source):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        # One pass per column: a member has to be complete before the next one starts
+        for i, name in enumerate(SAMPLE_FIELDS):
+            with zf.open(name + ".npy", "w", force_zip64=True) as member:
+                member.write(_npy_header(NPY_DESCR[SampleRing.TYPECODES[i]], source.count))
+                written = 0
+                for (col,) in source.chunks((i,)):
+                    if sys.byteorder != "little":
+                        col.byteswap()
+                    member.write(col)
+                    written += len(col)
+                    yield sink.take()
+                if written != source.count:
+                    raise RuntimeError("source changed during the export")
+        lines = list(source.console())
+        width = max((len(text) for _, text in lines), default=1) or 1
+        with zf.open("console_timestamp.npy", "w") as member:
+            member.write(_npy_header("<u4", len(lines)))
+            member.write(struct.pack(f"<{len(lines)}I", *(ts for ts, _ in lines)))
+        with zf.open("console_text.npy", "w", force_zip64=True) as member:
+            member.write(_npy_header(f"<U{width}", len(lines)))
+            for _, text in lines:
+                member.write(text.encode("utf-32-le").ljust(4 * width, b"\0"))
+    yield sink.take()
+
+
+def _parquet(source, table):
+    _require_pyarrow()
+    sink = _Sink()
+    if table == "console":
+        lines = list(source.console())
+        data = pa.table({"timestamp": pa.array([ts for ts, _ in lines], pa.uint32()),
+                         "text": pa.array([text for _, text in lines], pa.string())})
+        pq.write_table(data, sink)
+        yield sink.take()
+        return
+    types = {"I": pa.uint32(), "f": pa.float32()}
+    schema = pa.schema([(name, types[tc]) for name, tc in zip(SAMPLE_FIELDS, SampleRing.TYPECODES)])
+    with pq.ParquetWriter(sink, schema) as writer:
+        for cols in source.chunks():
+            arrays = [pa.Array.from_buffers(field.type, len(col), [None, pa.py_buffer(col)])
+                      for field, col in zip(schema, cols)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def export(source, fmt, table="samples"):
+    """Generator of the export file's bytes; closes ``source`` when done."""
+    try:
+        if fmt == "npz":
+            yield from _npz(source)
+        elif fmt == "parquet":
+            yield from _parquet(source, table)
+        else:
+            yield from _csv(source, table)
+    finally:
+        source.close()
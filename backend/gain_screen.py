@@ -0,0 +1,220 @@
+"""Offline PID gain pre-screening against the simulator's plant model.
+
+Thousands of (kp, ki, kd) candidates are simulated at once: the loop runs over
+time steps and every operation is a NumPy array operation over all candidates,
+so the cost per candidate is a few array elements rather than a Python call.
+Step-response metrics are accumulated while simulating (no trajectories are
+kept), candidates are scored, and the best ones are returned.
+
+The plant and PID update are the simulator's ``pid_step`` (second-order plant,
+wn = 2 rad/s, zeta = 0.7, forward Euler at ``dt``), so a good candidate here
+behaves the same on ``cli-simulator``. Needs NumPy; the rest of the backend
+does not.
+"""
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from step_metrics import SETTLE_BAND
+
+PLANT_WN = 2.0
+PLANT_ZETA = 0.7
+
+# Simulator sample period (1 kHz) and a step long enough for slow candidates to settle
+DEFAULT_DT = 0.001
+DEFAULT_DURATION = 3.0
+DEFAULT_AMPLITUDE = 10.0
+DEFAULT_TOP = 10
+MAX_CANDIDATES = 200000
+# Candidates x time steps per request
+MAX_WORK = int(os.environ.get("RWS_GAIN_SCREEN_MAX_WORK", str(10 ** 9)))
+# A response this many times the step is treated as unstable
+DIVERGED = 1e3
+# score = IAE (s) + overshoot weight * overshoot (fraction) + settling weight * settling time (s)
+DEFAULT_WEIGHTS = {"overshoot": 1.0, "settling": 0.2}
+
+METRICS = ("rise_time", "overshoot", "settling_time", "steady_state_error", "iae")
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("gain screening needs NumPy (pip install numpy)")
+
+
+def _check_count(count):
+    if not 1 <= count <= MAX_CANDIDATES:
+        raise ValueError(f"use 1 to {MAX_CANDIDATES} candidates")
+
+
+def grid_candidates(kp, ki, kd):
+    """Every combination of the per-gain ``(low, high, count)`` ranges, as an (N, 3) array."""
+    _require_numpy()
+    _check_count(int(kp[2]) * int(ki[2]) * int(kd[2]))
+    axes = [np.linspace(lo, hi, int(n)) for lo, hi, n in (kp, ki, kd)]
+    return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def random_candidates(kp, ki, kd, count, seed=None):
+    """``count`` candidates drawn uniformly from the per-gain ``(low, high)`` ranges."""
+    _require_numpy()
+    _check_count(int(count))
+    rng = np.random.default_rng(seed)
+    low = np.array([kp[0], ki[0], kd[0]], dtype=float)
+    high = np.array([kp[1], ki[1], kd[1]], dtype=float)
+    return low + rng.random((int(count), 3)) * (high - low)
+
+
+def simulate_step(gains, amplitude=DEFAULT_AMPLITUDE, duration=DEFAULT_DURATION, dt=DEFAULT_DT):
+    """Step response metrics of every candidate in ``gains`` (N, 3) from rest to ``amplitude``.
+
+    Returns a dict of (N,) arrays. Times are in ms and overshoot in percent,
+    like ``step_metrics``; ``iae`` is the integral of |error| over the step
+    size (s). Metrics that were never reached are NaN; ``stable`` is False for
+    candidates that diverged.
+    """
+    _require_numpy()
+    gains = np.asarray(gains, dtype=float).reshape(-1, 3)
+    kp, ki, kd = gains[:, 0].copy(), gains[:, 1].copy(), gains[:, 2].copy()
+    n = len(gains)
+    steps = max(int(round(duration / dt)), 1)
+    sp = float(amplitude)
+    scale = abs(sp) or 1.0
+    band = SETTLE_BAND * scale
+    lo_level, hi_level = 0.1 * sp, 0.9 * sp
+    up = sp >= 0
+
+    p, v, integral, last_e = (np.zeros(n) for _ in range(4))
+    peak = np.zeros(n)
+    t10 = np.full(n, np.nan)
+    t90 = np.full(n, np.nan)
+    last_outside = np.full(n, -1.0)
+    abs_error = np.zeros(n)
+    # Steady-state error over the last 10 % of the step, as in step_metrics
+    tail_start = steps - max(steps // 10, 1)
+    tail_sum = np.zeros(n)
+    error = np.empty(n)
+    u = np.empty(n)
+    tmp = np.empty(n)
+    damping, stiffness = 2 * PLANT_ZETA * PLANT_WN, PLANT_WN ** 2
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        for k in range(steps):
+            t = k * dt
+            # pid_step: PID on the error, then the plant, in the same order
+            np.subtract(sp, p, out=error)
+            integral += error * dt
+            np.multiply(kp, error, out=u)
+            u += ki * integral
+            np.subtract(error, last_e, out=tmp)
+            tmp *= kd / dt
+            u += tmp
+            u -= damping * v
+            u -= stiffness * p
+            u *= dt
+            v += u
+            p += v * dt
+            last_e, error = error, last_e
+
+            # Metrics of the sample just produced
+            if up:
+                np.maximum(peak, p, out=peak)
+                t10[np.isnan(t10) & (p >= lo_level)] = t
+                t90[np.isnan(t90) & (p >= hi_level)] = t
+            else:
+                np.minimum(peak, p, out=peak)
+                t10[np.isnan(t10) & (p <= lo_level)] = t
+                t90[np.isnan(t90) & (p <= hi_level)] = t
+            np.subtract(sp, p, out=tmp)
+            np.abs(tmp, out=tmp)
+            abs_error += tmp
+            last_outside[tmp > band] = t
+            if k >= tail_start:
+                tail_sum += p
+
+        stable = np.isfinite(p) & (np.abs(p) < DIVERGED * scale) & np.isfinite(abs_error)
+        end = (steps - 1) * dt
+        settled = stable & (last_outside < end)
+        overshoot = np.maximum((peak - sp) / (sp if sp else 1.0) * 100.0, 0.0)
+        return {
+            "stable": stable,
+            "rise_time": np.where(stable, (t90 - t10) * 1000.0, np.nan),
+            "overshoot": np.where(stable, overshoot, np.nan),
+            "settling_time": np.where(settled, (last_outside + dt) * 1000.0, np.nan),
+            "steady_state_error": np.where(stable, sp - tail_sum / (steps - tail_start), np.nan),
+            "iae": np.where(stable, abs_error * dt / scale, np.nan),
+        }
+
+
+def score(metrics, duration=DEFAULT_DURATION, weights=None):
+    """Lower is better; unstable candidates score +inf and unsettled ones pay the full duration."""
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    settling = np.where(np.isnan(metrics["settling_time"]), duration * 1000.0, metrics["settling_time"])
+    total = (metrics["iae"] + weights["overshoot"] * metrics["overshoot"] / 100.0
+             + weights["settling"] * settling / 1000.0)
+    return np.where(metrics["stable"], total, np.inf)
+
+
+def _screen_chunk(args):
+    gains, amplitude, duration, dt, weights = args
+    metrics = simulate_step(gains, amplitude, duration, dt)
+    metrics["score"] = score(metrics, duration, weights)
+    return metrics
+
+
+def screen(gains, amplitude=DEFAULT_AMPLITUDE, duration=DEFAULT_DURATION, dt=DEFAULT_DT, top=DEFAULT_TOP,
+           weights=None, workers=0):
+    """Simulate and score ``gains`` (N, 3) and return the ``top`` candidates, best first.
+
+    ``workers`` > 1 splits the candidates across a process pool (worth it for
+    tens of thousands of candidates; each worker needs its own NumPy import).
+    """
+    _require_numpy()
+    gains = np.asarray(gains, dtype=float).reshape(-1, 3)
+    _check_count(len(gains))
+    if not (dt > 0 and duration > 0 and math.isfinite(amplitude) and amplitude != 0):
+        raise ValueError("duration and dt must be positive and the step non-zero")
+    if len(gains) * (duration / dt) > MAX_WORK:
+        raise ValueError(f"candidates x time steps must stay under {MAX_WORK}")
+    if not np.isfinite(gains).all():
+        raise ValueError("gains must be finite")
+    unknown = set(weights or {}) - set(DEFAULT_WEIGHTS)
+    if unknown:
+        raise ValueError(f"unknown weights: {', '.join(sorted(unknown))}")
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    started = time.perf_counter()
+    workers = max(min(int(workers), os.cpu_count() or 1, len(gains)), 1)
+    if workers > 1:
+        chunks = np.array_split(gains, workers)
+        with ProcessPoolExecutor(workers) as pool:
+            parts = list(pool.map(_screen_chunk, [(c, amplitude, duration, dt, weights) for c in chunks]))
+        metrics = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    else:
+        metrics = _screen_chunk((gains, amplitude, duration, dt, weights))
+    order = np.argsort(metrics["score"], kind="stable")[:max(int(top), 0)]
+
+    def value(x):
+        x = float(x)
+        return x if math.isfinite(x) else None
+
+    best = []
+    for i in order:
+        candidate = {"kp": float(gains[i, 0]), "ki": float(gains[i, 1]), "kd": float(gains[i, 2]),
+                     "score": value(metrics["score"][i]), "stable": bool(metrics["stable"][i])}
+        candidate.update({key: value(metrics[key][i]) for key in METRICS})
+        best.append(candidate)
+    return {
+        "candidates": len(gains),
+        "stable": int(metrics["stable"].sum()),
+        "elapsed": time.perf_counter() - started,
+        "workers": workers,
+        "plant": {"wn": PLANT_WN, "zeta": PLANT_ZETA, "dt": dt},
+        "step": {"amplitude": amplitude, "duration": duration},
+        "weights": weights,
+        "top": best,
+    }
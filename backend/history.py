@@ -0,0 +1,243 @@
+from array import array
+
+from telemetry import SampleRing
+
+FANOUT = 8
+
+
+def _take(arr, start, count):
+    # ``count`` consecutive ring slots starting at ``start`` (may wrap)
+    cap = len(arr)
+    i = start % cap
+    if i + count <= cap:
+        return arr[i:i + count]
+    return arr[i:] + arr[:i + count - cap]
+
+
+def _put(arr, start, values):
+    cap = len(arr)
+    i = start % cap
+    first = min(len(values), cap - i)
+    arr[i:i + first] = values[:first]
+    if first < len(values):
+        arr[:len(values) - first] = values[first:]
+
+
+class _Level:
+    """Ring of min/max buckets covering FANOUT**k raw samples each."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.t_first = array("I", bytes(4 * capacity))
+        self.t_last = array("I", bytes(4 * capacity))
+        fields = len(SampleRing.TYPECODES) - 1
+        self.lo = [array("f", bytes(4 * capacity)) for _ in range(fields)]
+        self.hi = [array("f", bytes(4 * capacity)) for _ in range(fields)]
+        # 1 when the bucket minimum occurred before its maximum
+        self.lo_first = [array("B", bytes(capacity)) for _ in range(fields)]
+        self.done = 0  # buckets completed so far (bucket index of the next one)
+
+    def store(self, start, t_first, t_last, lo, hi, lo_first):
+        _put(self.t_first, start, t_first)
+        _put(self.t_last, start, t_last)
+        for dst, src in zip(self.lo, lo):
+            _put(dst, start, src)
+        for dst, src in zip(self.hi, hi):
+            _put(dst, start, src)
+        for dst, src in zip(self.lo_first, lo_first):
+            _put(dst, start, src)
+        self.done = start + len(t_first)
+
+
+class HistoryPyramid:
+    """Multi-resolution min/max aggregates over a SampleRing.
+
+    Level k holds one bucket per FANOUT**k raw samples (timestamps of the first and
+    last sample, and per field min, max and which came first). Levels are extended
+    incrementally from the level below as samples arrive, so a range query picks the
+    finest level whose buckets fit in ``max_points`` and touches only the buckets it
+    returns. The partial buckets at either end of the range, and a tail the level
+    has not aggregated yet, are computed from the raw samples in the range.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.levels = []
+        size = FANOUT
+        while ring.capacity // size >= 16:
+            self.levels.append(_Level(ring.capacity // size + 2))
+            size *= FANOUT
+
+    def update(self):
+        """Close every bucket made complete by samples appended to the ring."""
+        for k, level in enumerate(self.levels, start=1):
+            # Only buckets whose inputs are all still held below can be built
+            if k == 1:
+                target = self.ring.head // FANOUT
+                start = max(level.done, -(-self.ring.oldest // FANOUT))
+            else:
+                below = self.levels[k - 2]
+                target = below.done // FANOUT
+                start = max(level.done, -(-(below.done - below.capacity) // FANOUT))
+            if target <= start:
+                level.done = max(level.done, target)
+                continue
+            if k == 1:
+                self._build_from_raw(level, start, target)
+            else:
+                self._build_from_level(level, self.levels[k - 2], start, target)
+
+    def _build_from_raw(self, level, start, stop):
+        cols, _, _ = self.ring.columns(start * FANOUT, stop * FANOUT)
+        n = stop - start
+        ts = cols[0]
+        t_first = array("I", ts[::FANOUT])
+        t_last = array("I", ts[FANOUT - 1::FANOUT])
+        lo, hi, lo_first = [], [], []
+        for col in cols[1:]:
+            col_lo, col_hi, col_first = array("f"), array("f"), array("B")
+            for b in range(n):
+                chunk = col[b * FANOUT:(b + 1) * FANOUT]
+                vmin, vmax = min(chunk), max(chunk)
+                col_lo.append(vmin)
+                col_hi.append(vmax)
+                col_first.append(chunk.index(vmin) <= chunk.index(vmax))
+            lo.append(col_lo)
+            hi.append(col_hi)
+            lo_first.append(col_first)
+        level.store(start, t_first, t_last, lo, hi, lo_first)
+
+    def _build_from_level(self, level, below, start, stop):
+        n = stop - start
+        count = n * FANOUT
+        first = start * FANOUT
+        t_first = array("I", _take(below.t_first, first, count)[::FANOUT])
+        t_last = array("I", _take(below.t_last, first, count)[FANOUT - 1::FANOUT])
+        lo, hi, lo_first = [], [], []
+        for f in range(len(below.lo)):
+            child_lo = _take(below.lo[f], first, count)
+            child_hi = _take(below.hi[f], first, count)
+            child_first = _take(below.lo_first[f], first, count)
+            col_lo, col_hi, col_first = array("f"), array("f"), array("B")
+            for b in range(n):
+                a = b * FANOUT
+                los = child_lo[a:a + FANOUT]
+                his = child_hi[a:a + FANOUT]
+                vmin, vmax = min(los), max(his)
+                i_lo, i_hi = los.index(vmin), his.index(vmax)
+                col_lo.append(vmin)
+                col_hi.append(vmax)
+                col_first.append(i_lo < i_hi or (i_lo == i_hi and child_first[a + i_lo]))
+            lo.append(col_lo)
+            hi.append(col_hi)
+            lo_first.append(col_first)
+        level.store(start, t_first, t_last, lo, hi, lo_first)
+
+    def query(self, t_from=None, t_to=None, max_points=2000):
+        """Rows covering device time [t_from, t_to], ``max_points`` rows at most.
+
+        Returns ``(rows, level)`` where level 0 means raw samples.
+        """
+        ring = self.ring
+        max_points = max(max_points, 2)
+        with ring.lock:
+            s0 = ring.oldest if t_from is None else ring.find(t_from)
+            s1 = ring.head if t_to is None else ring.find(t_to + 1)
+            n = s1 - s0
+            if n <= 0:
+                return [], 0
+            k, size = 0, 1
+            if n > max_points:
+                # Each bucket the range touches, partial ones included, contributes two rows
+                while k < len(self.levels) and 2 * (-(-s1 // size) - s0 // size) > max_points:
+                    k += 1
+                    size *= FANOUT
+            rows = []
+            self._collect(k, s0, s1, rows)
+        if len(rows) > max_points:
+            # Range too long even for the coarsest level
+            rows = self._merge(rows, max_points)
+        return rows, k
+
+    def _collect(self, k, s0, s1, out):
+        if k == 0:
+            out.extend(self.ring.read(s0, s1)[0])
+            return
+        level = self.levels[k - 1]
+        size = FANOUT ** k
+        # Buckets wholly inside [s0, s1) that this level has built and still holds;
+        # the partial buckets at either end, and a tail the level has not reached
+        # yet, are aggregated from the raw samples so nothing outside the range leaks in
+        b0 = max(-(-s0 // size), level.done - level.capacity + 1)
+        b1 = min(s1 // size, level.done)
+        if b0 >= b1:
+            self._raw_buckets(size, s0, s1, out)
+            return
+        self._raw_buckets(size, s0, b0 * size, out)
+        self._bucket_rows(level, b0, b1, out)
+        self._raw_buckets(size, b1 * size, s1, out)
+
+    def _raw_buckets(self, size, s0, s1, out):
+        # Min/max rows of the raw samples [s0, s1), cut at bucket boundaries of ``size``
+        if s0 >= s1:
+            return
+        cols, start, _ = self.ring.columns(s0, s1)
+        ts = cols[0]
+        if not ts:
+            return
+        cuts = [0, *range((start // size + 1) * size - start, len(ts), size), len(ts)]
+        for a, b in zip(cuts, cuts[1:]):
+            first, second = [ts[a]], [ts[b - 1]]
+            for col in cols[1:]:
+                chunk = col[a:b]
+                vmin, vmax = min(chunk), max(chunk)
+                if chunk.index(vmin) <= chunk.index(vmax):
+                    first.append(vmin)
+                    second.append(vmax)
+                else:
+                    first.append(vmax)
+                    second.append(vmin)
+            out.append(tuple(first))
+            if b - a > 1:
+                out.append(tuple(second))
+
+    @staticmethod
+    def _merge(rows, max_points):
+        """Min/max rows of consecutive groups of ``rows``, at most ``max_points`` of them."""
+        # Two rows per group
+        group = -(-len(rows) // (max_points // 2))
+        out = []
+        for g in range(0, len(rows), group):
+            chunk = rows[g:g + group]
+            first, second = [chunk[0][0]], [chunk[-1][0]]
+            for values in list(zip(*chunk))[1:]:
+                vmin, vmax = min(values), max(values)
+                if values.index(vmin) <= values.index(vmax):
+                    first.append(vmin)
+                    second.append(vmax)
+                else:
+                    first.append(vmax)
+                    second.append(vmin)
+            out.append(tuple(first))
+            out.append(tuple(second))
+        return out
+
+    @staticmethod
+    def _bucket_rows(level, b0, b1, out):
+        n = b1 - b0
+        t_first = _take(level.t_first, b0, n)
+        t_last = _take(level.t_last, b0, n)
+        lo = [_take(col, b0, n) for col in level.lo]
+        hi = [_take(col, b0, n) for col in level.hi]
+        lo_first = [_take(col, b0, n) for col in level.lo_first]
+        for b in range(n):
+            first, second = [t_first[b]], [t_last[b]]
+            for f in range(len(lo)):
+                if lo_first[f][b]:
+                    first.append(lo[f][b])
+                    second.append(hi[f][b])
+                else:
+                    first.append(hi[f][b])
+                    second.append(lo[f][b])
+            out.append(tuple(first))
+            out.append(tuple(second))
@@ -0,0 +1,157 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Histogram upper bounds (seconds) for the reader loop and the /ws side
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# Histogram upper bounds (bytes) for the size of each serial read
+SIZE_BUCKETS = (25, 100, 250, 1000, 2500, 10000, 25000, 65536)
+
+COUNTERS = (
+    ("serial_bytes_read", "Bytes read from the serial port"),
+    ("serial_reads", "Serial reads that returned data"),
+    ("packets_decoded", "Telemetry packets decoded"),
+    ("packets_rejected", "Packets dropped for non-finite values"),
+    ("console_lines", "Console lines decoded"),
+    ("console_lines_misframed", "Console lines with undecodable bytes (misframed packet data)"),
+    ("frames_decoded", "Protocol v2 frames with a valid CRC"),
+    ("frame_crc_errors", "Protocol v2 frames dropped for a bad CRC"),
+    ("resync_skipped_bytes", "Bytes skipped outside protocol v2 frames while resyncing"),
+    ("ws_frames_sent", "Frames sent to /ws clients (and events to /stream clients)"),
+    ("ws_bytes_sent", "Bytes sent to /ws and /stream clients"),
+)
+
+HISTOGRAMS = (
+    ("reader_wait_seconds", TIME_BUCKETS, "Time the reader spent waiting in a serial read"),
+    ("reader_process_seconds", TIME_BUCKETS, "Time to decode and publish one serial read"),
+    ("reader_read_bytes", SIZE_BUCKETS, "Bytes returned by one serial read"),
+    ("serialize_seconds", TIME_BUCKETS, "Time to encode one /ws sample batch"),
+    ("ws_send_seconds", TIME_BUCKETS, "Time to send one /ws frame (or /stream event)"),
+)
+
+
+class Histogram:
+    """Fixed-bucket histogram with Prometheus semantics (cumulative ``le`` buckets)."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def drain(self):
+        """``(counts, sum, count)`` observed since the last drain, for ``merge`` in another process."""
+        with self._lock:
+            drained = (self.counts, self.sum, self.count)
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.sum = 0.0
+            self.count = 0
+        return drained
+
+    def merge(self, counts, total, count):
+        with self._lock:
+            for i, n in enumerate(counts):
+                self.counts[i] += n
+            self.sum += total
+            self.count += count
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for n in counts[:-1]:
+            running += n
+            cumulative.append(running)
+        # The +Inf bucket is ``count``
+        return {"le": list(self.bounds), "buckets": cumulative, "sum": total, "count": count}
+
+
+class PipelineMetrics:
+    """Counters and histograms for the serial -> decoder -> hub -> /ws pipeline.
+
+    The hot paths update ``counters`` and ``histograms`` directly. Counters are
+    plain integers bumped under the GIL (a lost increment between racing /ws
+    threads is acceptable for monitoring); histograms take their own lock. ``snapshot()`` returns everything as JSON-ready data and
+    ``render_prometheus()`` turns a snapshot into the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {name: 0 for name, _ in COUNTERS}
+        self.histograms = {name: Histogram(bounds) for name, bounds, _ in HISTOGRAMS}
+
+    def snapshot(self, counters=None, gauges=None, clients=()):
+        """Everything as JSON-ready data; ``counters`` adds totals kept elsewhere (e.g. by the decoder)."""
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters, **(counters or {})),
+            "gauges": dict(gauges or {}),
+            "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            "clients": list(clients),
+        }
+
+
+def _fmt(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshots, prefix="rws_"):
+    """Prometheus text format for ``{device_id: snapshot}``; every series gets a ``device`` label."""
+    help_text = {name: text for name, text in COUNTERS}
+    help_text.update({name: text for name, _, text in HISTOGRAMS})
+    devices = [(f'device="{device}"', snap) for device, snap in snapshots.items()]
+    out = []
+
+    def header(name, kind, text=None):
+        if text:
+            out.append(f"# HELP {prefix}{name} {text}")
+        out.append(f"# TYPE {prefix}{name} {kind}")
+
+    def series(key):
+        return sorted({name for _, snap in devices for name in snap[key]})
+
+    header("uptime_seconds", "gauge", "Seconds since the backend started")
+    for label, snap in devices[:1]:
+        out.append(f"{prefix}uptime_seconds {_fmt(snap['uptime'])}")
+    for name in series("counters"):
+        header(f"{name}_total", "counter", help_text.get(name))
+        for label, snap in devices:
+            out.append(f"{prefix}{name}_total{{{label}}} {_fmt(snap['counters'][name])}")
+    for name in series("gauges"):
+        header(name, "gauge")
+        for label, snap in devices:
+            value = snap["gauges"].get(name)
+            if value is not None:
+                out.append(f"{prefix}{name}{{{label}}} {_fmt(value)}")
+    for name in series("histograms"):
+        header(name, "histogram", help_text.get(name))
+        for label, snap in devices:
+            h = snap["histograms"][name]
+            for bound, n in zip(h["le"], h["buckets"]):
+                out.append(f'{prefix}{name}_bucket{{{label},le="{_fmt(bound)}"}} {n}')
+            out.append(f'{prefix}{name}_bucket{{{label},le="+Inf"}} {h["count"]}')
+            out.append(f"{prefix}{name}_sum{{{label}}} {_fmt(h['sum'])}")
+            out.append(f"{prefix}{name}_count{{{label}}} {h['count']}")
+    # Per-client series, labelled by hub subscriber id
+    client_series = (
+        ("client_buffered_samples", "gauge", "buffered"),
+        ("client_buffer_high_water_samples", "gauge", "high_water"),
+        ("client_send_rate", "gauge", "send_rate"),
+        ("client_sent_samples_total", "counter", "sent"),
+        ("client_dropped_samples_total", "counter", "dropped"),
+        ("client_dropped_events_total", "counter", "dropped_events"),
+    )
+    for name, kind, key in client_series:
+        header(name, kind)
+        for label, snap in devices:
+            for client in snap["clients"]:
+                out.append(f'{prefix}{name}{{{label},client="{client["id"]}",policy="{client["policy"]}"}} '
+                           f'{_fmt(client[key])}')
+    return "\n".join(out) + "\n"
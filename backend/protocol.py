@@ -0,0 +1,373 @@
+import re
+import struct
+from binascii import crc_hqx
+from itertools import accumulate
+from math import isfinite
+
+# Binary packet layout (little-endian):
+# uint32 timestamp, float setpoint, float pitch, float error, float pitch_angle, float roll_angle, uint8 end ('\n')
+PACKET_SIZE = 25
+PACKET_STRUCT = struct.Struct("<IfffffB")
+PACKET_END = 0x0A
+
+# Protocol v2 frame (little-endian): sync 0xA5 0x5A, uint16 payload length, uint8 type,
+# payload, uint16 CRC-16/CCITT (binascii.crc_hqx, initial 0xFFFF) of length, type and payload.
+# A packets frame carries a run of v1 packets (terminators included), so captures and
+# the bulk decoder are shared with v1; a console frame carries text lines.
+FRAME_SYNC = b"\xa5\x5a"
+FRAME_HEADER = struct.Struct("<2sHB")
+FRAME_CRC = struct.Struct("<H")
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_CRC.size
+FRAME_PACKETS = 0x01
+FRAME_CONSOLE = 0x02
+FRAME_BLOCK = 0x03
+FRAME_TYPES = (FRAME_PACKETS, FRAME_CONSOLE, FRAME_BLOCK)
+MAX_FRAME_PAYLOAD = 2048
+CRC_INIT = 0xFFFF
+# "auto" decodes v1 until the first valid v2 frame, then stays on v2
+PROTOCOLS = ("auto", "v1", "v2")
+# Compact block frame payload, columns instead of packets:
+#   uint32 t0 (ms), uint8 channel mask, uint16 sample count,
+#   float32 scale per enabled channel (value = int16 * scale),
+#   uint8 timestamp delta (ms) per sample after the first,
+#   int16 column per enabled channel, in bit order.
+# 11 bytes per sample with every channel on, against 25 for a packet. Channels
+# that are off decode as 0.0, except error, which is then setpoint - pitch.
+# Bits 5-7 are for int16 channels the pipeline does not carry yet (gyro rates,
+# motor output); their columns are stepped over.
+BLOCK_HEADER = struct.Struct("<IBH")
+CHANNELS = ("setpoint", "pitch", "error", "pitch_angle", "roll_angle")
+ALL_CHANNELS = (1 << len(CHANNELS)) - 1
+MAX_BLOCK_DELTA = 0xFF
+INT16_MIN, INT16_MAX = -0x8000, 0x7FFF
+
+# v2: text outside frames (boot messages) longer than this without a newline is dropped
+MAX_UNFRAMED_LINE = 1024
+# Bytes that never appear in console text (tab, CR and ESC are allowed)
+_BINARY_RE = re.compile(rb"[\x00-\x08\x0b\x0c\x0e-\x1a\x1c-\x1f\x7f]")
+
+
+def _is_text(line):
+    if _BINARY_RE.search(line):
+        return False
+    try:
+        bytes(line).decode()
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def encode_frame(frame_type, payload):
+    header = FRAME_HEADER.pack(FRAME_SYNC, len(payload), frame_type)
+    crc = crc_hqx(payload, crc_hqx(header[2:], CRC_INIT))
+    return header + payload + FRAME_CRC.pack(crc)
+
+
+def encode_packets(rows):
+    """v1 packet bytes for decoded rows (captures store packets whatever the wire format was)."""
+    return b"".join(PACKET_STRUCT.pack(*row, PACKET_END) for row in rows)
+
+
+def encode_block(rows, mask=ALL_CHANNELS, scales=0.01):
+    """Compact block payload for rows whose timestamps step by 0..255 ms.
+
+    ``scales`` is one scale for every channel or a sequence indexed by channel.
+    Values are rounded to the nearest step and clamped to the int16 range.
+    """
+    enabled = [bit for bit in range(len(CHANNELS)) if mask >> bit & 1]
+    if not isinstance(scales, (list, tuple)):
+        scales = [scales] * len(CHANNELS)
+    ts = [row[0] for row in rows]
+    deltas = [b - a for a, b in zip(ts, ts[1:])]
+    if any(not 0 <= d <= MAX_BLOCK_DELTA for d in deltas):
+        raise ValueError("timestamp steps must be 0..255 ms within a block")
+    out = [BLOCK_HEADER.pack(ts[0], mask, len(rows)), struct.pack(f"<{len(enabled)}f", *(scales[b] for b in enabled)),
+           bytes(deltas)]
+    for bit in enabled:
+        inv = 1.0 / scales[bit]
+        col = [min(max(round(row[bit + 1] * inv), INT16_MIN), INT16_MAX) for row in rows]
+        out.append(struct.pack(f"<{len(col)}h", *col))
+    return b"".join(out)
+
+
+class PacketDecoder:
+    """Splits the serial byte stream into telemetry packets and console lines.
+
+    Aligned runs of packets are decoded in bulk: the terminator bytes of the whole
+    run are checked with one strided slice, the run is unpacked with ``iter_unpack``
+    over a memoryview and finiteness is checked once for the run. Anything that does
+    not look like a packet falls back to line parsing, exactly like the old per-packet
+    loop did. Packets with non-finite values are dropped.
+
+    With protocol v2 every packet run and console line comes in a CRC-checked frame.
+    A damaged frame costs only itself: the parser skips to the next sync word in
+    the same pass over the buffer (counted in ``crc_errors`` and ``skipped``). Bytes
+    outside frames are dropped, except clean text lines before the first frame.
+
+    ``on_packets(rows, raw)`` receives a list of ``(ts, setpoint, pitch, error,
+    pitch_angle, roll_angle)`` tuples and the raw v1 packet bytes they were decoded
+    from (a memoryview that is only valid during the call), or None for rows from
+    a compact block frame. ``on_line(text)`` receives
+    console lines in stream order. Lines carrying undecodable bytes are still passed
+    on but counted in ``misframed``.
+    """
+
+    def __init__(self, on_packets, on_line, protocol="auto"):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"protocol must be one of {', '.join(PROTOCOLS)}")
+        self.on_packets = on_packets
+        self.on_line = on_line
+        self.protocol = protocol
+        self.version = 2 if protocol == "v2" else 1
+        self.buf = bytearray()
+        self.packets = 0
+        self.rejected = 0
+        self.lines = 0
+        self.misframed = 0
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped = 0
+        self.in_packets = False
+
+    def feed(self, data):
+        buf = self.buf
+        buf.extend(data)
+        pos = 0
+        with memoryview(buf) as mv:
+            if self.version == 1:
+                end, found = len(buf), None
+                if self.protocol == "auto":
+                    found = self._find_frame(buf)
+                    if found:
+                        end = found[0]
+                with mv[:end] as head:
+                    pos = self._feed_v1(buf, head)
+                if found and found[1]:
+                    # First valid v2 frame: what v1 left before it is lost framing
+                    self.skipped += end - pos
+                    self.version = 2
+                    self.in_packets = False
+                    pos = end
+            if self.version == 2:
+                pos = self._feed_v2(buf, mv, pos)
+        # Compact once per chunk instead of once per packet
+        if pos:
+            del buf[:pos]
+
+    def _feed_v1(self, buf, mv):
+        end = len(mv)
+        pos = 0
+        while True:
+            run_start = pos
+            pos = self._decode_run(mv, pos)
+            if pos > run_start:
+                self.in_packets = True
+            if self.in_packets and end - pos < PACKET_SIZE:
+                # While packets are flowing (console lines in between included) a short
+                # tail is almost always the next packet cut by the read boundary; a 0x0A
+                # inside it must not be taken for the end of a console line. Wait for
+                # more bytes, or for the link to go quiet (flush_idle).
+                break
+            # Text line
+            nl_index = buf.find(b"\n", pos, end)
+            if nl_index == -1:
+                break
+            self._emit_line(mv[pos:nl_index])
+            pos = nl_index + 1
+        return pos
+
+    def _frame_end(self, buf, pos, known_only=False):
+        """End offset of a valid frame at ``pos``, None if it is not complete yet, False if invalid."""
+        if len(buf) - pos < FRAME_HEADER.size:
+            return None
+        _, length, frame_type = FRAME_HEADER.unpack_from(buf, pos)
+        if length > MAX_FRAME_PAYLOAD or (known_only and frame_type not in FRAME_TYPES):
+            return False
+        end = pos + FRAME_OVERHEAD + length
+        if end > len(buf):
+            return None
+        with memoryview(buf) as mv, mv[pos + 2:end - FRAME_CRC.size] as body:
+            crc = crc_hqx(body, CRC_INIT)
+        if crc != FRAME_CRC.unpack_from(buf, end - FRAME_CRC.size)[0]:
+            self.crc_errors += 1
+            return False
+        return end
+
+    def _find_frame(self, buf):
+        """(offset, complete) of the first plausible v2 frame in a v1 stream, or None."""
+        idx = buf.find(FRAME_SYNC)
+        while idx != -1:
+            crc_errors = self.crc_errors
+            end = self._frame_end(buf, idx, known_only=True)
+            # Sync words inside v1 packet data are expected; only real frames count
+            self.crc_errors = crc_errors
+            if end is None:
+                return idx, False
+            if end:
+                return idx, True
+            idx = buf.find(FRAME_SYNC, idx + 1)
+        return None
+
+    def _feed_v2(self, buf, mv, pos):
+        n = len(buf)
+        while pos < n:
+            idx = buf.find(FRAME_SYNC, pos)
+            if idx == -1:
+                # A trailing 0xA5 may be the first half of the next sync word
+                stop = n - 1 if buf[-1] == FRAME_SYNC[0] else n
+                return self._unframed(buf, mv, pos, stop, False)
+            if idx > pos:
+                pos = self._unframed(buf, mv, pos, idx, True)
+            end = self._frame_end(buf, idx)
+            if end is None:
+                break
+            if end is False:
+                # Not a frame after all (or a damaged one): resync at the next sync word
+                self.skipped += len(FRAME_SYNC)
+                pos = idx + len(FRAME_SYNC)
+                continue
+            self._dispatch_frame(mv, idx, end)
+            pos = end
+        return pos
+
+    def _dispatch_frame(self, mv, start, end):
+        self.frames += 1
+        frame_type = mv[start + 4]
+        with mv[start + FRAME_HEADER.size:end - FRAME_CRC.size] as payload:
+            if frame_type == FRAME_PACKETS:
+                used = self._decode_run(payload, 0)
+                if used < len(payload):
+                    # Valid CRC but not whole packets: a firmware bug, not a transmission error
+                    self.rejected += -(-(len(payload) - used) // PACKET_SIZE)
+            elif frame_type == FRAME_CONSOLE:
+                for line in bytes(payload).split(b"\n"):
+                    self._emit_line(line)
+            elif frame_type == FRAME_BLOCK:
+                rows = self._decode_block(payload)
+                if rows:
+                    self.packets += len(rows)
+                    self.on_packets(rows, None)
+            # Other types are reserved for future firmware and skipped
+
+    def _decode_block(self, payload):
+        # Column by column: one struct call per column, scaling with map(), rows from zip()
+        if len(payload) < BLOCK_HEADER.size:
+            self.rejected += 1
+            return None
+        t0, mask, n = BLOCK_HEADER.unpack_from(payload)
+        bits = [bit for bit in range(8) if mask >> bit & 1]
+        pos = BLOCK_HEADER.size
+        if not n or len(payload) != pos + 4 * len(bits) + (n - 1) + 2 * n * len(bits):
+            self.rejected += max(n, 1)
+            return None
+        scales = struct.unpack_from(f"<{len(bits)}f", payload, pos)
+        if not all(isfinite(scale) for scale in scales):
+            self.rejected += n
+            return None
+        pos += 4 * len(bits)
+        ts = list(accumulate(payload[pos:pos + n - 1], initial=t0))
+        if ts[-1] > 0xFFFFFFFF:
+            ts = [t & 0xFFFFFFFF for t in ts]
+        pos += n - 1
+        columns = {}
+        column_format = struct.Struct(f"<{n}h")
+        for bit, scale in zip(bits, scales):
+            if bit < len(CHANNELS):
+                columns[bit] = list(map(scale.__mul__, column_format.unpack_from(payload, pos)))
+            pos += column_format.size
+        zeros = [0.0] * n
+        setpoint, pitch = columns.get(0, zeros), columns.get(1, zeros)
+        error = columns.get(2)
+        if error is None:
+            error = list(map(float.__sub__, setpoint, pitch))
+        return list(zip(ts, setpoint, pitch, error, columns.get(3, zeros), columns.get(4, zeros)))
+
+    def _unframed(self, buf, mv, pos, stop, complete):
+        # Bytes outside v2 frames: clean text lines before the first frame (boot messages)
+        # are shown, anything later is the remains of a damaged frame and is dropped
+        while True:
+            nl_index = buf.find(b"\n", pos, stop)
+            if nl_index == -1:
+                break
+            with mv[pos:nl_index] as line:
+                if self.frames or not _is_text(line):
+                    self.skipped += len(line) + 1
+                else:
+                    self._emit_line(line)
+            pos = nl_index + 1
+        if complete or stop - pos > MAX_UNFRAMED_LINE:
+            self.skipped += stop - pos
+            return stop
+        return pos
+
+    def flush_idle(self):
+        """Release lines held back after a packet run; call when a read came back empty.
+
+        ``feed`` keeps a tail shorter than a packet while packets are flowing, since
+        it is usually the next packet cut by the read boundary. Once the link goes
+        quiet it cannot be: a short reply right after ``stream off`` (``1.00\\n``)
+        is text, and would otherwise wait for the next bytes to arrive.
+        """
+        if self.version != 1 or not self.in_packets or b"\n" not in self.buf:
+            return
+        self.in_packets = False
+        buf = self.buf
+        with memoryview(buf) as mv:
+            pos = self._feed_v1(buf, mv)
+        if pos:
+            del buf[:pos]
+
+    def flush(self):
+        # Drain remaining partial text
+        if self.buf:
+            if self.version == 2:
+                self.skipped += len(self.buf)
+            else:
+                self._emit_line(self.buf)
+            self.buf = bytearray()
+
+    def _decode_run(self, mv, pos):
+        while True:
+            count = (len(mv) - pos) // PACKET_SIZE
+            if not count:
+                return pos
+            end = pos + count * PACKET_SIZE
+            # One strided slice picks the terminator byte of every candidate packet
+            terms = mv[pos + PACKET_SIZE - 1:end:PACKET_SIZE].tobytes()
+            count = len(terms) - len(terms.lstrip(b"\n"))
+            if not count:
+                return pos
+            end = pos + count * PACKET_SIZE
+            raw = mv[pos:end]
+            rows = [r[:6] for r in PACKET_STRUCT.iter_unpack(raw)]
+            # float32 values cannot overflow a float64 sum, so a single finite sum
+            # proves every value in the run is finite.
+            if isfinite(sum(r[1] + r[2] + r[3] + r[4] + r[5] for r in rows)):
+                self.packets += len(rows)
+                self.on_packets(rows, raw)
+                return end
+            good = 0
+            for r in rows:
+                if not all(isfinite(v) for v in r[1:]):
+                    break
+                good += 1
+            if good:
+                self.packets += good
+                self.on_packets(rows[:good], mv[pos:pos + good * PACKET_SIZE])
+            # Drop the non-finite packet and keep going with the rest of the run
+            self.rejected += 1
+            pos += (good + 1) * PACKET_SIZE
+
+    def _emit_line(self, line):
+        try:
+            text = bytes(line).decode(errors="replace")
+        except Exception:
+            text = "<decode error>"
+        # in_packets survives the line: packets that were flowing before a log line
+        # keep flowing after it, and their first one may be cut by the read boundary
+        if text:
+            self.lines += 1
+            if "\ufffd" in text:
+                # Bytes that are neither a packet nor text: usually a packet broken by a lost byte
+                self.misframed += 1
+            self.on_line(text)
@@ -0,0 +1,241 @@
+"""Serial reading and decoding in a child process (``RWS_READER_MODE=process``).
+
+The child owns the port: it reads, decodes and appends samples to the
+SerialService's SharedSampleRing, so acquisition never waits on the GIL held by
+/ws fan-out, JSON encoding or any number of attached clients. What does not fit
+the ring travels over a multiprocessing queue: console lines, reader metrics
+and decoder counters (every STATS_INTERVAL), errors. Commands go the other way
+over a second queue to a writer thread in the child.
+
+This module is imported by the child, so it stays away from Flask and the rest
+of the web process.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+import serial
+
+from metrics import HISTOGRAMS, Histogram
+from protocol import PacketDecoder
+from telemetry import SharedSampleRing
+
+# Port timeout of the child's blocking read, i.e. how quickly it notices a stop request
+READ_TIMEOUT = 0.05
+# Reader metrics and decoder counters are sent to the web process this often (seconds)
+STATS_INTERVAL = 0.3
+# A spawned child re-imports the main module, which can take a while in a frozen exe
+OPEN_TIMEOUT = 15.0
+CLOSE_TIMEOUT = 2.0
+
+# PacketDecoder attributes mirrored into the web process
+DECODER_STATS = ("packets", "rejected", "lines", "misframed", "frames", "crc_errors", "skipped", "version")
+READER_COUNTERS = ("serial_bytes_read", "serial_reads")
+READER_HISTOGRAMS = ("reader_wait_seconds", "reader_process_seconds", "reader_read_bytes")
+
+
+def read_blocking(ser, read_chunk):
+    # read(1) blocks in the driver (select() on POSIX, overlapped I/O on Windows)
+    # until the first byte arrives or the port timeout expires, then whatever
+    # else is already buffered is taken in the same pass.
+    data = ser.read(1)
+    if data:
+        waiting = ser.in_waiting
+        if waiting:
+            data += ser.read(min(waiting, read_chunk))
+    return data
+
+
+def read_polling(ser, read_chunk):
+    try:
+        available = ser.in_waiting
+    except Exception:
+        available = 0
+    if available:
+        return ser.read(min(available, read_chunk))
+    time.sleep(0.01)
+    return b""
+
+
+def _write_loop(ser, writes, events):
+    while True:
+        data = writes.get()
+        if data is None:
+            return
+        try:
+            ser.write(data)
+        except Exception as e:
+            events.put(("console", f"serial: {e}"))
+            return
+
+
+def _reader_main(port, baud, protocol, read_chunk, ring_name, capacity, events, writes, ready, stop):
+    ring = SharedSampleRing(capacity, ring_name)
+    try:
+        ser = serial.Serial(port, baud, timeout=READ_TIMEOUT)
+    except Exception as e:
+        events.put(("error", str(e) or type(e).__name__))
+        ring.close()
+        return
+    try:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+    except Exception:
+        pass
+    events.put(("open", None))
+    threading.Thread(target=_write_loop, args=(ser, writes, events), daemon=True).start()
+
+    lines = []
+    decoder = PacketDecoder(lambda rows, raw: ring.append(rows), lines.append, protocol)
+    histograms = {name: Histogram(bounds) for name, bounds, _ in HISTOGRAMS if name in READER_HISTOGRAMS}
+    wait_hist = histograms["reader_wait_seconds"]
+    process_hist = histograms["reader_process_seconds"]
+    size_hist = histograms["reader_read_bytes"]
+    counters = dict.fromkeys(READER_COUNTERS, 0)
+
+    def send_stats():
+        try:
+            in_waiting = ser.in_waiting
+        except Exception:
+            in_waiting = None
+        events.put(("stats", {
+            "decoder": {attr: getattr(decoder, attr) for attr in DECODER_STATS},
+            "counters": dict(counters),
+            "histograms": {name: h.drain() for name, h in histograms.items()},
+            "in_waiting": in_waiting,
+        }))
+        for name in counters:
+            counters[name] = 0
+
+    def send_lines():
+        if lines:
+            events.put(("lines", lines[:]))
+            del lines[:]
+            return True
+        return False
+
+    clock = time.perf_counter
+    last_stats = clock()
+    try:
+        while not stop.is_set():
+            started = clock()
+            try:
+                data = read_blocking(ser, read_chunk)
+            except Exception as e:
+                # Port vanished (USB unplugged)
+                if not stop.is_set():
+                    events.put(("console", f"serial: {e}"))
+                break
+            if data:
+                read_done = clock()
+                committed = ring.committed
+                decoder.feed(data)
+                wait_hist.observe(read_done - started)
+                process_hist.observe(clock() - read_done)
+                size_hist.observe(len(data))
+                counters["serial_bytes_read"] += len(data)
+                counters["serial_reads"] += 1
+                if send_lines() or ring.committed != committed:
+                    ready.set()
+            else:
+                # Port timeout: a short line held back after packets is a complete reply
+                decoder.flush_idle()
+                if send_lines():
+                    ready.set()
+            if clock() - last_stats >= STATS_INTERVAL:
+                send_stats()
+                last_stats = clock()
+        decoder.flush()
+    finally:
+        send_lines()
+        send_stats()
+        events.put(("closed", None))
+        ready.set()
+        try:
+            ser.close()
+        except Exception:
+            pass
+        ring.close()
+
+
+class ReaderProcess:
+    """Serial-port stand-in whose port is read and decoded in a child process.
+
+    It implements the subset of ``serial.Serial`` that SerialService uses
+    (``write``, ``is_open``, ``in_waiting``, ``close``); samples arrive in
+    ``ring`` and everything else through ``poll()``. ``decoder`` mirrors the
+    child's PacketDecoder counters as of its last report.
+    """
+
+    def __init__(self, ring, port, baud, protocol, read_chunk):
+        ctx = multiprocessing.get_context("spawn")
+        self.ring = ring
+        self.events = ctx.Queue()
+        self.ready = ctx.Event()
+        self._writes = ctx.Queue()
+        self._stop = ctx.Event()
+        self.decoder = SimpleNamespace(**dict.fromkeys(DECODER_STATS, 0))
+        self.decoder.version = None
+        self.in_waiting = None
+        self.is_open = False
+        self.process = ctx.Process(
+            target=_reader_main, name=f"rws-reader {port}", daemon=True,
+            args=(port, baud, protocol, read_chunk, ring.name, ring.capacity,
+                  self.events, self._writes, self.ready, self._stop))
+        self.process.start()
+        try:
+            kind, value = self.events.get(timeout=OPEN_TIMEOUT)
+        except queue.Empty:
+            kind, value = "error", "reader process did not start"
+        if kind != "open":
+            self.close()
+            raise serial.SerialException(value)
+        self.is_open = True
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException("port closed")
+        self._writes.put(bytes(data))
+        return len(data)
+
+    def wait(self, timeout):
+        """Block until the child signals new samples or events (or ``timeout``)."""
+        if self.ready.wait(timeout):
+            self.ready.clear()
+
+    def poll(self):
+        """``(kind, value)`` events received since the last call, oldest first."""
+        out = []
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                return out
+            if kind == "stats":
+                for attr, v in value["decoder"].items():
+                    setattr(self.decoder, attr, v)
+                self.in_waiting = value["in_waiting"]
+            elif kind == "closed":
+                self.is_open = False
+            out.append((kind, value))
+
+    def stop(self):
+        """Ask the child to finish; it flushes, reports and sends ``closed``."""
+        self._stop.set()
+        self._writes.put(None)
+
+    def reset_input_buffer(self):
+        pass  # done by the child when it opens the port
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+        self.stop()
+        self.process.join(CLOSE_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -39,6 +39,13 @@ if not datas:
     print("WARNING: No web assets collected (web directory empty at build time)")
     sys.exit(1)  # Use sys.exit instead of os.exit
 
+# The async server mode (RWS_SERVER=async) needs aiohttp; its C-extension dependencies
+# are imported lazily, so collect every submodule rather than rely on the analysis
+from PyInstaller.utils.hooks import collect_submodules
+async_imports = []
+for package in ('aiohttp', 'aiohappyeyeballs', 'aiosignal', 'frozenlist', 'multidict', 'propcache', 'yarl'):
+    async_imports += collect_submodules(package)
+
 # Add icon file
 icon_src = str(base_dir / "web" / "line-chart.ico")
 
@@ -63,14 +70,27 @@ a = Analysis(
         'queue',
         'struct',
         'json',
-        'start_backend'  # Ensure start_backend is included
-    ],
+        'start_backend',  # Ensure start_backend is included
+        'protocol',
+        'telemetry',
+        'capture',
+        'history',
+        'step_metrics',
+        'metrics',
+        'async_server',
+        'commands',
+        'gain_screen',
+        'reader_process',
+        'multiprocessing.shared_memory',
+        'export'
+    ] + async_imports,
     hookspath=[],
     runtime_hooks=[],
     excludes=[
         'tkinter',
         'matplotlib',
         'numpy',
+        'pyarrow',
         'scipy',
         'pandas',
         'jupyter',
@@ -3,16 +3,28 @@ try:
     from flask_cors import CORS
 except Exception:
     CORS = None
+import atexit
+import multiprocessing
+from collections import deque
 import threading
-import queue
 import time
-import struct
 import json
+import math
 import serial
 import serial.tools.list_ports
 import os
+import re
 import sys
-from math import isfinite
+
+from capture import CAPTURE_EXT, REPLAY_PREFIX, CaptureWriter, ReplayPort, list_captures, new_capture_path
+from commands import COMMAND_TIMEOUT, MAX_BATCH_COMMANDS, MAX_COMMAND_TIMEOUT, CommandBatch
+from history import HistoryPyramid
+from metrics import PipelineMetrics, render_prometheus
+from protocol import PACKET_SIZE, PROTOCOLS, PacketDecoder, encode_packets
+from reader_process import ReaderProcess, read_blocking, read_polling
+from step_metrics import StepResponseTracker
+from telemetry import (ENCODINGS, MinMaxDecimator, SampleChannel, SampleRing, SharedSampleRing, TelemetryHub,
+                       batch_columns, encode_batch, encode_channel_batch, parse_subscription)
 
 # Optional websocket support
 try:
@@ -33,24 +45,105 @@ else:
 BASE_DIR = getattr(sys, "_MEIPASS", os.path.dirname(__file__))
 WEB_DIR = os.path.join(BASE_DIR, "web")  # populated by build script / included in bundle
 
-# Binary packet layout (little-endian):
-# uint32 timestamp, float setpoint, float pitch, float error, float pitch_angle, float roll_angle, uint8 end ('\n')
-PACKET_SIZE = 25
-PACKET_STRUCT = struct.Struct("<IfffffB")
+# Recordings started through /api/record/start land here
+CAPTURE_DIR = os.environ.get("RWS_CAPTURE_DIR", os.path.join(os.path.expanduser("~"), "RWS-Captures"))
+
+# Samples are coalesced into one /ws frame per window (overridable per client with ?window=<ms>)
+WS_BATCH_WINDOW_MS = int(os.environ.get("RWS_WS_BATCH_WINDOW_MS", "50"))
+
+# /stream (SSE): reconnect delay suggested to the browser, and a comment line this often when idle
+SSE_RETRY_MS = 1000
+SSE_HEARTBEAT = 15.0
+
+# Per-client sample buffer size for /ws fan-out (slow clients drop beyond this)
+CLIENT_BUFFER_SAMPLES = int(os.environ.get("RWS_CLIENT_BUFFER_SAMPLES", "20000"))
+
+# Recent samples kept in memory whether or not a client is connected (24 bytes per sample)
+SAMPLE_RING_CAPACITY = int(os.environ.get("RWS_SAMPLE_RING_CAPACITY", str(8000 * 60)))
+# Recent console lines kept for /api/export, stamped with the device time they arrived at
+CONSOLE_LOG_LINES = int(os.environ.get("RWS_CONSOLE_LOG_LINES", "10000"))
+
+# "blocking": the reader sleeps inside the serial read and wakes when bytes arrive.
+# "poll": legacy in_waiting polling with a 10 ms sleep when idle.
+# "process": a child process reads and decodes into a shared-memory ring (reader_process.py),
+# so acquisition does not compete with /ws clients for the GIL; replays stay in-process.
+READER_MODE = os.environ.get("RWS_READER_MODE", "blocking")
+# Upper bound on bytes handed to the decoder per read
+READ_CHUNK_SIZE = int(os.environ.get("RWS_READ_CHUNK_SIZE", "65536"))
+
+# "flask": threaded Flask server (default); "async": aiohttp event loop (async_server.py)
+SERVER_MODE = os.environ.get("RWS_SERVER", "flask")
+
+# Serial framing: "v1" (bare packets), "v2" (CRC-checked frames) or "auto" (v1 until a v2 frame shows up)
+PROTOCOL = os.environ.get("RWS_PROTOCOL", "auto")
+
+# /api/health reports uptime since import, and the startup timings of a launcher
+# that measures them (tray_app.py fills in startup_report)
+STARTED = time.perf_counter()
+startup_report = None
+
+# Boards are addressed by device id (?device=<id> / "device" in JSON bodies); requests
+# without one go to DEFAULT_DEVICE. Each device costs a SampleRing of its own.
+DEFAULT_DEVICE = "default"
+MAX_DEVICES = int(os.environ.get("RWS_MAX_DEVICES", "16"))
+DEVICE_ID_RE = re.compile(r"^[A-Za-z0-9_.-]{1,32}$")
 
 class SerialService:
-    def __init__(self):
+    # PacketDecoder counters and the metric names they are reported under
+    DECODER_COUNTERS = (("packets", "packets_decoded"), ("rejected", "packets_rejected"),
+                        ("lines", "console_lines"), ("misframed", "console_lines_misframed"),
+                        ("frames", "frames_decoded"), ("crc_errors", "frame_crc_errors"),
+                        ("skipped", "resync_skipped_bytes"))
+
+    def __init__(self, hub, ring_capacity=SAMPLE_RING_CAPACITY, reader_mode=READER_MODE, read_chunk=READ_CHUNK_SIZE,
+                 metrics=None):
         self.ser = None
+        self.port = None
+        self.protocol = PROTOCOL
         self.thread = None
         self.running = False
-        self.q = queue.Queue()
+        self.hub = hub
+        # Under spawn the reader child re-imports the main module; only the web process owns a ring
+        if reader_mode == "process" and multiprocessing.parent_process() is None:
+            self.ring = SharedSampleRing(ring_capacity)
+            atexit.register(self.ring.close)
+        else:
+            self.ring = SampleRing(ring_capacity)
+        self.history = HistoryPyramid(self.ring)
+        self.console_log = deque(maxlen=CONSOLE_LOG_LINES)
+        self.steps = StepResponseTracker(self.ring, hub.publish)
+        self.reader_mode = reader_mode
+        self.read_chunk = max(int(read_chunk), 1)
+        self.recorder = None
+        self.decoder = None
+        self.metrics = metrics or PipelineMetrics()
+        # Decoder counters of previous connections (each connection gets a fresh decoder)
+        self.decoder_totals = {name: 0 for _, name in self.DECODER_COUNTERS}
+        self._decoder_lock = threading.Lock()
+        # One command batch at a time, so replies cannot be attributed to the wrong batch
+        self.command_lock = threading.Lock()
+        self.command_batch = None
+        # Console commands (send()) whose replies have not arrived yet
+        self.console_batch = None
         self.packet_counter = 0
-        self.last_freq_time = time.time()
+        self.last_freq_time = time.monotonic()
 
-    def connect(self, port, baud=2000000):
+    def connect(self, port, baud=2000000, speed=1.0, start=0.0, protocol=None):
+        if protocol is not None and protocol not in PROTOCOLS:
+            raise ValueError(f"protocol must be one of {', '.join(PROTOCOLS)}")
         if self.ser and self.ser.is_open:
             self.disconnect()
-        self.ser = serial.Serial(port, baud, timeout=0.05)
+        if port.startswith(REPLAY_PREFIX):
+            # Pseudo-port: play a capture through the normal pipeline
+            name = os.path.basename(port[len(REPLAY_PREFIX):])
+            self.ser = ReplayPort(os.path.join(CAPTURE_DIR, name), speed=speed, start=start)
+        elif isinstance(self.ring, SharedSampleRing):
+            self.ser = ReaderProcess(self.ring, port, baud, protocol or PROTOCOL, self.read_chunk)
+        else:
+            self.ser = serial.Serial(port, baud, timeout=0.05)
+        self.port = port
+        # Captures hold v1 packets whatever the board spoke
+        self.protocol = "v1" if port.startswith(REPLAY_PREFIX) else (protocol or PROTOCOL)
 
         # Clear any transient data so the first real response is not mixed with noise
         try:
@@ -59,11 +152,20 @@ class SerialService:
         except Exception:
             pass
 
+        self.steps.reset()
         self.running = True
-        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        target = self.pump_loop if isinstance(self.ser, ReaderProcess) else self.read_loop
+        self.thread = threading.Thread(target=target, daemon=True)
         self.thread.start()
         return True
 
+    def close(self):
+        """Disconnect and free the ring (a service that is not kept in the registry)."""
+        self.disconnect()
+        if isinstance(self.ring, SharedSampleRing):
+            atexit.unregister(self.ring.close)
+            self.ring.close()
+
     def disconnect(self):
         self.running = False
         if self.thread:
@@ -71,93 +173,327 @@ class SerialService:
         if self.ser:
             try:
                 self.ser.close()
-            except Exception:
-                pass
+            except OSError:
+                pass  # port already gone (SerialException is an OSError); anything else is a bug
         self.ser = None
+        self.port = None
+        self.console_batch = None
         return True
 
     def send(self, cmd: str):
+        """Write one console command without waiting for its reply.
+
+        Its reply is still expected (``console_batch``), so that a batch started
+        right after does not take it for one of its own. While a batch is waiting
+        for replies, this waits for the batch.
+        """
+        if not self.ser or not self.ser.is_open:
+            raise RuntimeError("Not connected")
+        cmd = " ".join(cmd.split())
+        with self.command_lock:
+            console = self.console_batch
+            if console is None or console.done.is_set():
+                console = self.console_batch = CommandBatch([])
+            console.add(cmd)
+            self.ser.write((cmd + "\n").encode())
+        self.steps.on_command(cmd)
+
+    def execute(self, commands, timeout=COMMAND_TIMEOUT):
+        """Send a batch of commands in one write and wait for their replies.
+
+        Returns one result per command (see ``commands.CommandBatch``). Batches
+        and ``send()`` are serialized on ``command_lock``, and a batch first waits
+        (up to ``timeout``) for the replies of console commands sent before it.
+        """
+        commands = [" ".join(cmd.split()) for cmd in commands]
         if not self.ser or not self.ser.is_open:
             raise RuntimeError("Not connected")
-        payload = cmd.strip() + "\n"
-        self.ser.write(payload.encode())
+        with self.command_lock:
+            console = self.console_batch
+            if console:
+                console.wait(timeout)
+                # Replies still missing by now are not coming; the lines are the batch's
+                self.console_batch = None
+            batch = CommandBatch(commands)
+            self.command_batch = batch
+            try:
+                self.ser.write("".join(cmd + "\n" for cmd in commands).encode())
+                for cmd in commands:
+                    self.steps.on_command(cmd)
+                return batch.wait(timeout)
+            finally:
+                self.command_batch = None
 
     def _emit_frequency_if_needed(self):
-        now = time.time()
+        now = time.monotonic()
         elapsed = now - self.last_freq_time
         if elapsed >= 0.3:
             freq = self.packet_counter / elapsed if elapsed > 0 else 0.0
-            self.q.put({"type": "freq", "value": freq})
+            self.hub.publish({"type": "freq", "value": freq})
             self.packet_counter = 0
             self.last_freq_time = now
 
+    def start_recording(self, path):
+        self.stop_recording()
+        self.recorder = CaptureWriter(path, PACKET_SIZE)
+        return self.recorder.stats()
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        return recorder.stats()
+
+    def _on_packets(self, rows, raw):
+        recorder = self.recorder
+        if recorder:
+            # Compact block frames have no packet bytes; captures always hold packets
+            recorder.write_packets(raw if raw is not None else encode_packets(rows))
+        # Published once per decoded chunk; each /ws client turns these into batch frames
+        with self.ring.lock:
+            first_seq = self.ring.head
+            self.ring.append(rows)
+            self._process_rows(rows, first_seq)
+        self.packet_counter += len(rows)
+        self._emit_frequency_if_needed()
+
+    def _process_rows(self, rows, first_seq):
+        # Caller holds ring.lock and has made rows visible up to ring.head
+        self.history.update()
+        self.steps.process(rows, first_seq)
+        self.hub.publish_samples(rows)
+
+    def _pump_samples(self):
+        # Process mode: publish what the reader process committed since the last pass
+        ring = self.ring
+        with ring.lock:
+            rows, first_seq, _ = ring.read(ring.head, ring.committed)
+            if not rows:
+                return
+            ring.head = first_seq + len(rows)
+            self._process_rows(rows, first_seq)
+        recorder = self.recorder
+        if recorder:
+            recorder.write_packets(encode_packets(rows))
+        self.packet_counter += len(rows)
+        self._emit_frequency_if_needed()
+
+    def subscribe(self, policy="drop_oldest", backlog_ms=0, ready=None, notify=None, since=None):
+        """Subscribe to live telemetry, optionally primed with the last ``backlog_ms`` of samples.
+
+        The default is live tail only: a reconnecting client never gets flooded with
+        samples that arrived while nobody was listening. ``since`` (a ring sequence
+        number, e.g. from an SSE Last-Event-ID) resumes from that sample instead; a
+        ``gap`` event reports samples already overwritten.
+        """
+        with self.ring.lock:
+            sub = self.hub.subscribe(policy, ready=ready, notify=notify)
+            if since is not None and since <= self.ring.head:
+                rows, _, lost = self.ring.read(since)
+                if lost:
+                    sub.push_event({"type": "gap", "lost": lost})
+                sub.push_samples(rows)
+            elif backlog_ms > 0 and self.ring.head:
+                latest = self.ring.timestamp_at(self.ring.head - 1)
+                rows, _, _ = self.ring.read(self.ring.find(latest - backlog_ms))
+                sub.push_samples(rows)
+            sub.next_seq = self.ring.head
+        return sub
+
+    def _on_line(self, text):
+        recorder = self.recorder
+        if recorder:
+            recorder.write_console(text)
+        ring = self.ring
+        self.console_log.append((ring.timestamp_at(ring.head - 1) if ring.head else 0, text))
+        self.steps.on_console(text)
+        # Replies to console commands go to them first; a batch only starts once they are in
+        console = self.console_batch
+        if not (console and console.on_line(text)):
+            batch = self.command_batch
+            if batch:
+                batch.on_line(text)
+        self.hub.publish({"type": "console", "text": text})
+
+    def _read_blocking(self):
+        return read_blocking(self.ser, self.read_chunk)
+
+    def _read_polling(self):
+        return read_polling(self.ser, self.read_chunk)
+
     def read_loop(self):
-        buf = bytearray()
+        decoder = self.decoder = PacketDecoder(self._on_packets, self._on_line, self.protocol)
+        # A replay has nothing to poll for: its read() waits for the next due record
+        poll = self.reader_mode == "poll" and not isinstance(self.ser, ReplayPort)
+        read = self._read_polling if poll else self._read_blocking
+        metrics = self.metrics
+        counters = metrics.counters
+        wait_hist = metrics.histograms["reader_wait_seconds"]
+        process_hist = metrics.histograms["reader_process_seconds"]
+        size_hist = metrics.histograms["reader_read_bytes"]
+        clock = time.perf_counter
         while self.running and self.ser and self.ser.is_open:
+            started = clock()
             try:
-                available = self.ser.in_waiting
-            except Exception:
-                available = 0
-            if available:
-                chunk = self.ser.read(available)
-                buf.extend(chunk)
-                # Parse packets / lines
-                while True:
-                    # Binary packet
-                    if len(buf) >= PACKET_SIZE and buf[PACKET_SIZE - 1] == 0x0A:  # '\n'
-                        raw_pkt = bytes(buf[:PACKET_SIZE])
-                        del buf[:PACKET_SIZE]
-                        try:
-                            ts, setpoint, pitch, error, pitch_ang, roll_ang, endb = PACKET_STRUCT.unpack(raw_pkt)
-                            # Basic sanity check
-                            if not all(isfinite(v) for v in (setpoint, pitch, error, pitch_ang, roll_ang)):
-                                raise ValueError("non-finite values")
-                            # Enqueue separate logical messages
-                            self.q.put({
-                                "type": "pid",
-                                "timestamp": ts,
-                                "setpoint": setpoint,
-                                "pitch": pitch,
-                                "error": error
-                            })
-                            self.q.put({
-                                "type": "angle",
-                                "timestamp": ts,
-                                "pitch_angle": pitch_ang,
-                                "roll_angle": roll_ang
-                            })
-                            self.packet_counter += 1
-                            self._emit_frequency_if_needed()
-                            continue
-                        except Exception:
-                            # Fall through to attempt text parsing
-                            pass
-                    # Text line
-                    nl_index = buf.find(b"\n")
-                    if nl_index != -1:
-                        line = bytes(buf[:nl_index])
-                        del buf[: nl_index + 1]
-                        try:
-                            text = line.decode(errors="replace")
-                        except Exception:
-                            text = "<decode error>"
-                        if text:
-                            self.q.put({"type": "console", "text": text})
-                        continue
-                    break
+                data = read()
+            except Exception as e:
+                # Port vanished (USB unplugged) or was closed under us by disconnect()
+                if self.running:
+                    self.hub.publish({"type": "console", "text": f"serial: {e}"})
+                break
+            if data:
+                read_done = clock()
+                # Decode the whole chunk in one pass (packets / lines)
+                decoder.feed(data)
+                wait_hist.observe(read_done - started)
+                process_hist.observe(clock() - read_done)
+                size_hist.observe(len(data))
+                counters["serial_bytes_read"] += len(data)
+                counters["serial_reads"] += 1
             else:
-                time.sleep(0.01)
+                # Port timeout: a short line held back after packets is a complete reply
+                decoder.flush_idle()
         # Drain remaining partial text (optional)
-        if buf:
+        decoder.flush()
+        self._reader_stopped(decoder)
+
+    def pump_loop(self):
+        """Process-mode counterpart of ``read_loop``: relays what the reader process produces."""
+        proc = self.ser
+        self.decoder = proc.decoder
+        metrics = self.metrics
+        deadline = None
+        while proc.is_open:
+            if not self.running and deadline is None:
+                # Let the child flush its decoder and final stats before it goes
+                proc.stop()
+                deadline = time.monotonic() + 1.0
+            elif deadline is not None and time.monotonic() > deadline:
+                break
+            proc.wait(0.01)
+            for kind, value in proc.poll():
+                if kind == "lines":
+                    for text in value:
+                        self._on_line(text)
+                elif kind == "console":
+                    if self.running:
+                        self.hub.publish({"type": "console", "text": value})
+                elif kind == "stats":
+                    for name, n in value["counters"].items():
+                        metrics.counters[name] += n
+                    for name, drained in value["histograms"].items():
+                        metrics.histograms[name].merge(*drained)
+            self._pump_samples()
+        proc.close()
+        self._reader_stopped(proc.decoder)
+
+    def _reader_stopped(self, decoder):
+        with self._decoder_lock:
+            for attr, name in self.DECODER_COUNTERS:
+                self.decoder_totals[name] += getattr(decoder, attr)
+            self.decoder = None
+        self.hub.publish({"type": "console", "text": "serial: disconnected"})
+
+    def metrics_snapshot(self):
+        with self._decoder_lock:
+            counters = dict(self.decoder_totals)
+            decoder = self.decoder
+            if decoder:
+                for attr, name in self.DECODER_COUNTERS:
+                    counters[name] += getattr(decoder, attr)
+            protocol_version = decoder.version if decoder else None
+        clients = [sub.stats() for sub in self.hub.subscribers]
+        ring = self.ring
+        in_waiting = None
+        ser = self.ser
+        if ser is not None:
             try:
-                text = buf.decode(errors="replace")
-                if text:
-                    self.q.put({"type": "console", "text": text})
+                in_waiting = ser.in_waiting
             except Exception:
                 pass
-        self.q.put({"type": "console", "text": "serial: disconnected"})
+        gauges = {
+            "serial_connected": int(bool(ser is not None and self.running)),
+            "serial_in_waiting_bytes": in_waiting,
+            "protocol_version": protocol_version,
+            "recording": int(self.recorder is not None),
+            "ring_capacity_samples": ring.capacity,
+            "ring_size_samples": len(ring),
+            "ring_overwritten_samples": ring.overwritten,
+            "clients": len(clients),
+            "client_buffered_samples_total": sum(c["buffered"] for c in clients),
+            "client_buffer_high_water_samples_max": max((c["high_water"] for c in clients), default=0),
+        }
+        return self.metrics.snapshot(counters, gauges, clients)
 
-serial_service = SerialService()
+class DeviceError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class DeviceRegistry:
+    """SerialService per device id.
+
+    Every device has its own reader thread, ring, hub and metrics, so a busy link
+    never shares a thread or a buffer with another board.
+    """
+
+    def __init__(self, max_devices=MAX_DEVICES):
+        self.max_devices = max_devices
+        self._services = {}
+        self._lock = threading.Lock()
+
+    def add(self, device_id, service):
+        with self._lock:
+            self._services[device_id] = service
+        return service
+
+    def _check_id(self, device_id):
+        if not DEVICE_ID_RE.match(device_id):
+            raise DeviceError(f"invalid device id: {device_id!r}")
+
+    def get(self, device_id):
+        self._check_id(device_id)
+        with self._lock:
+            service = self._services.get(device_id)
+        if service is None:
+            raise DeviceError(f"unknown device: {device_id}", 404)
+        return service
+
+    def new(self, device_id):
+        """SerialService for an id that is not registered yet; ``register`` it once it has connected"""
+        self._check_id(device_id)
+        with self._lock:
+            if len(self._services) >= self.max_devices:
+                raise DeviceError(f"too many devices (max {self.max_devices})")
+        return SerialService(TelemetryHub(CLIENT_BUFFER_SAMPLES))
+
+    def register(self, device_id, service):
+        with self._lock:
+            if device_id in self._services:
+                raise DeviceError(f"device {device_id} was connected by another request", 409)
+            if len(self._services) >= self.max_devices:
+                raise DeviceError(f"too many devices (max {self.max_devices})")
+            self._services[device_id] = service
+        return service
+
+    def items(self):
+        with self._lock:
+            return list(self._services.items())
+
+    def owner(self, port):
+        """Id of the device currently connected to ``port``, if any"""
+        for device_id, service in self.items():
+            if service.port == port:
+                return device_id
+        return None
+
+
+hub = TelemetryHub(CLIENT_BUFFER_SAMPLES)
+serial_service = SerialService(hub)
+devices = DeviceRegistry()
+devices.add(DEFAULT_DEVICE, serial_service)
 
 @app.after_request
 def add_cors_headers(response):
@@ -166,10 +502,51 @@ def add_cors_headers(response):
     response.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
     return response
 
+@app.errorhandler(DeviceError)
+def device_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+def _device_id():
+    # "device" in the JSON body or the query string
+    data = request.get_json(silent=True) or {}
+    return str(data.get("device") or request.args.get("device") or DEFAULT_DEVICE)
+
+def _device():
+    """(device id, SerialService) addressed by the request"""
+    device_id = _device_id()
+    return device_id, devices.get(device_id)
+
 @app.route("/api/ports", methods=["GET"])
 def list_ports():
     ports = [p.device for p in serial.tools.list_ports.comports()]
-    return jsonify({"ports": ports})
+    ports += [REPLAY_PREFIX + name for name in list_captures(CAPTURE_DIR)]
+    in_use = {service.port: device_id for device_id, service in devices.items() if service.port}
+    return jsonify({"ports": ports, "in_use": in_use})
+
+@app.route("/api/devices", methods=["GET"])
+def api_devices():
+    return jsonify({"devices": [
+        {
+            "id": device_id,
+            "port": service.port,
+            "connected": bool(service.ser and service.running),
+            "recording": service.recorder is not None,
+            "clients": len(service.hub.subscribers),
+            "samples": len(service.ring),
+        }
+        for device_id, service in devices.items()
+    ]})
+
+@app.route("/api/health", methods=["GET"])
+def api_health():
+    # Liveness probe (the tray app asks it whether port 5000 is already ours); cheap, no device access
+    return jsonify({
+        "ok": True,
+        "app": "rws-pid-tuner",
+        "server": SERVER_MODE,
+        "uptime": time.perf_counter() - STARTED,
+        "startup": startup_report,
+    })
 
 # Serve frontend (fallback to index.html for SPA routes)
 @app.route("/", defaults={"path": ""})
@@ -189,42 +566,612 @@ def api_connect():
     baud = int(data.get("baud", 2000000))
     if not port:
         return jsonify({"error": "port required"}), 400
+    if data.get("protocol") not in (None,) + PROTOCOLS:
+        return jsonify({"error": f"protocol must be one of {', '.join(PROTOCOLS)}"}), 400
+    device_id = _device_id()
+    owner = devices.owner(port)
+    if owner is not None and owner != device_id:
+        return jsonify({"error": f"{port} is in use by device {owner}"}), 409
+    # A new device only joins the registry (and keeps its ring) once its port has opened
     try:
-        serial_service.connect(port, baud)
-        return jsonify({"ok": True})
+        service, new = devices.get(device_id), False
+    except DeviceError as e:
+        if e.status != 404:
+            raise
+        service, new = devices.new(device_id), True
+    try:
+        # speed/start only apply to replay: pseudo-ports (speed 0 = as fast as possible)
+        service.connect(port, baud, float(data.get("speed", 1.0)), float(data.get("start", 0.0)),
+                        data.get("protocol"))
     except Exception as e:
+        if new:
+            service.close()
         return jsonify({"error": str(e) or type(e).__name__}), 500
+    if new:
+        try:
+            devices.register(device_id, service)
+        except DeviceError:
+            service.close()
+            raise
+    return jsonify({"ok": True, "device": device_id})
 
 @app.route("/api/disconnect", methods=["POST"])
 def api_disconnect():
-    serial_service.disconnect()
+    _, service = _device()
+    service.disconnect()
     return jsonify({"ok": True})
 
 @app.route("/api/send", methods=["POST"])
 def api_send():
     data = request.json or {}
     cmd = data.get("cmd", "")
+    _, service = _device()
     try:
-        serial_service.send(cmd)
+        service.send(cmd)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"error": str(e) or type(e).__name__}), 500
 
+@app.route("/api/command", methods=["POST"])
+def api_command():
+    """Run a batch of CLI commands and return their replies.
+
+    Body: ``{"commands": [...], "timeout": seconds}`` (``"cmd": "..."`` for one).
+    All commands go out in one serial write; each result has ``cmd``, ``ok``,
+    ``status`` (ok, error, no_reply, timeout), the ``reply`` line, all ``lines``
+    and, for known reply formats, the parsed ``values``.
+    """
+    data = request.json or {}
+    commands = data.get("commands")
+    if commands is None:
+        commands = [data["cmd"]] if data.get("cmd") else []
+    if not isinstance(commands, list) or not all(isinstance(c, str) and c.strip() for c in commands):
+        return jsonify({"error": "commands must be a list of non-empty strings"}), 400
+    if not commands or len(commands) > MAX_BATCH_COMMANDS:
+        return jsonify({"error": f"send 1 to {MAX_BATCH_COMMANDS} commands"}), 400
+    try:
+        timeout = min(max(float(data.get("timeout", COMMAND_TIMEOUT)), 0.0), MAX_COMMAND_TIMEOUT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "timeout must be a number"}), 400
+    device_id, service = _device()
+    started = time.monotonic()
+    try:
+        results = service.execute(commands, timeout)
+    except Exception as e:
+        return jsonify({"error": str(e) or type(e).__name__}), 500
+    return jsonify({
+        "ok": all(r["ok"] for r in results),
+        "device": device_id,
+        "elapsed": time.monotonic() - started,
+        "results": results,
+    })
+
+
+@app.route("/api/record/start", methods=["POST"])
+def api_record_start():
+    data = request.json or {}
+    _, service = _device()
+    name = data.get("file")
+    if name:
+        # Only plain file names inside CAPTURE_DIR
+        name = os.path.basename(name)
+        if not name.endswith(CAPTURE_EXT):
+            name += CAPTURE_EXT
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        path = os.path.join(CAPTURE_DIR, name)
+    else:
+        path = new_capture_path(CAPTURE_DIR)
+    try:
+        return jsonify({"ok": True, "recording": service.start_recording(path)})
+    except Exception as e:
+        return jsonify({"error": str(e) or type(e).__name__}), 500
+
+@app.route("/api/record/stop", methods=["POST"])
+def api_record_stop():
+    _, service = _device()
+    return jsonify({"ok": True, "recording": service.stop_recording()})
+
+@app.route("/api/record", methods=["GET"])
+def api_record_status():
+    recorder = _device()[1].recorder
+    return jsonify({"recording": recorder.stats() if recorder else None})
+
+@app.route("/api/replay", methods=["GET"])
+def api_replay_status():
+    ser = _device()[1].ser
+    if not isinstance(ser, ReplayPort):
+        return jsonify({"replay": None})
+    return jsonify({"replay": ser.status()})
+
+@app.route("/api/replay/seek", methods=["POST"])
+def api_replay_seek():
+    data = request.json or {}
+    ser = _device()[1].ser
+    if not isinstance(ser, ReplayPort):
+        return jsonify({"error": "not replaying"}), 400
+    try:
+        t = float(data.get("t", 0.0))
+        if not math.isfinite(t):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "t must be a number of seconds"}), 400
+    ser.seek(t)
+    return jsonify({"ok": True, "replay": ser.status()})
+
+def _time_range(cast):
+    """``from`` / ``to`` query args converted with ``cast`` (None when absent).
+
+    Raises ValueError for a malformed or non-finite value instead of dropping it,
+    which ``request.args.get(type=...)`` would do.
+    """
+    bounds = []
+    for name in ("from", "to"):
+        value = request.args.get(name)
+        if value is not None:
+            kind = "an integer" if cast is int else "a finite number"
+            try:
+                value = cast(value)
+            except ValueError:
+                raise ValueError(f"{name} must be {kind}") from None
+            if isinstance(value, float) and not math.isfinite(value):
+                raise ValueError(f"{name} must be {kind}")
+        bounds.append(value)
+    return bounds
+
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    # from/to are device timestamps in ms (default: everything still in the ring)
+    try:
+        t_from, t_to = _time_range(int)
+        max_points = max(int(request.args.get("max_points", 2000)), 2)
+    except ValueError:
+        return jsonify({"error": "from, to and max_points must be integers"}), 400
+    rows, level = _device()[1].history.query(t_from, t_to, max_points)
+    return jsonify(dict(batch_columns(rows), level=level, count=len(rows)))
+
+@app.route("/api/export", methods=["GET"])
+def api_export():
+    """Download samples or console lines as csv, npz or parquet, streamed in chunks.
+
+    Query: ``format`` (default csv), ``table=samples|console`` (csv and parquet;
+    npz holds both), and either ``capture=<file>`` in CAPTURE_DIR with ``from`` /
+    ``to`` in seconds since the recording started, or a device's ring with
+    ``from`` / ``to`` as device timestamps in ms (as in /api/history).
+    """
+    import export  # imported on first use: pyarrow alone costs more than the rest of startup
+    fmt = request.args.get("format", "csv")
+    table = request.args.get("table", "samples")
+    if fmt not in export.FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(export.FORMATS)}"}), 400
+    if table not in export.TABLES:
+        return jsonify({"error": f"table must be one of {', '.join(export.TABLES)}"}), 400
+    if fmt == "parquet" and export.pa is None:
+        return jsonify({"error": "parquet export needs pyarrow (pip install pyarrow)"}), 501
+    capture = request.args.get("capture")
+    try:
+        if capture:
+            name = os.path.basename(capture)
+            path = os.path.join(CAPTURE_DIR, name)
+            if not os.path.isfile(path):
+                return jsonify({"error": f"no such capture: {name}"}), 404
+            source = export.CaptureSource(path, *_time_range(float))
+            stem = os.path.splitext(name)[0]
+        else:
+            t_from, t_to = _time_range(int)
+            device_id, service = _device()
+            source = export.RingSource(service.ring, service.console_log, t_from, t_to)
+            stem = f"rws-{device_id}"
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    filename = f"{stem}.{fmt}" if fmt == "npz" else f"{stem}-{table}.{fmt}"
+    return Response(stream_with_context(export.export(source, fmt, table)),
+                    mimetype=export.CONTENT_TYPES[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route("/api/step_metrics", methods=["GET"])
+def api_step_metrics():
+    return jsonify(_device()[1].steps.snapshot())
+
+@app.route("/api/step_metrics/clear", methods=["POST"])
+def api_step_metrics_clear():
+    _device()[1].steps.clear()
+    return jsonify({"ok": True})
+
+@app.route("/api/gain_screen", methods=["POST"])
+def api_gain_screen():
+    """Pre-screen PID gains offline against the simulator plant (needs NumPy).
+
+    Body: ``kp``/``ki``/``kd`` ranges as ``[low, high]``, plus either ``"grid": n``
+    (or ``[n_kp, n_ki, n_kd]``) points per gain or ``"samples": n`` random
+    candidates (``seed``); optional ``amplitude``, ``duration``, ``dt``, ``top``,
+    ``weights`` and ``workers`` (process pool size).
+    """
+    import gain_screen  # imported on first use, like export: NumPy is slow to import
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    try:
+        weights = data.get("weights") or {}
+        if not isinstance(weights, dict):
+            raise ValueError("weights must be an object of metric: weight")
+        ranges = [tuple(float(x) for x in data.get(name, default)) for name, default in
+                  (("kp", (0.0, 20.0)), ("ki", (0.0, 10.0)), ("kd", (0.0, 2.0)))]
+        if any(len(r) != 2 for r in ranges):
+            raise ValueError("kp, ki and kd must be [low, high]")
+        if "samples" in data:
+            gains = gain_screen.random_candidates(*ranges, int(data["samples"]), data.get("seed"))
+        else:
+            grid = data.get("grid", 16)
+            counts = grid if isinstance(grid, list) else [grid] * 3
+            if len(counts) != 3 or any(int(n) < 1 for n in counts):
+                raise ValueError("grid must be a positive count or three of them")
+            gains = gain_screen.grid_candidates(*[(lo, hi, n) for (lo, hi), n in zip(ranges, counts)])
+        result = gain_screen.screen(
+            gains,
+            amplitude=float(data.get("amplitude", gain_screen.DEFAULT_AMPLITUDE)),
+            duration=float(data.get("duration", gain_screen.DEFAULT_DURATION)),
+            dt=float(data.get("dt", gain_screen.DEFAULT_DT)),
+            top=int(data.get("top", gain_screen.DEFAULT_TOP)),
+            weights={k: float(v) for k, v in weights.items()},
+            workers=int(data.get("workers", 0)),
+        )
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 501
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e) or type(e).__name__}), 400
+    return jsonify(result)
+
+@app.route("/api/metrics", methods=["GET"])
+def api_metrics():
+    # ?format=prometheus for the Prometheus text exposition format (scrape target);
+    # ?device=<id> limits the output to one device
+    if request.args.get("device"):
+        device_id, service = _device()
+        snapshots = {device_id: service.metrics_snapshot()}
+    else:
+        snapshots = {device_id: service.metrics_snapshot() for device_id, service in devices.items()}
+    if request.args.get("format") == "prometheus":
+        return Response(render_prometheus(snapshots), mimetype="text/plain; version=0.0.4")
+    if request.args.get("device"):
+        return jsonify(next(iter(snapshots.values())))
+    return jsonify({"devices": snapshots})
+
+@app.route("/api/clients", methods=["GET"])
+def api_clients():
+    _, service = _device()
+    ring = service.ring
+    return jsonify({
+        "clients": [sub.stats() for sub in service.hub.subscribers],
+        "ring": {"capacity": ring.capacity, "size": len(ring), "head": ring.head, "overwritten": ring.overwritten},
+    })
+
 
 # WebSocket endpoint
+# Query parameters (negotiated at connect time):
+#   encoding=json|binary          sample batch format (binary frames are described in telemetry.py)
+#   window=<ms>                   coalescing window for sample batches
+#   policy=drop_oldest|decimate   what to do with this client's buffer when it falls behind
+#   backlog=<ms>                  replay this much recent history on connect (default 0: live tail only)
+#   display_rate=<points/s>       min/max-decimate samples for display (default 0: full rate)
+#   device=<id>[,<id>...]         devices to stream (default: "default"); with more than one,
+#                                 events carry a "device" field and batches are device-tagged
+def _int_arg(name, default, minimum=0, args=None):
+    args = request.args if args is None else args
+    try:
+        return max(int(args.get(name, default)), minimum)
+    except ValueError:
+        return default
+
+
+class WsStream:
+    """One device's part of a /ws connection: its subscriber, decimator and pending rows.
+
+    Until the client subscribes to channels every sample goes out in one frame
+    per window (decimated to ``display_rate`` if set) along with every event.
+    """
+
+    def __init__(self, device_id, service, sub, display_rate, tagged):
+        self.device_id = device_id
+        self.service = service
+        self.sub = sub
+        self.decimator = MinMaxDecimator(display_rate) if display_rate else None
+        self.tag = device_id if tagged else None
+        self.channels = None
+        self.rows = []
+        self.counters = service.metrics.counters
+        self.serialize_hist = service.metrics.histograms["serialize_seconds"]
+        self.send_hist = service.metrics.histograms["ws_send_seconds"]
+
+    def poll(self):
+        """Take what the subscriber buffered: rows are kept for frames(), events are returned as JSON"""
+        rows, events = self.sub.get(timeout=0)
+        self.rows.extend(rows)
+        return [json.dumps(dict(item, device=self.tag) if self.tag else item) for item in events]
+
+    def subscribe(self, subscription):
+        """Apply ``parse_subscription`` output, or None to go back to everything"""
+        if subscription is None:
+            self.channels = None
+            self.sub.wants_samples = True
+            self.sub.event_types = None
+        else:
+            samples, events = subscription
+            self.channels = [SampleChannel(name, *spec) for name, spec in samples.items()]
+            self.sub.wants_samples = bool(self.channels)
+            self.sub.event_types = events
+        self.rows = []
+
+    def frames(self, encoding):
+        """The batch frames for the rows collected since the last call"""
+        rows, self.rows = self.rows, []
+        if self.channels is None:
+            if self.decimator:
+                # An idle window closes the open bucket so the last points are not held back
+                rows = self.decimator.process(rows) if rows else self.decimator.flush()
+            if not rows:
+                return []
+            started = time.perf_counter()
+            frame = encode_batch(rows, encoding, self.tag)
+            self.serialize_hist.observe(time.perf_counter() - started)
+            return [frame]
+        frames = []
+        now = time.monotonic()
+        for channel in self.channels:
+            picked = channel.take(rows, now)
+            if picked:
+                started = time.perf_counter()
+                frames.append(encode_channel_batch(picked, channel.fields, encoding, self.tag, channel.name))
+                self.serialize_hist.observe(time.perf_counter() - started)
+        return frames
+
+    def resume_seq(self):
+        """Ring sequence number after the last row sent, for SSE resume ids.
+
+        Rows drained from the subscriber but still in an open decimation bucket have
+        not gone out yet; a client that resumes from here gets them again.
+        """
+        if self.channels is None:
+            decimators = [self.decimator] if self.decimator else []
+        else:
+            decimators = [channel.decimator for channel in self.channels if channel.decimator]
+        return self.sub.seq - max((len(d.pending) for d in decimators), default=0)
+
+    def sent(self, frame, seconds):
+        self.send_hist.observe(seconds)
+        self.counters["ws_frames_sent"] += 1
+        self.counters["ws_bytes_sent"] += len(frame)
+
+    def close(self):
+        self.service.hub.unsubscribe(self.sub)
+
+
+def ws_message(streams, text):
+    """Handle a message from a /ws client and return the reply.
+
+    The only message is a channel subscription, which replaces the previous one
+    on every device of the connection; ``"channels": null`` restores the default
+    of everything.
+    """
+    try:
+        message = json.loads(text)
+        if not isinstance(message, dict) or message.get("type") != "subscribe":
+            raise ValueError('expected {"type": "subscribe", "channels": {...}}')
+        channels = message.get("channels")
+        subscription = None if channels is None else parse_subscription(channels)
+    except ValueError as e:
+        return json.dumps({"type": "error", "error": str(e)})
+    for stream in streams:
+        stream.subscribe(subscription)
+    if subscription is None:
+        return json.dumps({"type": "subscribed", "channels": None})
+    samples, events = subscription
+    channels = {name: {"fields": list(fields), "mode": mode, "rate": rate}
+                for name, (fields, mode, rate) in samples.items()}
+    channels.update((name, True) for name in sorted(events))
+    return json.dumps({"type": "subscribed", "channels": channels})
+
+
+class WsOptions:
+    """/ws and /stream query parameters, shared by the Flask and the asyncio server."""
+
+    def __init__(self, args):
+        self.encoding = args.get("encoding", "json")
+        if self.encoding not in ENCODINGS:
+            self.encoding = "json"
+        self.window = _int_arg("window", WS_BATCH_WINDOW_MS, 1, args) / 1000.0
+        self.display_rate = _int_arg("display_rate", 0, 0, args)
+        self.backlog = _int_arg("backlog", 0, 0, args)
+        self.policy = args.get("policy", "drop_oldest")
+        # Werkzeug MultiDict (Flask) or multidict (aiohttp)
+        values = args.getlist("device") if hasattr(args, "getlist") else args.getall("device", [])
+        device_ids = [d for arg in values for d in arg.split(",") if d] or [DEFAULT_DEVICE]
+        self.device_ids = list(dict.fromkeys(device_ids))
+        # Channel subscription (JSON, as in the subscribe message) for clients that cannot send one
+        self.channels = args.get("channels")
+
+    def check_devices(self):
+        """Raise DeviceError for an unknown device, so /ws can refuse it before the handshake"""
+        for device_id in self.device_ids:
+            devices.get(device_id)
+
+    def open_streams(self, ready, notify=None, since=None):
+        """Subscribe to every requested device (raises DeviceError for a bad id or channel list)
+
+        ``since`` holds one resume sequence number per device (see ``sse_resume``).
+        """
+        subscription = None
+        if self.channels is not None:
+            try:
+                subscription = parse_subscription(json.loads(self.channels))
+            except ValueError as e:
+                raise DeviceError(f"channels: {e}")
+        tagged = len(self.device_ids) > 1
+        streams = []
+        try:
+            for i, device_id in enumerate(self.device_ids):
+                # Only devices that have connected at least once (404 otherwise)
+                service = devices.get(device_id)
+                sub = service.subscribe(self.policy, self.backlog, ready, notify, since[i] if since else None)
+                stream = WsStream(device_id, service, sub, self.display_rate, tagged)
+                if subscription is not None:
+                    stream.subscribe(subscription)
+                streams.append(stream)
+        except DeviceError:
+            for stream in streams:
+                stream.close()
+            raise
+        return streams
+
+
+def sse_resume(last_event_id, count):
+    """Per-device sequence numbers from an SSE ``Last-Event-ID``, or None if it does not fit"""
+    try:
+        seqs = [int(v) for v in last_event_id.split(",")]
+    except (AttributeError, ValueError):
+        return None
+    return seqs if len(seqs) == count and min(seqs) >= 0 else None
+
+
+def sse_chunk(streams):
+    """What the streams collected since the last call as SSE text ("" if nothing),
+    and the ``(stream, message)`` pairs it holds for ``sse_sent``.
+
+    Every message is one event with the same JSON as the /ws frame; the last one
+    carries the resume id, the sequence number of each device's first sample not
+    sent yet (``WsStream.resume_seq``).
+    """
+    sent = []
+    for stream in streams:
+        sent.extend((stream, message) for message in stream.poll())
+    for stream in streams:
+        sent.extend((stream, message) for message in stream.frames("json"))
+    if not sent:
+        return "", sent
+    out = [f"data: {message}\n\n" for _, message in sent[:-1]]
+    out.append(f"id: {','.join(str(stream.resume_seq()) for stream in streams)}\ndata: {sent[-1][1]}\n\n")
+    return "".join(out), sent
+
+
+def sse_sent(sent, seconds):
+    """Count an SSE chunk's events like /ws frames; the chunk's write time is split between them"""
+    for stream, message in sent:
+        stream.sent(message, seconds / len(sent))
+
+
+@app.route('/stream')
+def sse_stream():
+    """Server-Sent Events with the /ws data, one chunk of events per batch window.
+
+    Same query parameters as /ws (JSON encoding only). An EventSource sends the
+    last id back when it reconnects and the stream resumes from the ring, so a
+    brief reconnect loses nothing (``?last_event_id=`` does the same by hand).
+    """
+    options = WsOptions(request.args)
+    window = options.window
+    since = sse_resume(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"),
+                       len(options.device_ids))
+    ready = threading.Event()
+    streams = options.open_streams(ready, since=since)
+
+    def generate():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            idle_since = time.monotonic()
+            while True:
+                started = time.monotonic()
+                ready.wait(window)
+                # Let samples accumulate for the rest of the window
+                remaining = window - (time.monotonic() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+                chunk, sent = sse_chunk(streams)
+                if chunk:
+                    idle_since = time.monotonic()
+                    write_started = time.perf_counter()
+                    yield chunk
+                    sse_sent(sent, time.perf_counter() - write_started)
+                elif time.monotonic() - idle_since >= SSE_HEARTBEAT:
+                    # Comment line: keeps proxies from timing out and notices a gone client
+                    idle_since = time.monotonic()
+                    yield ": keepalive\n\n"
+        finally:
+            for stream in streams:
+                stream.close()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
 if sock:
+    @app.before_request
+    def ws_check_devices():
+        # flask_sock accepts the handshake before the handler runs; an unknown device gets a 404 instead
+        if request.path == "/ws":
+            WsOptions(request.args).check_devices()
+
     @sock.route('/ws')
     def ws(ws):  # type: ignore
-        while True:
-            item = serial_service.q.get()
+        options = WsOptions(request.args)
+        window = options.window
+        # One event for all of this client's subscribers: wake up when any device has data
+        ready = threading.Event()
+        streams = []
+
+        def send(stream, frame):
+            started = time.perf_counter()
+            ws.send(frame)
+            stream.sent(frame, time.perf_counter() - started)
+
+        def drain():
+            for stream in streams:
+                for text in stream.poll():
+                    send(stream, text)
+
+        try:
+            streams = options.open_streams(ready)
+            while ws.connected:
+                message = ws.receive(timeout=0)
+                while message is not None:
+                    if isinstance(message, str):
+                        ws.send(ws_message(streams, message))
+                    message = ws.receive(timeout=0)
+                started = time.monotonic()
+                ready.wait(window)
+                drain()
+                # Let samples accumulate for the rest of the window before draining again
+                remaining = window - (time.monotonic() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+                    drain()
+                for stream in streams:
+                    for frame in stream.frames(options.encoding):
+                        send(stream, frame)
+        except DeviceError as e:
             try:
-                ws.send(json.dumps(item))
+                ws.send(json.dumps({"type": "console", "text": f"ws: {e}"}))
             except Exception:
-                break
+                pass
+        except Exception:
+            pass
+        finally:
+            for stream in streams:
+                stream.close()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     if not os.path.isdir(WEB_DIR):
         BASE_DIR = os.path.dirname(__file__)
         WEB_DIR = os.path.join(BASE_DIR, "web")
-    print("Starting backend on http://127.0.0.1:5000")
-    app.run(host="127.0.0.1", port=5000, threaded=True)
\ No newline at end of file
+    if "--server" in sys.argv[1:-1]:
+        SERVER_MODE = sys.argv[sys.argv.index("--server") + 1]
+    if SERVER_MODE == "async":
+        import async_server
+        try:
+            async_server.require_aiohttp()
+        except RuntimeError as e:
+            sys.exit(str(e))
+    print(f"Starting backend on http://127.0.0.1:5000 ({SERVER_MODE} server)")
+    if SERVER_MODE == "async":
+        async_server.run(sys.modules[__name__], host="127.0.0.1", port=5000)
+    else:
+        app.run(host="127.0.0.1", port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,232 @@
+import re
+import threading
+from collections import OrderedDict, deque
+from itertools import compress, count
+from operator import itemgetter, or_
+
+# Setpoint changes smaller than this are not treated as steps
+STEP_THRESHOLD = 1e-3
+# Settled means within this fraction of the step size of the new setpoint
+SETTLE_BAND = 0.02
+# A step is closed once the response has stayed settled this long, at the next
+# step, or after MAX_STEP_MS, whichever comes first
+SETTLE_HOLD_MS = 1000
+MAX_STEP_MS = 20000
+MAX_STEPS_PER_GAINS = 100
+# Gain sets kept in the history; the one used least recently goes first (a gain sweep)
+MAX_GAIN_SETS = 50
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+PID_SET_CMD_RE = re.compile(r"^\s*pid\s+set\s+([pid])\s+(\S+)", re.IGNORECASE)
+PID_SET_REPLY_RE = re.compile(r"PID k([PID]) set to (\S+)")
+PID_SHOW_REPLY_RE = re.compile(r"P:\s*(\S+),\s*I:\s*(\S+),\s*D:\s*(\S+)")
+
+
+# Column scans look at blocks this long with min()/max() and only step through
+# the one block that holds the sample they are after
+SCAN_BLOCK = 256
+
+
+def _first_index(flags):
+    # Index of the first true flag; map/compress keep the per-sample work in C
+    return next(compress(count(), flags), None)
+
+
+def _first_outside(values, lo, hi, start=0):
+    """Index of the first value at ``start`` or later that is outside [lo, hi]."""
+    for b in range(start, len(values), SCAN_BLOCK):
+        block = values[b:b + SCAN_BLOCK]
+        if min(block) < lo or max(block) > hi:
+            return b + _first_index(map(or_, map(hi.__lt__, block), map(lo.__gt__, block)))
+    return None
+
+
+def _last_outside(values, lo, hi):
+    """Index of the last value outside [lo, hi]."""
+    for b in range((len(values) - 1) // SCAN_BLOCK * SCAN_BLOCK, -1, -SCAN_BLOCK):
+        block = values[b:b + SCAN_BLOCK]
+        if min(block) < lo or max(block) > hi:
+            flags = list(map(or_, map(hi.__lt__, block), map(lo.__gt__, block)))
+            return b + len(flags) - 1 - flags[::-1].index(True)
+    return None
+
+
+def _first_reaching(values, level, up):
+    """Index of the first value >= ``level`` (``up``) or <= ``level``."""
+    for b in range(0, len(values), SCAN_BLOCK):
+        block = values[b:b + SCAN_BLOCK]
+        if up and max(block) >= level:
+            return b + _first_index(map(level.__le__, block))
+        if not up and min(block) <= level:
+            return b + _first_index(map(level.__ge__, block))
+    return None
+
+
+def compute_step_metrics(ts, setpoint, pitch, sp_before, sp_after):
+    """Step-response metrics of one step window (columns starting at the step)."""
+    n = len(pitch)
+    y0 = pitch[0]
+    amplitude = sp_after - y0
+    metrics = {
+        "t0": ts[0],
+        "from": sp_before,
+        "to": sp_after,
+        "samples": n,
+        "duration": ts[-1] - ts[0],
+        "rise_time": None,
+        "overshoot": None,
+        "peak_time": None,
+        "settling_time": None,
+        "steady_state_error": None,
+    }
+    if n < 2 or abs(amplitude) < STEP_THRESHOLD:
+        return metrics
+    up = amplitude > 0
+    # 10-90 % rise time: first sample past each level
+    i10 = _first_reaching(pitch, y0 + 0.1 * amplitude, up)
+    i90 = _first_reaching(pitch, y0 + 0.9 * amplitude, up)
+    if i10 is not None and i90 is not None:
+        metrics["rise_time"] = ts[i90] - ts[i10]
+    # Overshoot past the new setpoint, as a percentage of the step
+    peak = max(pitch) if up else min(pitch)
+    metrics["peak_time"] = ts[pitch.index(peak)] - ts[0]
+    metrics["overshoot"] = max((peak - sp_after) / amplitude * 100.0, 0.0)
+    # Settling: the sample after the last one outside the band around the new setpoint
+    band = SETTLE_BAND * abs(amplitude)
+    last_out = _last_outside(pitch, sp_after - band, sp_after + band)
+    if last_out is None:
+        metrics["settling_time"] = 0
+    elif last_out < n - 1:
+        metrics["settling_time"] = ts[last_out + 1] - ts[0]
+    # Steady-state error over the last 10 % of the window
+    tail = pitch[-max(n // 10, 1):]
+    metrics["steady_state_error"] = sp_after - sum(tail) / len(tail)
+    return metrics
+
+
+class StepResponseTracker:
+    """Detects setpoint steps in the sample stream and measures the response.
+
+    Fed each decoded chunk right after it is appended to the SampleRing. Steps are
+    found and measured with block scans of the columns: min()/max() of each slice
+    rule out whole blocks, and only the block holding the sample in question is
+    stepped through with map()/compress(), so no Python code runs per sample and
+    NumPy is not needed. Metrics are computed once per step over the ring's
+    column slices. The first setpoint after a connect counts as a step from 0 unless
+    the pitch already sits on it.
+    Results are kept per PID gain set, as captured from ``pid set`` commands and
+    the board's replies.
+    """
+
+    def __init__(self, ring, publish):
+        self.ring = ring
+        self.publish = publish
+        self.gains = {"p": None, "i": None, "d": None}
+        self.history = OrderedDict()
+        self.setpoint = None
+        self.step = None
+        self._lock = threading.Lock()
+
+    # --- gain capture -------------------------------------------------------
+
+    def on_command(self, cmd):
+        m = PID_SET_CMD_RE.match(cmd)
+        if m:
+            self._set_gain(m.group(1), m.group(2))
+
+    def on_console(self, text):
+        text = ANSI_RE.sub("", text)
+        m = PID_SET_REPLY_RE.search(text)
+        if m:
+            self._set_gain(m.group(1), m.group(2))
+            return
+        m = PID_SHOW_REPLY_RE.search(text)
+        if m:
+            for name, value in zip("pid", m.groups()):
+                self._set_gain(name, value)
+
+    def _set_gain(self, name, value):
+        try:
+            self.gains[name.lower()] = float(value)
+        except ValueError:
+            pass
+
+    # --- step detection -----------------------------------------------------
+
+    def reset(self):
+        """Forget the setpoint and any open step (new connection)."""
+        self.setpoint = None
+        self.step = None
+
+    def process(self, rows, first_seq):
+        setpoints = list(map(itemgetter(1), rows))
+        if self.setpoint is None:
+            # First setpoint after a connect: a step from 0 if the response is still
+            # on its way there; if the board was already holding it, just the baseline
+            first_sp, first_pitch = rows[0][1], rows[0][2]
+            band = SETTLE_BAND * max(abs(first_sp), STEP_THRESHOLD)
+            self.setpoint = 0.0 if abs(first_pitch - first_sp) > band else first_sp
+        sp = self.setpoint
+        i = _first_outside(setpoints, sp - STEP_THRESHOLD, sp + STEP_THRESHOLD)
+        while i is not None:
+            value = setpoints[i]
+            self._close(first_seq + i)
+            # Filed under the gains the step ran with, even if they change before it closes
+            self.step = {"start": first_seq + i, "t0": rows[i][0], "from": self.setpoint,
+                         "to": value, "settled_since": None, "gains": dict(self.gains)}
+            self.setpoint = value
+            i = _first_outside(setpoints, value - STEP_THRESHOLD, value + STEP_THRESHOLD, i + 1)
+        step = self.step
+        if step is None:
+            return
+        last_ts = rows[-1][0]
+        if last_ts - step["t0"] >= MAX_STEP_MS:
+            self._close(first_seq + len(rows))
+            return
+        # Settled for the whole chunk? (band relative to the commanded step)
+        band = SETTLE_BAND * max(abs(step["to"] - step["from"]), STEP_THRESHOLD)
+        start = max(step["start"] - first_seq, 0)
+        pitch = list(map(itemgetter(2), rows[start:]))
+        if pitch and (max(pitch) > step["to"] + band or min(pitch) < step["to"] - band):
+            step["settled_since"] = None
+        elif step["settled_since"] is None:
+            step["settled_since"] = rows[start][0] if start < len(rows) else last_ts
+        elif last_ts - step["settled_since"] >= SETTLE_HOLD_MS:
+            self._close(first_seq + len(rows))
+
+    def _close(self, end_seq):
+        step, self.step = self.step, None
+        if step is None:
+            return
+        cols, _, _ = self.ring.columns(step["start"], end_seq)
+        ts, setpoint, pitch = cols[0], cols[1], cols[2]
+        if len(ts) < 2:
+            return
+        metrics = compute_step_metrics(ts, setpoint, pitch, step["from"], step["to"])
+        gains = step["gains"]
+        metrics["gains"] = gains
+        key = (gains["p"], gains["i"], gains["d"])
+        with self._lock:
+            steps = self.history.get(key)
+            if steps is None:
+                steps = self.history[key] = deque(maxlen=MAX_STEPS_PER_GAINS)
+                while len(self.history) > MAX_GAIN_SETS:
+                    self.history.popitem(last=False)
+            else:
+                self.history.move_to_end(key)
+            steps.append(metrics)
+        self.publish(dict(metrics, type="step_metrics"))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "gains": dict(self.gains),
+                "history": [
+                    {"gains": dict(zip("pid", key)), "steps": list(steps)}
+                    for key, steps in self.history.items()
+                ],
+            }
+
+    def clear(self):
+        with self._lock:
+            self.history.clear()
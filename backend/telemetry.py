@@ -0,0 +1,571 @@
+import itertools
+import json
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from multiprocessing import shared_memory
+
+# Column names of a decoded sample row, in PACKET_STRUCT order
+SAMPLE_FIELDS = ("timestamp", "setpoint", "pitch", "error", "pitch_angle", "roll_angle")
+
+# Binary batch frame (little-endian):
+# 4s magic "RWSB", uint32 count, then uint32 timestamp[count] and float32 column[count]
+# for each remaining field in SAMPLE_FIELDS order. Every column starts 4-byte aligned
+# so the browser can view it with a typed array directly.
+BATCH_MAGIC = b"RWSB"
+BATCH_HEADER = struct.Struct("<4sI")
+# Device-tagged variant for clients subscribed to several devices: magic "RWSD",
+# uint32 count, uint8 id length, the UTF-8 device id, zero padding to a multiple
+# of 4 bytes, then the same columns.
+DEVICE_BATCH_MAGIC = b"RWSD"
+DEVICE_BATCH_HEADER = struct.Struct("<4sIB")
+
+# Field-masked variant for /ws channel subscriptions: magic "RWSC", uint32 count,
+# uint8 field mask (bit i set: SAMPLE_FIELDS[i + 1] is present), uint8 device id
+# length (0: untagged), the UTF-8 device id, zero padding to a multiple of 4 bytes,
+# then the uint32 timestamp column and the float32 columns of the masked fields.
+CHANNEL_BATCH_MAGIC = b"RWSC"
+CHANNEL_BATCH_HEADER = struct.Struct("<4sIBB")
+
+ENCODINGS = ("json", "binary")
+
+# /ws subscription channels: sample channels carry these fields (plus the timestamp),
+# event channels are hub event types
+SAMPLE_CHANNELS = {"pid": ("setpoint", "pitch", "error"), "angle": ("pitch_angle", "roll_angle")}
+EVENT_CHANNELS = ("console", "freq", "step_metrics")
+# "all": every sample; "decimated": min/max decimation to ``rate`` points/s;
+# "latest": the newest sample, at most ``rate`` times a second
+CHANNEL_MODES = {"all": None, "decimated": 500, "latest": 30}
+
+
+def _column_bytes(typecode, values):
+    col = array(typecode, values)
+    if sys.byteorder != "little":
+        col.byteswap()
+    return col.tobytes()
+
+
+def batch_columns(rows):
+    cols = list(zip(*rows)) or [()] * len(SAMPLE_FIELDS)
+    return dict(zip(SAMPLE_FIELDS, cols))
+
+
+def encode_batch_json(rows, device=None):
+    if device is not None:
+        return json.dumps(dict(type="batch", device=device, **batch_columns(rows)))
+    return json.dumps(dict(type="batch", **batch_columns(rows)))
+
+
+def encode_batch_binary(rows, device=None):
+    cols = list(zip(*rows))
+    if device is None:
+        header = BATCH_HEADER.pack(BATCH_MAGIC, len(rows))
+    else:
+        tag = device.encode()[:255]
+        header = DEVICE_BATCH_HEADER.pack(DEVICE_BATCH_MAGIC, len(rows), len(tag)) + tag
+        header += bytes(-len(header) % 4)
+    parts = [header, _column_bytes("I", cols[0])]
+    parts.extend(_column_bytes("f", col) for col in cols[1:])
+    return b"".join(parts)
+
+
+def encode_batch(rows, encoding="json", device=None):
+    """One sample batch frame; ``device`` tags it for multi-device clients."""
+    if encoding == "binary":
+        return encode_batch_binary(rows, device)
+    return encode_batch_json(rows, device)
+
+
+def encode_channel_batch(rows, fields, encoding="json", device=None, channel=None):
+    """A batch frame with the timestamp and only ``fields`` of each row."""
+    cols = list(zip(*rows)) or [()] * len(SAMPLE_FIELDS)
+    indices = [SAMPLE_FIELDS.index(field) for field in fields]
+    if encoding == "binary":
+        mask = 0
+        for i in indices:
+            mask |= 1 << (i - 1)
+        tag = device.encode()[:255] if device is not None else b""
+        header = CHANNEL_BATCH_HEADER.pack(CHANNEL_BATCH_MAGIC, len(rows), mask, len(tag)) + tag
+        header += bytes(-len(header) % 4)
+        parts = [header, _column_bytes("I", cols[0])]
+        parts.extend(_column_bytes("f", cols[i]) for i in sorted(indices))
+        return b"".join(parts)
+    frame = {"type": "batch"}
+    if device is not None:
+        frame["device"] = device
+    if channel is not None:
+        frame["channel"] = channel
+    frame["timestamp"] = cols[0]
+    for i in indices:
+        frame[SAMPLE_FIELDS[i]] = cols[i]
+    return json.dumps(frame)
+
+
+def parse_subscription(channels):
+    """Validate the ``channels`` of a /ws subscribe message.
+
+    ``{"pid": {"fields": [...], "mode": "decimated", "rate": 500}, "console": true}``
+    becomes ``({"pid": (fields, mode, rate)}, {"console"})``: the sample channels
+    and the event types to send. Omitted channels are not sent. Raises ValueError.
+    """
+    if not isinstance(channels, dict):
+        raise ValueError("channels must be an object")
+    samples, events = {}, set()
+    for name, spec in channels.items():
+        if name in EVENT_CHANNELS:
+            if spec:
+                events.add(name)
+            continue
+        if name not in SAMPLE_CHANNELS:
+            raise ValueError(f"unknown channel: {name}")
+        if not spec:
+            continue
+        spec = spec if isinstance(spec, dict) else {}
+        fields = spec.get("fields") or SAMPLE_CHANNELS[name]
+        if not isinstance(fields, (list, tuple)) or not set(fields) <= set(SAMPLE_CHANNELS[name]):
+            raise ValueError(f"{name} fields must be a list of {', '.join(SAMPLE_CHANNELS[name])}")
+        mode = spec.get("mode", "all")
+        if mode not in CHANNEL_MODES:
+            raise ValueError(f"mode must be one of {', '.join(CHANNEL_MODES)}")
+        rate = spec.get("rate", CHANNEL_MODES[mode])
+        if mode != "all" and not (isinstance(rate, (int, float)) and rate > 0):
+            raise ValueError(f"{name} rate must be a positive number")
+        samples[name] = (tuple(f for f in SAMPLE_CHANNELS[name] if f in fields), mode, rate)
+    return samples, events
+
+
+class SampleChannel:
+    """One subscribed sample channel of a /ws stream: picks what to send from each window's rows."""
+
+    def __init__(self, name, fields, mode, rate):
+        self.name = name
+        self.fields = fields
+        self.mode = mode
+        self.decimator = MinMaxDecimator(rate) if mode == "decimated" else None
+        self.interval = 1.0 / rate if mode == "latest" else 0.0
+        self.latest = None
+        self.next_due = 0.0
+
+    def take(self, rows, now):
+        if self.decimator:
+            return self.decimator.process(rows) if rows else self.decimator.flush()
+        if self.mode == "latest":
+            if rows:
+                self.latest = rows[-1]
+            if self.latest is None or now < self.next_due:
+                return []
+            # Keep to the rate on average even though sends land on window boundaries
+            if now - self.next_due > self.interval:
+                self.next_due = now + self.interval
+            else:
+                self.next_due += self.interval
+            latest, self.latest = self.latest, None
+            return [latest]
+        return rows
+
+
+class MinMaxDecimator:
+    """Shape-preserving decimation of a sample stream to about ``rate`` points/s per trace.
+
+    Samples are grouped into buckets of ``2 / rate`` seconds of device time. Each
+    bucket becomes two rows, stamped with its first and last timestamps, that carry
+    every field's minimum and maximum in the order they occurred, so spikes and
+    envelopes survive while the point count is bounded. Buckets are closed
+    incrementally as chunks arrive; the open bucket is carried to the next call.
+    """
+
+    def __init__(self, rate):
+        self.width = max(2000.0 / rate, 1.0)  # ms of device time per bucket
+        self.pending = []
+
+    def process(self, rows):
+        rows = self.pending + rows if self.pending else rows
+        if not rows:
+            return []
+        ts = [r[0] for r in rows]
+        if ts[-1] < ts[0]:
+            # Device timestamp went backwards (board reset): pass the chunk through
+            self.pending = []
+            return rows
+        out = []
+        start, n = 0, len(rows)
+        while start < n:
+            end = bisect_left(ts, ts[start] + self.width, start)
+            if end >= n:
+                break
+            out.extend(self._bucket(rows[start:end]))
+            start = end
+        self.pending = rows[start:]
+        return out
+
+    def flush(self):
+        out = self._bucket(self.pending)
+        self.pending = []
+        return out
+
+    @staticmethod
+    def _bucket(rows):
+        if len(rows) <= 2:
+            return list(rows)
+        cols = list(zip(*rows))
+        first, second = [cols[0][0]], [cols[0][-1]]
+        for col in cols[1:]:
+            lo, hi = min(col), max(col)
+            if col.index(lo) <= col.index(hi):
+                first.append(lo)
+                second.append(hi)
+            else:
+                first.append(hi)
+                second.append(lo)
+        return [tuple(first), tuple(second)]
+
+
+class SampleRing:
+    """Fixed-capacity ring of recent samples stored as typed arrays (24 bytes/sample).
+
+    Samples are addressed by a monotonically increasing sequence number. When the
+    ring is full the oldest samples are overwritten (counted in ``overwritten``) and
+    reads that start before ``oldest`` report how many samples were lost. Memory use
+    is fixed at construction regardless of whether anyone is reading.
+    """
+
+    TYPECODES = ("I", "f", "f", "f", "f", "f")
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.cols = [array(tc, bytes(4 * self.capacity)) for tc in self.TYPECODES]
+        self.head = 0  # sequence number of the next sample written
+        self.overwritten = 0
+        # Held by writers across append + publish so readers can snapshot a consistent head
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    @property
+    def oldest(self):
+        return max(self.head - self.capacity, 0)
+
+    def append(self, rows):
+        n = len(rows)
+        if not n:
+            return
+        with self.lock:
+            self.overwritten += max(len(self) + n - self.capacity, 0)
+            self._store(self.head, rows)
+            self.head += n
+
+    def _store(self, seq, rows):
+        # Write rows as samples seq, seq + 1, ...; only the last ``capacity`` fit
+        cap = self.capacity
+        n = len(rows)
+        if n > cap:
+            rows = rows[-cap:]
+        start = (seq + n - len(rows)) % cap
+        first = min(len(rows), cap - start)
+        for tc, arr, col in zip(self.TYPECODES, self.cols, zip(*rows)):
+            arr[start:start + first] = array(tc, col[:first])
+            if first < len(rows):
+                arr[:len(rows) - first] = array(tc, col[first:])
+
+    def columns(self, start, stop=None):
+        """Copy samples [start, stop) out as one typed array per field.
+
+        Returns ``(columns, start, lost)`` where ``start`` is clamped to the oldest
+        sample still held and ``lost`` is how many requested samples were overwritten.
+        """
+        with self.lock:
+            stop = self.head if stop is None else min(stop, self.head)
+            lost = max(self.oldest - start, 0)
+            start = max(start, self.oldest)
+            if start >= stop:
+                return [array(tc) for tc in self.TYPECODES], start, lost
+            cap = self.capacity
+            i, j = start % cap, stop % cap
+            if i < j:
+                cols = [arr[i:j] for arr in self.cols]
+            else:
+                cols = [arr[i:] + arr[:j] for arr in self.cols]
+        return cols, start, lost
+
+    def read(self, start, stop=None):
+        """Like ``columns`` but returns a list of row tuples."""
+        cols, start, lost = self.columns(start, stop)
+        return list(zip(*cols)), start, lost
+
+    def timestamp_at(self, seq):
+        return self.cols[0][seq % self.capacity]
+
+    def find(self, timestamp):
+        """First sequence number whose timestamp is >= ``timestamp`` (timestamps assumed monotonic)."""
+        with self.lock:
+            lo, hi = self.oldest, self.head
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.timestamp_at(mid) < timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+
+class SharedSampleRing(SampleRing):
+    """SampleRing whose columns live in a ``multiprocessing.shared_memory`` block.
+
+    Used by the process reader mode: the reader process is the only writer and
+    the web process reads the same pages directly instead of receiving samples
+    through a pipe. The block starts with two uint64 sequence numbers: the writer
+    bumps ``reserved`` before it touches the columns and ``committed`` after, so
+    a reader can drop whatever it copied from slots that were being overwritten
+    meanwhile. ``head`` remains what this process has published (the web
+    process advances it as it processes committed samples); ``committed`` is
+    how far the writer has got. Created with ``name=None`` (owner, unlinks on
+    ``close``) or attached by name.
+    """
+
+    HEADER_SIZE = 64
+    _COMMITTED, _RESERVED = 0, 1
+
+    def __init__(self, capacity, name=None):
+        self.capacity = max(int(capacity), 1)
+        column_size = 4 * self.capacity
+        size = self.HEADER_SIZE + column_size * len(self.TYPECODES)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13 attaching registers the block with the resource
+                # tracker shared with the owner, whose unlink() unregisters it
+                self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        buf = self.shm.buf
+        self._views = [buf[:16]]
+        self._marks = self._views[0].cast("Q")
+        self._raw = []
+        self.cols = []
+        for i, tc in enumerate(self.TYPECODES):
+            offset = self.HEADER_SIZE + i * column_size
+            raw = buf[offset:offset + column_size]
+            self._raw.append(raw)
+            self.cols.append(raw.cast(tc))
+        self._views += self._raw
+        self.head = self.committed
+        self.lock = threading.RLock()
+
+    @property
+    def committed(self):
+        return self._marks[self._COMMITTED]
+
+    @property
+    def overwritten(self):
+        return max(self.committed - self.capacity, 0)
+
+    @property
+    def oldest(self):
+        return max(self.committed - self.capacity, 0)
+
+    def append(self, rows):
+        n = len(rows)
+        if not n:
+            return
+        with self.lock:
+            committed = self._marks[self._COMMITTED]
+            self._marks[self._RESERVED] = committed + n
+            self._store(committed, rows)
+            self._marks[self._COMMITTED] = committed + n
+            self.head = committed + n
+
+    def columns(self, start, stop=None):
+        with self.lock:
+            cap = self.capacity
+            committed = self.committed
+            stop = min(self.head if stop is None else stop, committed)
+            oldest = max(committed - cap, 0)
+            lost = max(oldest - start, 0)
+            start = max(start, oldest)
+            if start >= stop:
+                return [array(tc) for tc in self.TYPECODES], start, lost
+            i, j = 4 * (start % cap), 4 * (stop % cap)
+            cols = []
+            for tc, raw in zip(self.TYPECODES, self._raw):
+                col = array(tc)
+                if i < j:
+                    col.frombytes(raw[i:j])
+                else:
+                    col.frombytes(raw[i:])
+                    col.frombytes(raw[:j])
+                cols.append(col)
+            # Slots the writer reserved while we were copying may hold newer samples
+            torn = min(max(self._marks[self._RESERVED] - cap - start, 0), stop - start)
+            if torn:
+                cols = [col[torn:] for col in cols]
+                start += torn
+                lost += torn
+        return cols, start, lost
+
+    def close(self):
+        """Release the mapping (and remove the block if this process created it)."""
+        if self.shm is None:
+            return
+        for view in self.cols + [self._marks] + self._views:
+            view.release()
+        self.cols, self._raw, self._views = [], [], []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+class Subscriber:
+    """Per-client bounded buffer fed by TelemetryHub.
+
+    Sample rows are kept up to ``max_samples``; when the client falls behind the
+    ``drop_oldest`` policy discards the oldest rows and ``decimate`` thins the whole
+    backlog evenly so the client still sees the full time span at a lower rate.
+    Dropped rows are counted in ``dropped``.
+    """
+
+    POLICIES = ("drop_oldest", "decimate")
+    MAX_EVENTS = 1000
+    RATE_WINDOW = 1.0
+
+    def __init__(self, client_id, max_samples, policy="drop_oldest", ready=None, notify=None):
+        self.id = client_id
+        self.max_samples = max(int(max_samples), 1)
+        self.policy = policy if policy in self.POLICIES else "drop_oldest"
+        self.samples = deque(maxlen=self.max_samples)
+        self.events = deque(maxlen=self.MAX_EVENTS)
+        self.dropped = 0
+        self.dropped_events = 0
+        self.sent = 0
+        self.high_water = 0
+        self.send_rate = 0.0  # samples/s handed to the client over the last RATE_WINDOW
+        self.connected_at = time.time()
+        self._rate_start = time.monotonic()
+        self._rate_sent = 0
+        # Set by a /ws channel subscription; anything else is dropped on publish
+        self.wants_samples = True
+        self.event_types = None  # None: every event
+        # Ring sequence number after the newest row pushed / drained by get(); the
+        # owner sets next_seq when it subscribes (SSE resume ids)
+        self.next_seq = 0
+        self.seq = 0
+        self._lock = threading.Lock()
+        # May be shared by several subscribers so one client can wait on many devices
+        self._ready = ready or threading.Event()
+        # Called (from the publishing thread) when the buffer goes from drained to
+        # non-empty, e.g. to wake an event loop with call_soon_threadsafe
+        self._notify = notify
+
+    def push_samples(self, rows):
+        with self._lock:
+            # Under the lock so get() never pairs rows with a seq they do not reach
+            self.next_seq += len(rows)
+            if not self.wants_samples:
+                return
+            overflow = len(self.samples) + len(rows) - self.max_samples
+            if overflow > 0 and self.policy == "decimate":
+                combined = list(self.samples)
+                combined.extend(rows)
+                kept = combined[::-(-len(combined) // self.max_samples)]
+                self.dropped += len(combined) - len(kept)
+                self.samples.clear()
+                self.samples.extend(kept)
+            else:
+                if overflow > 0:
+                    self.dropped += overflow
+                self.samples.extend(rows)
+            if len(self.samples) > self.high_water:
+                self.high_water = len(self.samples)
+            self._wake()
+
+    def push_event(self, item):
+        if self.event_types is not None and item.get("type") not in self.event_types:
+            return
+        with self._lock:
+            if len(self.events) == self.MAX_EVENTS:
+                self.dropped_events += 1
+            self.events.append(item)
+            self._wake()
+
+    def _wake(self):
+        if self._notify is not None and not self._ready.is_set():
+            self._ready.set()
+            self._notify()
+        else:
+            self._ready.set()
+
+    def get(self, timeout=None):
+        """Wait up to ``timeout`` for data, then drain everything buffered as (rows, events)."""
+        self._ready.wait(timeout)
+        with self._lock:
+            rows = list(self.samples)
+            events = list(self.events)
+            self.samples.clear()
+            self.events.clear()
+            self._ready.clear()
+            self.seq = self.next_seq
+        self.sent += len(rows)
+        now = time.monotonic()
+        if now - self._rate_start >= self.RATE_WINDOW:
+            self.send_rate = (self.sent - self._rate_sent) / (now - self._rate_start)
+            self._rate_start = now
+            self._rate_sent = self.sent
+        return rows, events
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "policy": self.policy,
+            "buffered": len(self.samples),
+            "high_water": self.high_water,
+            "capacity": self.max_samples,
+            "sent": self.sent,
+            "send_rate": self.send_rate,
+            "dropped": self.dropped,
+            "dropped_events": self.dropped_events,
+            "connected_for": time.time() - self.connected_at,
+        }
+
+
+class TelemetryHub:
+    """Fans decoded telemetry out to every subscribed client.
+
+    The reader publishes each chunk once; every subscriber gets its own bounded
+    buffer so a slow client never blocks the reader or steals data from others.
+    """
+
+    def __init__(self, max_samples=20000):
+        self.max_samples = max_samples
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, policy="drop_oldest", max_samples=None, ready=None, notify=None):
+        sub = Subscriber(next(self._ids), max_samples or self.max_samples, policy, ready, notify)
+        with self._lock:
+            self._subscribers = self._subscribers + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    def publish_samples(self, rows):
+        for sub in self._subscribers:
+            sub.push_samples(rows)
+
+    def publish(self, item):
+        for sub in self._subscribers:
+            sub.push_event(item)
@@ -1,35 +1,140 @@
-import sys
+import time
+
+STARTED = time.perf_counter()
+
+import importlib
+import json
 import os
 import socket
+import sys
 import threading
-import time
+import urllib.request
 import webbrowser
-from PIL import Image
-import pystray
-import ctypes
+import multiprocessing
 
 # Single instance guard using local TCP port
 SINGLE_INSTANCE_PORT = 56789
 BACKEND_PORT = 5000
 
-def start_backend():
-    # Import here so pyinstaller bundles start_backend and dependencies
-    from start_backend import app  # noqa
-    # Run flask without reloader
-    app.run(host="127.0.0.1", port=BACKEND_PORT, threaded=True, use_reloader=False)
+# Imported one by one on the backend thread so the startup report can break the time down;
+# the tray icon's PIL and pystray wait until the server is listening
+BACKEND_IMPORTS = ("serial", "flask", "flask_cors", "flask_sock", "start_backend")
+TRAY_IMPORTS = ("PIL.Image", "pystray")
+# How long to wait for the backend before opening the browser anyway (slow disk, antivirus scan)
+READY_TIMEOUT = 30.0
+HEALTH_TIMEOUT = 1.0
+
+# --startup-report (or RWS_STARTUP_REPORT=1) prints the startup timings as JSON; /api/health always has them
+STARTUP_REPORT = "--startup-report" in sys.argv[1:] or os.environ.get("RWS_STARTUP_REPORT") == "1"
+
+
+class StartupReport:
+    """Seconds since process start at each startup phase, and the time each import took."""
+
+    def __init__(self):
+        self.phases = {}
+        self.imports = {}
+        self.server_unavailable = None
+
+    def mark(self, phase):
+        self.phases[phase] = round(time.perf_counter() - STARTED, 4)
+
+    def timed_import(self, name):
+        started = time.perf_counter()
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            module = None  # optional (flask_cors, flask_sock); start_backend copes without them
+        self.imports[name] = round(time.perf_counter() - started, 4)
+        return module
+
+    def as_dict(self):
+        report = {"phases": self.phases, "imports": self.imports}
+        if self.server_unavailable:
+            report["server_unavailable"] = self.server_unavailable
+        return report
+
+
+def start_backend(report, ready, failed):
+    try:
+        # Import here so pyinstaller bundles start_backend and dependencies
+        for name in BACKEND_IMPORTS:
+            backend = report.timed_import(name)
+        if backend is None:
+            raise ImportError("start_backend could not be imported")
+        if backend.SERVER_MODE == "async":
+            async_server = report.timed_import("async_server")
+            try:
+                async_server.require_aiohttp()
+            except RuntimeError as e:
+                # Mode unavailable in this build: serve with Flask rather than not at all
+                report.server_unavailable = f"async: {e}"
+                backend.SERVER_MODE = "flask"
+        backend.startup_report = report.as_dict()
+        if backend.SERVER_MODE == "async":
+            server = socket.create_server(("127.0.0.1", BACKEND_PORT))
+        else:
+            # make_server binds and listens in the constructor; app.run would do the same
+            # after a reloader check and a banner
+            from werkzeug.serving import make_server
+            server = make_server("127.0.0.1", BACKEND_PORT, backend.app, threaded=True)
+    except (OSError, SystemExit) as e:
+        # Port in use, most likely by a running instance; make_server reports it with sys.exit(1)
+        failed.append(e if isinstance(e, OSError) else OSError(f"port {BACKEND_PORT} is in use"))
+        ready.set()
+        return
+    except Exception as e:
+        failed.append(e)
+        ready.set()
+        raise
+    # Connections made from here on are queued by the OS until the server accepts them
+    report.mark("listening")
+    ready.set()
+    if backend.SERVER_MODE == "async":
+        async_server.run(backend, handle_signals=False, sock=server)
+    else:
+        server.serve_forever()
+
+
+def backend_running():
+    """True if an RWS backend already answers on BACKEND_PORT (e.g. a second launch)."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{BACKEND_PORT}/api/health", timeout=HEALTH_TIMEOUT) as r:
+            return json.load(r).get("app") == "rws-pid-tuner"
+    except (OSError, ValueError):
+        return False
+
 
 def open_gui():
     webbrowser.open(f"http://127.0.0.1:{BACKEND_PORT}", new=1)
 
+
 def main():
     # When running from a PyInstaller onefile exe, resources are in sys._MEIPASS
     base_dir = getattr(sys, "_MEIPASS", os.path.dirname(__file__))
+    report = StartupReport()
+    report.mark("launched")
     # Start backend server thread
-    t = threading.Thread(target=start_backend, daemon=True)
+    ready = threading.Event()
+    failed = []
+    t = threading.Thread(target=start_backend, args=(report, ready, failed), daemon=True)
     t.start()
 
-    # Wait a moment for server to start then open browser
-    threading.Thread(target=lambda: (time.sleep(1.2), open_gui()), daemon=True).start()
+    # Open the browser as soon as the server listens
+    if not ready.wait(READY_TIMEOUT):
+        report.mark("ready_timeout")
+    if failed:
+        if backend_running():
+            # Already running: bring its GUI up instead of starting a second tray icon
+            open_gui()
+            return
+        if sys.stderr:
+            print(f"Backend did not start: {failed[0]}", file=sys.stderr)
+    else:
+        open_gui()
+        report.mark("browser_opened")
+
+    Image, pystray = (report.timed_import(name) for name in TRAY_IMPORTS)
 
     # Tray icon setup (icon is stored under backend/data/line-chart.ico and bundled)
     icon_path = os.path.join(base_dir, "web", "line-chart.ico")
@@ -54,7 +159,13 @@ def main():
     )
 
     tray_icon = pystray.Icon("RWS Pid-Tuner GUI", image, "RWS Pid-Tuner GUI", menu)
+    report.mark("tray_ready")
+    if STARTUP_REPORT and sys.stdout:
+        # The windowed exe has no stdout; /api/health carries the same report
+        print(json.dumps(report.as_dict(), indent=2), flush=True)
     tray_icon.run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # The process reader mode spawns a child; in the frozen exe it re-enters here
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,740 @@
+"""Importable emulator of the RWS board: plant model, console commands and an engine.
+
+A ``VirtualDevice`` is one board: its PID loop + plant and IMU attitude model, its
+console command handler and its periodic log messages. Device time is the sample
+index divided by the rate, so for a given seed the byte stream depends only on
+the commands it receives and the sample index they arrive at, never on the host
+clock. An ``Engine`` drives any number of devices from one thread, each attached
+to its own transport (a pty pair or a real serial port).
+
+    engine = Engine(rate=10000)
+    for seed in range(4):
+        device, transport = engine.add_pty_device(seed=seed, stream=True)
+        print(transport.path)
+    engine.run()
+"""
+import binascii
+import math
+import os
+import random
+import struct
+import time
+from collections import deque
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PACKET_STRUCT = struct.Struct("<IfffffB")
+
+# Protocol v2 (see backend/protocol.py): sync, uint16 length, uint8 type, payload,
+# CRC-16/CCITT of length + type + payload. Packet frames carry runs of v1 packets.
+FRAME_SYNC = b"\xa5\x5a"
+FRAME_HEADER = struct.Struct("<2sHB")
+FRAME_CRC = struct.Struct("<H")
+FRAME_PACKETS = 0x01
+FRAME_CONSOLE = 0x02
+FRAME_BLOCK = 0x03
+FRAME_MAX_PACKETS = 40
+PROTOCOLS = (1, 2)
+# Compact block frames: t0, channel mask, count, float32 scales, uint8 ms deltas, int16 columns
+BLOCK_HEADER = struct.Struct("<IBH")
+CHANNELS = ("setpoint", "pitch", "error", "pitch_angle", "roll_angle")
+ALL_CHANNELS = (1 << len(CHANNELS)) - 1
+DEFAULT_SCALE = 0.01
+BLOCK_MAX_SAMPLES = 160
+
+DEFAULT_RATE = 1000.0
+DEFAULT_TICK = 0.005
+# Samples per vectorized step; the stacked matrices grow with its square
+MAX_CHUNK = 256
+# Give up catching up (and skip ahead) when the engine is this far behind the clock
+MAX_LAG = 0.1
+# Output held for a transport nobody reads (pty with no backend attached) before dropping
+MAX_PENDING_BYTES = 1 << 20
+
+# ANSI color codes (VT100)
+COLORS = {
+    "INFO": "\x1b[96m",    # Cyan
+    "WARN": "\x1b[93m",    # Yellow
+    "ERROR": "\x1b[91m",   # Red
+    "RESET": "\x1b[0m"
+}
+
+LOG_MESSAGES = [
+    ("INFO", "System running smoothly"),
+    ("WARN", "Sensor jitter detected"),
+    ("ERROR", "IMU read timeout")
+]
+
+PID_HELP = "\nCMD: pid >\n\tset    - set coefs value <p|i|d> <value>\n\tget    - get coefs value <p|i|d>\n\tshow   - print coefs values\n\tstream - on/off data stream <on|off>\n"
+IMU_HELP = "\nCMD: imu >\n\tcalib  - start Gyro calibration\n\tlevel  - wizard tool to calibrate min-center-max angles\n\tshow   - show filter coefficients\n\tmahony - filter coefficients <p|i> <value>\n\toffset - set or show offsets <set x|y|z <val>|show>\n"
+
+PACKET_DTYPE = None if np is None else np.dtype([
+    ("ts", "<u4"), ("setpoint", "<f4"), ("pitch", "<f4"), ("error", "<f4"),
+    ("pitch_angle", "<f4"), ("roll_angle", "<f4"), ("end", "u1"),
+])
+
+
+# === Model ===
+
+def setpoint_at(t):
+    """Example setpoint: step every 10 sec"""
+    return 20.0 if int(t / 10) % 2 == 0 else 0.0
+
+
+def pid_step(state, sp, gains, dt):
+    """One PID + plant step; linear in (state, sp) for fixed gains"""
+    p, v, i, last_e = state
+    kp, ki, kd = gains
+
+    # --- PID control ---
+    error = sp - p
+    i += error * dt
+    derivative = (error - last_e) / dt
+
+    u = kp * error + ki * i + kd * derivative
+
+    # --- System dynamics ---
+    wn = 2.0    # rad/s natural frequency
+    zeta = 0.7  # damping ratio
+
+    acc = u - (2 * zeta * wn * v + wn**2 * p)
+    v += acc * dt
+    p += v * dt
+
+    return p, v, i, error
+
+
+def imu_targets(t):
+    """Commanded attitude at time t (s): slow swing + turbulence + a maneuver every 12 s"""
+    base_pitch = 25.0 * math.sin(0.2 * t)
+    base_roll = 20.0 * math.cos(0.17 * t)
+
+    turbulence_pitch = 5.0 * math.sin(2.0 * t) + 2.5 * math.sin(5.0 * t)
+    turbulence_roll = 4.0 * math.cos(2.2 * t) + 1.8 * math.sin(4.8 * t)
+
+    maneuver_time = int(t / 12) * 12
+    maneuver_progress = (t - maneuver_time) / 2.0
+
+    if maneuver_progress < 1.0:
+        maneuver_factor = 1.0 / (1.0 + math.exp(-10 * (maneuver_progress - 0.5)))
+        maneuver_pitch = 45.0 * maneuver_factor * math.sin(math.pi * maneuver_progress)
+        maneuver_roll = 35.0 * maneuver_factor * math.cos(math.pi * maneuver_progress)
+    else:
+        maneuver_pitch = 0.0
+        maneuver_roll = 0.0
+
+    return base_pitch + turbulence_pitch + maneuver_pitch, base_roll + turbulence_roll + maneuver_roll
+
+
+def imu_targets_vec(t):
+    """imu_targets() over an array of times"""
+    base_pitch = 25.0 * np.sin(0.2 * t)
+    base_roll = 20.0 * np.cos(0.17 * t)
+    turbulence_pitch = 5.0 * np.sin(2.0 * t) + 2.5 * np.sin(5.0 * t)
+    turbulence_roll = 4.0 * np.cos(2.2 * t) + 1.8 * np.sin(4.8 * t)
+    progress = (t - (t // 12) * 12) / 2.0
+    factor = np.where(progress < 1.0, 1.0 / (1.0 + np.exp(-10 * (np.minimum(progress, 1.0) - 0.5))), 0.0)
+    maneuver_pitch = 45.0 * factor * np.sin(np.pi * progress)
+    maneuver_roll = 35.0 * factor * np.cos(np.pi * progress)
+    return base_pitch + turbulence_pitch + maneuver_pitch, base_roll + turbulence_roll + maneuver_roll
+
+
+def imu_step(state, target, noise, dt):
+    """One spring-damper step of an IMU angle; linear in (state, target, noise)"""
+    angle, velocity = state
+
+    damping = 0.92
+    spring_constant = 12.0
+
+    velocity = velocity * damping + (target - angle) * spring_constant * dt
+    angle += velocity * dt + noise
+
+    return angle, velocity
+
+
+def _linear_matrices(step, n_state, n_input):
+    """(A, B) of a linear step function x' = A x + B u, found by probing unit vectors"""
+    zero_u = [0.0] * n_input
+    a = np.array([step(list(np.eye(n_state)[j]), zero_u) for j in range(n_state)]).T
+    b = np.array([step([0.0] * n_state, list(np.eye(n_input)[j])) for j in range(n_input)]).T
+    return a, b
+
+
+def _stacked_powers(a, b, n):
+    """Matrices that advance x' = A x + B u by n steps at once.
+
+    Returns (phi, gamma) with phi of shape (n, s, s) holding A^1..A^n and gamma of
+    shape (n*s, n*m), the block lower-triangular Toeplitz matrix of A^(k-j) B, so
+    that the states x_1..x_n are ``phi @ x0 + (gamma @ u.ravel()).reshape(n, s)``.
+    Any prefix of k steps uses ``phi[:k]`` and ``gamma[:k*s, :k*m]``.
+    """
+    s, m = b.shape
+    phi = np.empty((n, s, s))
+    markov = np.empty((n, s, m))
+    power = np.eye(s)
+    for k in range(n):
+        markov[k] = power @ b
+        power = a @ power
+        phi[k] = power
+    lag = np.arange(n)[:, None] - np.arange(n)[None, :]
+    blocks = np.where((lag >= 0)[:, :, None, None], markov[np.clip(lag, 0, None)], 0.0)
+    gamma = blocks.transpose(0, 2, 1, 3).reshape(n * s, n * m)
+    return phi, gamma
+
+
+# Shared by every device running at the same rate (and gains)
+@lru_cache(maxsize=32)
+def _pid_block_matrices(dt, gains, chunk):
+    return _stacked_powers(*_linear_matrices(lambda x, u: pid_step(x, u[0], gains, dt), 4, 1), chunk)
+
+
+@lru_cache(maxsize=8)
+def _imu_block_matrices(dt, chunk):
+    return _stacked_powers(*_linear_matrices(lambda x, u: imu_step(x, u[0], u[1], dt), 2, 2), chunk)
+
+
+class DeviceModel:
+    """PID loop + plant and IMU attitude of one board, advanced sample by sample.
+
+    ``generate(n)`` returns the next n telemetry packets. With NumPy (``vectorized``)
+    the loop, the plant and the IMU spring-damper, all linear for fixed gains, are
+    advanced a chunk at a time as one product with the stacked powers of their
+    step matrices; otherwise one sample at a time in pure Python. Both paths give
+    the same bytes for a seed however the calls are split, though the two paths'
+    noise streams differ.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, seed=None, vectorized=None, chunk=MAX_CHUNK):
+        self.rate = float(rate)
+        self.dt = 1.0 / self.rate
+        self.vectorized = (np is not None) if vectorized is None else bool(vectorized and np is not None)
+        self.chunk = max(int(chunk), 1)
+        self.index = 0  # samples since boot; device time is index * dt
+        self.pid = {"kp": 1.0, "ki": 0.5, "kd": 0.1}
+        self.pid_state = (0.0, 0.0, 0.0, 0.0)  # pitch, pitch_rate, integral, last_error
+        self.imu_state = [(0.0, 0.0), (0.0, 0.0)]  # (pitch, roll) x (angle, velocity)
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed) if self.vectorized else None
+        self._segment = None
+        self._noise = None
+        self._noise_chunk = None
+
+    @property
+    def gains(self):
+        return self.pid["kp"], self.pid["ki"], self.pid["kd"]
+
+    @property
+    def time(self):
+        return self.index * self.dt
+
+    def generate(self, n):
+        """Next n packets as one bytes object"""
+        if not self.vectorized:
+            return self._generate_scalar(n)
+        out = []
+        end = self.index + n
+        while self.index < end:
+            seg = self._segment
+            if seg is None or self.index >= seg["stop"] or seg["gains"] != self.gains:
+                seg = self._segment = self._compute_segment()
+            row, take = self.index - seg["start"], min(end, seg["stop"]) - self.index
+            out.append(seg["packets"][row:row + take].tobytes())
+            last = row + take - 1
+            self.pid_state = tuple(seg["pid"][last])
+            self.imu_state = [tuple(seg["imu"][0][last]), tuple(seg["imu"][1][last])]
+            self.index += take
+        return b"".join(out)
+
+    def _generate_scalar(self, n):
+        dt, gains, gauss = self.dt, self.gains, self.rng.gauss
+        state, (imu_pitch, imu_roll) = self.pid_state, self.imu_state
+        out = []
+        for k in range(self.index, self.index + n):
+            t = k * dt
+            sp = setpoint_at(t)
+            error = sp - state[0]
+            state = pid_step(state, sp, gains, dt)
+            target_pitch, target_roll = imu_targets(t)
+            imu_pitch = imu_step(imu_pitch, target_pitch, gauss(0, 0.4), dt)
+            imu_roll = imu_step(imu_roll, target_roll, gauss(0, 0.4), dt)
+            out.append(PACKET_STRUCT.pack(int(t * 1000.0) & 0xFFFFFFFF, sp, state[0], error,
+                                          max(-180.0, min(180.0, imu_pitch[0])),
+                                          max(-180.0, min(180.0, imu_roll[0])), 10))
+        self.pid_state, self.imu_state = state, [imu_pitch, imu_roll]
+        self.index += n
+        return b"".join(out)
+
+    def _compute_segment(self):
+        """States and packets from the current index up to the next chunk boundary.
+
+        Segments are aligned to absolute sample indices (and restarted at a gain
+        change) and noise is drawn per aligned chunk, so the output does not depend
+        on how callers split their ``generate`` calls.
+        """
+        start = self.index
+        chunk_start = start - start % self.chunk
+        stop = chunk_start + self.chunk
+        n = stop - start
+        if self._noise_chunk != chunk_start:
+            self._noise = self.np_rng.normal(0.0, 0.4, (self.chunk, 2))
+            self._noise_chunk = chunk_start
+        noise = self._noise[start - chunk_start:]
+
+        t = (start + np.arange(n)) * self.dt
+        sp = np.where((t // 10).astype(np.int64) % 2 == 0, 20.0, 0.0)
+
+        gains = self.gains
+        phi, gamma = _pid_block_matrices(self.dt, gains, self.chunk)
+        x0 = np.asarray(self.pid_state)
+        states = phi[:n] @ x0 + (gamma[:n * 4, :n] @ sp).reshape(n, 4)
+        pitch_before = np.concatenate(([x0[0]], states[:-1, 0]))
+
+        imu_phi, imu_gamma = _imu_block_matrices(self.dt, self.chunk)
+        targets = imu_targets_vec(t)
+        imu = []
+        for axis in range(2):
+            u = np.stack((targets[axis], noise[:, axis]), axis=1).ravel()
+            imu.append(imu_phi[:n] @ np.asarray(self.imu_state[axis]) + (imu_gamma[:n * 2, :n * 2] @ u).reshape(n, 2))
+
+        packets = np.zeros(n, dtype=PACKET_DTYPE)
+        packets["ts"] = (t * 1000.0).astype(np.uint32)
+        packets["setpoint"] = sp
+        packets["pitch"] = states[:, 0]
+        packets["error"] = sp - pitch_before
+        # Clamped on output only: the clamp never engages for this model's range
+        packets["pitch_angle"] = np.clip(imu[0][:, 0], -180.0, 180.0)
+        packets["roll_angle"] = np.clip(imu[1][:, 0], -180.0, 180.0)
+        packets["end"] = 10
+        return {"start": start, "stop": stop, "gains": gains, "pid": states, "imu": imu, "packets": packets}
+
+
+# === Device ===
+
+def encode_frame(frame_type, payload):
+    header = FRAME_HEADER.pack(FRAME_SYNC, len(payload), frame_type)
+    crc = binascii.crc_hqx(payload, binascii.crc_hqx(header[2:], 0xFFFF))
+    return header + payload + FRAME_CRC.pack(crc)
+
+
+def _block_runs(ts):
+    # Split where a block cannot hold the timestamp step (0..255 ms) or is full
+    start = 0
+    for i in range(1, len(ts) + 1):
+        if i == len(ts) or i - start == BLOCK_MAX_SAMPLES or not 0 <= ts[i] - ts[i - 1] <= 0xFF:
+            yield start, i
+            start = i
+
+
+def encode_blocks(packets, mask=ALL_CHANNELS, scale=DEFAULT_SCALE):
+    """Re-encode v1 packet bytes as compact block frames (only the channels in ``mask``)."""
+    enabled = [bit for bit in range(len(CHANNELS)) if mask >> bit & 1]
+    scales = struct.pack(f"<{len(enabled)}f", *([scale] * len(enabled)))
+    frames = []
+    if np is not None:
+        arr = np.frombuffer(packets, PACKET_DTYPE)
+        ts = arr["ts"].astype(np.int64)
+        columns = [np.clip(np.rint(arr[CHANNELS[bit]].astype(np.float64) / scale), -0x8000, 0x7FFF).astype("<i2")
+                   for bit in enabled]
+        for start, stop in _block_runs(ts.tolist()):
+            parts = [BLOCK_HEADER.pack(int(ts[start]), mask, stop - start), scales,
+                     np.diff(ts[start:stop]).astype(np.uint8).tobytes()]
+            parts += [col[start:stop].tobytes() for col in columns]
+            frames.append(encode_frame(FRAME_BLOCK, b"".join(parts)))
+        return b"".join(frames)
+    rows = list(PACKET_STRUCT.iter_unpack(packets))
+    ts = [row[0] for row in rows]
+    for start, stop in _block_runs(ts):
+        chunk = rows[start:stop]
+        parts = [BLOCK_HEADER.pack(ts[start], mask, len(chunk)), scales,
+                 bytes(b - a for a, b in zip(ts[start:stop], ts[start + 1:stop]))]
+        for bit in enabled:
+            col = [min(max(round(row[bit + 1] / scale), -0x8000), 0x7FFF) for row in chunk]
+            parts.append(struct.pack(f"<{len(col)}h", *col))
+        frames.append(encode_frame(FRAME_BLOCK, b"".join(parts)))
+    return b"".join(frames)
+
+
+def _is_float(s: str):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def _onoff(value_str):
+    if value_str.lower() == "on":
+        return 1
+    elif value_str.lower() == "off":
+        return 0
+    else:
+        return -1
+
+
+class VirtualDevice:
+    """One emulated board: model, console command handler and log messages.
+
+    ``feed(data)`` takes bytes received from the host and returns the console
+    replies; ``advance(n)`` runs the control loop n samples and returns what the
+    board sends meanwhile (packets while streaming, plus the odd log line, which
+    is scheduled in device time from the seed).
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, seed=None, stream=False, vectorized=None, logs=True, protocol=1,
+                 channels=None, scale=DEFAULT_SCALE):
+        if protocol not in PROTOCOLS:
+            raise ValueError("protocol must be 1 or 2")
+        if channels is not None and protocol != 2:
+            raise ValueError("compact blocks need protocol 2")
+        self.model = DeviceModel(rate, seed, vectorized)
+        self.protocol = protocol
+        # Channel mask for compact block frames (None: full packets)
+        self.channels = channels
+        self.scale = scale
+        self.streaming = stream
+        self.mahony = {"kp": 2.0, "ki": 0.1}
+        self.imu_offset = {"x": 1.0, "y": 0.2, "z": 3.0}
+        self.log_rng = random.Random(seed)
+        self.next_log = self._schedule_log(0) if logs else None
+        self.inbuf = b""
+        self.out = []
+
+    @property
+    def pid(self):
+        return self.model.pid
+
+    def _schedule_log(self, index):
+        return index + int(self.log_rng.uniform(3, 8) * self.model.rate)
+
+    def _write(self, text):
+        if self.protocol == 1:
+            self.out.append(text.encode())
+            return
+        for line in text.split("\n"):
+            if line:
+                self.out.append(encode_frame(FRAME_CONSOLE, line.encode()))
+
+    def _write_packets(self, packets):
+        if self.protocol == 1:
+            self.out.append(packets)
+            return
+        if self.channels is not None:
+            self.out.append(encode_blocks(packets, self.channels, self.scale))
+            return
+        step = FRAME_MAX_PACKETS * PACKET_STRUCT.size
+        for i in range(0, len(packets), step):
+            self.out.append(encode_frame(FRAME_PACKETS, packets[i:i + step]))
+
+    def _drain(self):
+        data, self.out = b"".join(self.out), []
+        return data
+
+    # --- output --------------------------------------------------------------
+
+    def advance(self, n):
+        model = self.model
+        end = model.index + n
+        while model.index < end:
+            stop = end if self.next_log is None else min(end, self.next_log)
+            packets = model.generate(stop - model.index)
+            if self.streaming:
+                self._write_packets(packets)
+            if model.index == self.next_log:
+                level, msg = self.log_rng.choice(LOG_MESSAGES)
+                self._write(f"{COLORS[level]}[{level}] {msg}{COLORS['RESET']}\n")
+                self.next_log = self._schedule_log(model.index)
+        return self._drain()
+
+    # --- commands ------------------------------------------------------------
+
+    def feed(self, data):
+        self.inbuf += data
+        while b"\n" in self.inbuf:
+            line, self.inbuf = self.inbuf.split(b"\n", 1)
+            try:
+                self.handle_command(line.decode().strip())
+            except Exception as e:
+                self._write(f"{COLORS['ERROR']}ERR: {e}{COLORS['RESET']}\n")
+        return self._drain()
+
+    def handle_command(self, cmd: str):
+        parts = cmd.strip().split()
+        if not parts:
+            return
+
+        if parts[0] == "pid":
+            self.cli_pid(parts[1:])
+        elif parts[0] == "imu":
+            self.cli_imu(parts[1:])
+        elif parts[0] == "help" or parts[0] == "?":
+            self._write(PID_HELP + IMU_HELP)
+        elif parts[0] == "status":
+            self._write(self.status())
+        else:
+            self._write(f"{COLORS['WARN']}Unknown command: {cmd}{COLORS['RESET']}\n")
+
+    def status(self):
+        model, pid, mahony, imu_offset = self.model, self.pid, self.mahony, self.imu_offset
+        msg = f"{COLORS['INFO']}System Status:{COLORS['RESET']}\n"
+        msg += f"  Pitch Angle: {model.imu_state[0][0]:6.2f}°\n"
+        msg += f"  Roll Angle:  {model.imu_state[1][0]:6.2f}°\n"
+        msg += f"  PID Pitch:   {model.pid_state[0]:6.2f}\n"
+        msg += f"  Setpoint:    {setpoint_at(model.time):6.2f}\n"
+        msg += f"  Streaming:   {'ON' if self.streaming else 'OFF'}\n"
+        msg += f"  PID: kP={pid['kp']:4.2f}, kI={pid['ki']:4.2f}, kD={pid['kd']:4.2f}\n"
+        msg += f"  Mahony: kP={mahony['kp']:4.2f}, kI={mahony['ki']:4.2f}\n"
+        msg += f"  IMU Offset: X={imu_offset['x']:4.2f}, Y={imu_offset['y']:4.2f}, Z={imu_offset['z']:4.2f}\n"
+        return msg
+
+    def cli_pid(self, argv):
+        pid = self.pid
+
+        if not argv:
+            self._write(f"{COLORS['ERROR']}ERR: missing arguments{COLORS['RESET']}\n")
+            return
+
+        cmd = argv[0].lower()
+
+        if cmd == "show":
+            self._write(f"P: {pid['kp']:4.2f}, I: {pid['ki']:4.2f}, D: {pid['kd']:4.2f}\n")
+
+        elif cmd == "set" and len(argv) >= 3:
+            param = argv[1].lower()
+            val = argv[2]
+            if _is_float(val):
+                value = float(val)
+                if param in ("p", "i", "d"):
+                    pid["k" + param] = value
+                    self._write(f"{COLORS['INFO']}PID k{param.upper()} set to {value}{COLORS['RESET']}\n")
+                else:
+                    self._write(f"{COLORS['ERROR']}ERR: unknown parameter{COLORS['RESET']}\n")
+            else:
+                self._write(f"{COLORS['ERROR']}ERR: invalid value{COLORS['RESET']}\n")
+
+        elif cmd == "get" and len(argv) >= 2:
+            param = argv[1].lower()
+            if param in ("p", "i", "d"):
+                self._write(f"{pid['k' + param]:4.2f}\n")
+            else:
+                self._write(f"{COLORS['ERROR']}ERR: unknown parameter{COLORS['RESET']}\n")
+
+        elif cmd == "stream" and len(argv) >= 2:
+            value = _onoff(argv[1])
+            if value == 0:
+                self.streaming = False
+                self._write(f"{COLORS['WARN']}PID streaming OFF{COLORS['RESET']}\n")
+            elif value == 1:
+                self.streaming = True
+                self._write(f"{COLORS['INFO']}PID streaming ON{COLORS['RESET']}\n")
+            else:
+                self._write(f"{COLORS['ERROR']}ERR: invalid on/off value{COLORS['RESET']}\n")
+        else:
+            self._write(PID_HELP)
+
+    def cli_imu(self, argv):
+        mahony, imu_offset = self.mahony, self.imu_offset
+
+        if not argv:
+            self._write(f"{COLORS['ERROR']}ERR: missing arguments{COLORS['RESET']}\n")
+            return
+
+        cmd = argv[0].lower()
+
+        if cmd == "offset" and len(argv) >= 2:
+            subcmd = argv[1].lower()
+            if subcmd == "set" and len(argv) >= 4:
+                axis = argv[2].lower()
+                val = argv[3]
+                if axis in imu_offset and _is_float(val):
+                    imu_offset[axis] = float(val)
+                    self._write(f"{COLORS['INFO']}IMU offset {axis.upper()} set to {float(val):4.2f}{COLORS['RESET']}\n")
+                else:
+                    self._write(f"{COLORS['ERROR']}ERR: invalid axis or value{COLORS['RESET']}\n")
+            elif subcmd == "show":
+                self._write(f"X: {imu_offset['x']:4.2f}, Y: {imu_offset['y']:4.2f}, Z: {imu_offset['z']:4.2f}\n")
+            else:
+                self._write(f"{COLORS['ERROR']}ERR: offset usage: offset set <x|y|z> <value> | offset show{COLORS['RESET']}\n")
+            return
+
+        if cmd == "calib":
+            self._write(f"{COLORS['INFO']}Starting gyro calibration...{COLORS['RESET']}\n")
+
+        elif cmd == "level":
+            self._write(f"{COLORS['INFO']}Starting level calibration wizard...{COLORS['RESET']}\n")
+
+        elif cmd == "mahony" and len(argv) >= 2:
+            subcmd = argv[1].lower()
+            if subcmd in ("p", "i") and len(argv) >= 3:
+                val = argv[2]
+                if _is_float(val):
+                    mahony["k" + subcmd] = float(val)
+                    self._write(f"{COLORS['INFO']}Mahony k{subcmd.upper()} set to {val}{COLORS['RESET']}\n")
+                else:
+                    self._write(f"{COLORS['ERROR']}ERR: invalid value{COLORS['RESET']}\n")
+            elif subcmd == "show":
+                self._write(f"P: {mahony['kp']:4.2f}, I: {mahony['ki']:4.2f}\n")
+            else:
+                self._write(f"{COLORS['ERROR']}ERR: mahony usage: mahony <p|i|show> <value>{COLORS['RESET']}\n")
+
+        elif cmd == "show":
+            self._write(f"P: {mahony['kp']:4.2f}, I: {mahony['ki']:4.2f}\n")
+
+        else:
+            self._write(IMU_HELP)
+
+
+# === Transports ===
+
+class PtyTransport:
+    """Master side of a pseudo-terminal; the backend opens ``path`` (the slave).
+
+    Writes never block the engine: output the other side is not reading is queued
+    up to ``max_pending`` bytes, then whole writes are dropped (counted in
+    ``dropped``) so packet framing survives, like a UART nobody listens to.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_BYTES):
+        import tty
+        self.master, self.slave = os.openpty()
+        # Raw mode: no echo of our output back to us, no newline translation
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.dropped = 0
+
+    def read(self):
+        try:
+            return os.read(self.master, 65536)
+        except (BlockingIOError, OSError):
+            return b""
+
+    def write(self, data):
+        if data:
+            self.pending.append(memoryview(data))
+            self.pending_bytes += len(data)
+        while self.pending:
+            try:
+                n = os.write(self.master, self.pending[0])
+            except (BlockingIOError, OSError):
+                break
+            self.pending_bytes -= n
+            if n == len(self.pending[0]):
+                self.pending.popleft()
+            else:
+                self.pending[0] = self.pending[0][n:]
+                break
+        # Drop whole queued writes (never the one in progress) until under the limit
+        while self.pending_bytes > self.max_pending and len(self.pending) > 1:
+            self.dropped += len(self.pending[1])
+            self.pending_bytes -= len(self.pending[1])
+            del self.pending[1]
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class SerialTransport:
+    """A real serial port opened with pyserial."""
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.path = ser.port
+        self.dropped = 0
+
+    def read(self):
+        waiting = self.ser.in_waiting
+        return self.ser.read(waiting) if waiting else b""
+
+    def write(self, data):
+        if data:
+            try:
+                self.ser.write(data)
+            except Exception:
+                # write timeout: the host is not draining the port
+                self.dropped += len(data)
+
+    def close(self):
+        self.ser.close()
+
+
+# === Engine ===
+
+class Engine:
+    """Runs N virtual devices from one thread on one clock.
+
+    Every tick each device gets its pending host input, then advances by the
+    samples the clock owes and everything it produced goes out in one write.
+    ``step(n)`` advances by n samples without looking at the clock, so tests get
+    identical output for identical seeds and inputs.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, tick=DEFAULT_TICK, vectorized=None):
+        self.rate = float(rate)
+        self.tick = tick
+        self.vectorized = vectorized
+        self.devices = []  # (device, transport)
+        self.running = False
+        self.index = 0
+
+    def add_device(self, transport, seed=None, stream=False, logs=True, protocol=1, channels=None,
+                   scale=DEFAULT_SCALE):
+        device = VirtualDevice(self.rate, seed, stream, self.vectorized, logs, protocol, channels, scale)
+        # Devices added later start at the engine's current time
+        device.model.index = self.index
+        if device.next_log is not None:
+            device.next_log = device._schedule_log(self.index)
+        self.devices.append((device, transport))
+        return device
+
+    def add_pty_device(self, seed=None, stream=False, logs=True, protocol=1, channels=None, scale=DEFAULT_SCALE):
+        transport = PtyTransport()
+        return self.add_device(transport, seed, stream, logs, protocol, channels, scale), transport
+
+    def step(self, n):
+        for device, transport in self.devices:
+            out = device.feed(transport.read())
+            out += device.advance(n)
+            transport.write(out)
+        self.index += n
+
+    def run(self, duration=None):
+        self.running = True
+        max_owed = int(self.rate * (self.tick + MAX_LAG)) + 1
+        start = next_time = time.perf_counter()
+        done = 0
+        while self.running:
+            now = time.perf_counter()
+            if duration is not None and now - start >= duration:
+                break
+            owed = int((now - start) * self.rate) - done
+            if owed > max_owed:
+                # Fell too far behind (machine stalled): skip ahead instead of bursting
+                done += owed - max_owed
+                owed = max_owed
+            self.step(max(owed, 0))
+            done += max(owed, 0)
+            next_time += self.tick
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.stop()
+        for _, transport in self.devices:
+            transport.close()
@@ -78,18 +78,14 @@ export default function PIDControls() {
     }
 
     try {
-      // Send PID values individually with new commands
-      await apiService.sendCommand(`pid set p ${state.pid.p}`)
-      await apiService.sendCommand(`pid set i ${state.pid.i}`)
-      await apiService.sendCommand(`pid set d ${state.pid.d}`)
-
-      // Add console messages for sent commands
+      // Send all three gains in one batch and confirm them from the replies
       const commands = [
         `pid set p ${state.pid.p}`,
         `pid set i ${state.pid.i}`,
         `pid set d ${state.pid.d}`
       ]
-      
+      const result = await apiService.sendCommands(commands)
+
       commands.forEach(cmd => {
         dispatch({
           type: 'SERIAL_ADD_CONSOLE_MESSAGE',
@@ -101,6 +97,18 @@ export default function PIDControls() {
         })
       })
 
+      if (!result.ok) {
+        const failed = result.results.filter(r => !r.ok)
+        toast({
+          title: 'PID Values Not Confirmed',
+          description: failed.map(r => `${r.cmd}: ${r.reply || r.status}`).join('\n'),
+          status: 'warning',
+          duration: 4000,
+          isClosable: true,
+        })
+        return
+      }
+
       toast({
         title: 'PID Values Set',
         status: 'success',
@@ -36,7 +36,30 @@ export const apiService = {
     return response.json()
   },
 
-  createWebSocket() {
-    return new WebSocket('ws://127.0.0.1:5000/ws')
+  // Sends the commands in one serial write and resolves with their replies:
+  // { ok, results: [{ cmd, ok, status, reply, lines, values }] }
+  async sendCommands(commands, timeout = 1.0) {
+    const response = await fetch(`${API_BASE}/api/command`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ commands, timeout })
+    })
+    if (!response.ok) throw new Error('Failed to send commands')
+    return response.json()
+  },
+
+  // encoding: 'json' | 'binary' (packed batch frames), window: batch window in ms,
+  // displayRate: points per second per trace after server-side min/max decimation (0 = full rate)
+  createWebSocket({ encoding = 'binary', window = 50, displayRate = 500 } = {}) {
+    const params = `encoding=${encoding}&window=${window}&display_rate=${displayRate}`
+    const ws = new WebSocket(`ws://127.0.0.1:5000/ws?${params}`)
+    ws.binaryType = 'arraybuffer'
+    return ws
+  },
+
+  // Same data as createWebSocket over Server-Sent Events (JSON only); the browser
+  // resumes from the last event id when it reconnects
+  createEventSource({ window = 50, displayRate = 500 } = {}) {
+    return new EventSource(`${API_BASE}/stream?window=${window}&display_rate=${displayRate}`)
   }
 }
\ No newline at end of file
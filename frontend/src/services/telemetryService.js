@@ -3,6 +3,55 @@
 import { useEffect } from 'react'
 import { apiService } from './apiService.js'
 
+// Binary batch frame: 'RWSB', uint32 count, uint32 timestamps[count], then float32
+// setpoint, pitch, error, pitch_angle, roll_angle columns (see backend/telemetry.py)
+const BATCH_MAGIC = 0x42535752 // 'RWSB' read as little-endian uint32
+const BATCH_HEADER_SIZE = 8
+// Channel batch frame: 'RWSC', uint32 count, uint8 field mask, uint8 device id length,
+// the id padded to 4 bytes, uint32 timestamps, then only the masked float32 columns
+const CHANNEL_BATCH_MAGIC = 0x43535752 // 'RWSC'
+const CHANNEL_BATCH_HEADER_SIZE = 10
+const FLOAT_FIELDS = ['setpoint', 'pitch', 'error', 'pitch_angle', 'roll_angle']
+
+// Consecutive /ws connections that never opened before switching to /stream
+const WS_FAILURES_BEFORE_SSE = 2
+
+// Display rate (points/s per trace) of the decimated pid / angle channels
+const DISPLAY_RATE = 500
+
+function decodeChannelBatch(buffer, view) {
+  const count = view.getUint32(4, true)
+  const mask = view.getUint8(8)
+  const offset = Math.ceil((CHANNEL_BATCH_HEADER_SIZE + view.getUint8(9)) / 4) * 4
+  const batch = { timestamp: new Uint32Array(buffer, offset, count) }
+  let column = 1
+  FLOAT_FIELDS.forEach((field, bit) => {
+    if (mask & (1 << bit)) {
+      batch[field] = new Float32Array(buffer, offset + column * count * 4, count)
+      column++
+    }
+  })
+  return batch
+}
+
+function decodeBinaryBatch(buffer) {
+  const view = new DataView(buffer)
+  if (buffer.byteLength < BATCH_HEADER_SIZE) return null
+  const magic = view.getUint32(0, true)
+  if (magic === CHANNEL_BATCH_MAGIC) return decodeChannelBatch(buffer, view)
+  if (magic !== BATCH_MAGIC) return null
+  const count = view.getUint32(4, true)
+  const column = (i) => BATCH_HEADER_SIZE + i * count * 4
+  return {
+    timestamp: new Uint32Array(buffer, column(0), count),
+    setpoint: new Float32Array(buffer, column(1), count),
+    pitch: new Float32Array(buffer, column(2), count),
+    error: new Float32Array(buffer, column(3), count),
+    pitch_angle: new Float32Array(buffer, column(4), count),
+    roll_angle: new Float32Array(buffer, column(5), count)
+  }
+}
+
 class TelemetryClient {
   constructor() {
     this.ws = null
@@ -10,6 +59,10 @@ class TelemetryClient {
     this.isStreaming = false
     this.connected = false
     this.reconnectTimer = null
+    // Server-Sent Events fallback (/stream) when /ws keeps failing to open,
+    // e.g. a backend without flask_sock
+    this.source = null
+    this.wsFailures = 0
 
     // buffering / batching
     this.pidBuffer = []
@@ -21,7 +74,7 @@ class TelemetryClient {
   start(dispatch) {
     // Always update dispatch reference so actions use the latest dispatch
     this.dispatch = dispatch
-    if (this.ws || this.connected) return
+    if (this.ws || this.source || this.connected) return
     this._open()
 
     // start periodic flush if not running
@@ -31,67 +84,37 @@ class TelemetryClient {
   }
 
   _open() {
+    if (this.wsFailures >= WS_FAILURES_BEFORE_SSE) {
+      this._openEventSource()
+      return
+    }
     try {
       this.ws = apiService.createWebSocket()
     } catch {
+      this.wsFailures++
       this._scheduleReconnect()
       return
     }
 
+    let opened = false
     this.ws.onopen = () => {
+      opened = true
+      this.wsFailures = 0
       this.connected = true
+      this._subscribe()
     }
 
     this.ws.onmessage = (evt) => {
-      let data
-      try {
-        data = JSON.parse(evt.data)
-      } catch {
+      if (evt.data instanceof ArrayBuffer) {
+        const batch = decodeBinaryBatch(evt.data)
+        if (batch) this._bufferBatch(batch)
         return
       }
-      if (!data?.type) return
-      switch (data.type) {
-      case 'pid':
-        // buffer pid points, don't dispatch immediately
-        if (this.isStreaming) {
-          this.pidBuffer.push({
-            timestamp: data.timestamp,
-            setpoint: data.setpoint,
-            pitch: data.pitch,
-            error: data.error
-          })
-        }
-        break
-      case 'angle':
-        // buffer angle points
-        if (this.isStreaming) {
-          this.angleBuffer.push({
-            timestamp: data.timestamp,
-            pitch_angle: data.pitch_angle,
-            roll_angle: data.roll_angle
-          })
-        }
-        break
-      case 'freq':
-        // frequency can be dispatched immediately (UI badge)
-        this.dispatch({ type: 'CHART_SET_FREQUENCY', payload: data.value })
-        break
-      case 'console':
-        this.dispatch({
-          type: 'SERIAL_ADD_CONSOLE_MESSAGE',
-          payload: {
-            timestamp: Date.now(),
-            text: data.text,
-            type: 'received'
-          }
-        })
-        break
-      default:
-        break
-      }
+      this._handleMessage(evt.data)
     }
 
     this.ws.onclose = () => {
+      if (!opened) this.wsFailures++
       this.connected = false
       this.ws = null
       if (this.dispatch) {
@@ -104,6 +127,120 @@ class TelemetryClient {
     }
   }
 
+  // EventSource reconnects by itself and resumes from the last event id, so
+  // only a stream the browser gave up on needs reopening
+  _openEventSource() {
+    try {
+      this.source = apiService.createEventSource()
+    } catch {
+      this._scheduleReconnect()
+      return
+    }
+    this.source.onopen = () => {
+      this.connected = true
+    }
+    this.source.onmessage = (evt) => this._handleMessage(evt.data)
+    this.source.onerror = () => {
+      if (this.source?.readyState === EventSource.CLOSED) {
+        this.connected = false
+        this.source = null
+        if (this.dispatch) this._scheduleReconnect()
+      }
+    }
+  }
+
+  _handleMessage(text) {
+    let data
+    try {
+      data = JSON.parse(text)
+    } catch {
+      return
+    }
+    if (!data?.type) return
+    switch (data.type) {
+    case 'batch':
+      this._bufferBatch(data)
+      break
+    case 'pid':
+      // buffer pid points, don't dispatch immediately
+      if (this.isStreaming) {
+        this.pidBuffer.push({
+          timestamp: data.timestamp,
+          setpoint: data.setpoint,
+          pitch: data.pitch,
+          error: data.error
+        })
+      }
+      break
+    case 'angle':
+      // buffer angle points
+      if (this.isStreaming) {
+        this.angleBuffer.push({
+          timestamp: data.timestamp,
+          pitch_angle: data.pitch_angle,
+          roll_angle: data.roll_angle
+        })
+      }
+      break
+    case 'freq':
+      // frequency can be dispatched immediately (UI badge)
+      this.dispatch({ type: 'CHART_SET_FREQUENCY', payload: data.value })
+      break
+    case 'console':
+      this.dispatch({
+        type: 'SERIAL_ADD_CONSOLE_MESSAGE',
+        payload: {
+          timestamp: Date.now(),
+          text: data.text,
+          type: 'received'
+        }
+      })
+      break
+    default:
+      break
+    }
+  }
+
+  // Ask the backend only for what the views use: samples only while streaming
+  _subscribe() {
+    if (!this.connected || !this.ws) return
+    const channels = { console: true, freq: true, step_metrics: true }
+    if (this.isStreaming) {
+      channels.pid = { mode: 'decimated', rate: DISPLAY_RATE }
+      channels.angle = { mode: 'decimated', rate: DISPLAY_RATE }
+    }
+    try {
+      this.ws.send(JSON.stringify({ type: 'subscribe', channels }))
+    } catch { /* empty */ }
+  }
+
+  // Columnar batch (JSON arrays or typed arrays) -> chart points; channel
+  // batches carry either the pid or the angle columns
+  _bufferBatch(batch) {
+    if (!this.isStreaming) return
+    const count = batch.timestamp.length
+    const hasPid = !!batch.pitch
+    const hasAngle = !!batch.pitch_angle
+    for (let i = 0; i < count; i++) {
+      const timestamp = batch.timestamp[i]
+      if (hasPid) {
+        this.pidBuffer.push({
+          timestamp,
+          setpoint: batch.setpoint[i],
+          pitch: batch.pitch[i],
+          error: batch.error[i]
+        })
+      }
+      if (hasAngle) {
+        this.angleBuffer.push({
+          timestamp,
+          pitch_angle: batch.pitch_angle[i],
+          roll_angle: batch.roll_angle[i]
+        })
+      }
+    }
+  }
+
   _flushBuffers() {
     if (!this.dispatch) return
 
@@ -132,7 +269,9 @@ class TelemetryClient {
   }
 
   setStreaming(flag) {
+    const changed = this.isStreaming !== !!flag
     this.isStreaming = !!flag
+    if (changed) this._subscribe()
     if (!flag) {
       // When stopping streaming, zero frequency immediately (matches prior behavior)
       this.dispatch?.({ type: 'CHART_SET_FREQUENCY', payload: 0 })
@@ -153,6 +292,8 @@ class TelemetryClient {
       try { this.ws.close() } catch { /* empty */ }
     }
     this.ws = null
+    if (this.source) this.source.close()
+    this.source = null
     this.connected = false
 
     // stop flush timer